@@ -0,0 +1,148 @@
+""" Hit rate and put() latency of the CLOCK sweep
+
+Replays key streams against LRUCache with several sweep budgets, and
+against a copy of the previous put(), which walked the clock in a Python
+loop and forced an eviction after 107 referenced slots:
+
+- zipf: a skewed stream over 20 times more keys than fit in the cache.
+- dense: a uniform stream over 5% more keys than fit, so that nearly all
+  reference bits are set when put() looks for a victim.
+
+With repoze.lru importable (installed, or PYTHONPATH set to the checkout),
+run: python benchmarks/clock_sweep.py [cache size] [requests]
+"""
+from __future__ import print_function
+
+import gc
+import random
+import sys
+import time
+
+from repoze.lru import _MARKER
+from repoze.lru import LRUCache
+
+
+class LegacyLRUCache(LRUCache):
+    """ LRUCache with the put() of repoze.lru 0.7 (without tags) """
+    def __init__(self, size):
+        LRUCache.__init__(self, size)
+        # 0.7 allocated the whole clock up front.
+        grow = size - len(self.clock_keys)
+        self.clock_keys.extend([_MARKER] * grow)
+        self.clock_refs.extend([False] * grow)
+        self.maxpos = size - 1
+
+    def put(self, key, val):
+        maxpos = self.maxpos
+        clock_refs = self.clock_refs
+        clock_keys = self.clock_keys
+        data = self.data
+
+        with self.lock:
+            entry = data.get(key)
+            if entry is not None:
+                pos, old_val = entry
+                if old_val is not val:
+                    data[key] = (pos, val)
+                self.clock_refs[pos] = True
+                return
+
+            hand = self.hand
+            count = 0
+            max_count = 107
+            while 1:
+                ref = clock_refs[hand]
+                if ref == True:
+                    clock_refs[hand] = False
+                    hand += 1
+                    if hand > maxpos:
+                        hand = 0
+
+                    count += 1
+                    if count >= max_count:
+                        clock_refs[hand] = False
+                else:
+                    oldkey = clock_keys[hand]
+                    oldentry = data.pop(oldkey, _MARKER)
+                    if oldentry is not _MARKER:
+                        self.evictions += 1
+                    clock_keys[hand] = key
+                    clock_refs[hand] = True
+                    data[key] = (hand, val)
+                    hand += 1
+                    if hand > maxpos:
+                        hand = 0
+                    self.hand = hand
+                    break
+
+
+def zipf_keys(count, universe, skew=1.1, seed=42):
+    # Inverse transform sampling over precomputed cumulative weights.
+    from bisect import bisect
+    rnd = random.Random(seed)
+    total = 0.0
+    cumulative = []
+    for rank in range(1, universe + 1):
+        total += 1.0 / rank ** skew
+        cumulative.append(total)
+    return [bisect(cumulative, rnd.random() * total) for _ in range(count)]
+
+
+def dense_keys(count, size, seed=42):
+    rnd = random.Random(seed)
+    universe = size + size // 20
+    return [rnd.randrange(universe) for _ in range(count)]
+
+
+def run(cache, keys):
+    get = cache.get
+    put = cache.put
+    timer = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+    latencies = []
+    # Collector pauses would dominate the tail latencies.
+    gc.disable()
+    try:
+        for key in keys:
+            if get(key, _MARKER) is _MARKER:
+                start = timer()
+                put(key, key)
+                latencies.append(timer() - start)
+    finally:
+        gc.enable()
+    latencies.sort()
+    hit_rate = cache.hits / float(cache.lookups)
+    return hit_rate, latencies
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def main(argv):
+    size = int(argv[1]) if len(argv) > 1 else 10000
+    requests = int(argv[2]) if len(argv) > 2 else 500000
+    workloads = [
+        ('zipf', zipf_keys(requests, size * 20)),
+        ('dense', dense_keys(requests, size)),
+    ]
+    for workload, keys in workloads:
+        caches = [
+            ('legacy loop, 107', LegacyLRUCache(size)),
+            ('sweep_budget=107', LRUCache(size, sweep_budget=107)),
+            ('sweep_budget=1024', LRUCache(size)),
+            ('sweep_budget=size', LRUCache(size, sweep_budget=size)),
+        ]
+        print('%s: size=%d requests=%d' % (workload, size, requests))
+        print('%-20s %8s %9s %9s %9s %9s' % (
+            'put()', 'hit rate', 'mean us', 'p99 us', 'p99.9 us', 'max us'))
+        for name, cache in caches:
+            hit_rate, latencies = run(cache, keys)
+            mean = sum(latencies) / len(latencies)
+            print('%-20s %8.4f %9.2f %9.2f %9.2f %9.2f' % (
+                name, hit_rate, mean * 1e6,
+                percentile(latencies, 0.99) * 1e6,
+                percentile(latencies, 0.999) * 1e6, latencies[-1] * 1e6))
+        print()
+
+if __name__ == '__main__':
+    main(sys.argv)
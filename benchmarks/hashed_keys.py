@@ -0,0 +1,64 @@
+""" Cost of a decorated call with and without hashed_keys
+
+Calls a function decorated with lru_cache with argument tuples of several
+widths, each item being a small nested tuple, so that hashing the key is
+not free. Every call misses in the "miss" runs (more distinct keys than fit
+in the cache, each called once); every call hits in the "hit" runs.
+
+With repoze.lru importable (installed, or PYTHONPATH set to the checkout),
+run: python benchmarks/hashed_keys.py [cache size] [calls]
+"""
+from __future__ import print_function
+
+import gc
+import sys
+import time
+
+from repoze.lru import lru_cache
+
+
+def make_args(count, width):
+    # Lists, so that every call packs a new tuple of arguments, as real
+    # calls do.
+    return [[(i, ('item', j)) for j in range(width)] for i in range(count)]
+
+
+def run(decorator, calls, hits):
+    @decorator
+    def func(*args):
+        return len(args)
+    if hits:
+        for args in calls:
+            func(*args)
+    timer = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+    gc.disable()
+    try:
+        start = timer()
+        for args in calls:
+            func(*args)
+        elapsed = timer() - start
+    finally:
+        gc.enable()
+    return elapsed / len(calls)
+
+
+def main(argv):
+    size = int(argv[1]) if len(argv) > 1 else 1000
+    count = int(argv[2]) if len(argv) > 2 else 50000
+    print('size=%d calls=%d, us per call' % (size, count))
+    print('%6s %10s %10s %10s %10s' % (
+        'width', 'miss', 'miss+hk', 'hit', 'hit+hk'))
+    for width in (1, 4, 16, 64):
+        misses = make_args(count, width)
+        hits = misses[:size]
+        times = [
+            run(lru_cache(size), misses, False),
+            run(lru_cache(size, hashed_keys=True), misses, False),
+            run(lru_cache(size), hits, True),
+            run(lru_cache(size, hashed_keys=True), hits, True),
+        ]
+        print('%6d %10.2f %10.2f %10.2f %10.2f' % (
+            (width,) + tuple(t * 1e6 for t in times)))
+
+if __name__ == '__main__':
+    main(sys.argv)
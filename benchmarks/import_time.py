@@ -0,0 +1,70 @@
+""" Time taken by 'import repoze.lru' in a fresh interpreter
+
+Imports repoze.lru in new Python processes and reports the median and best
+times, split between the 'repoze' namespace package, which imports
+pkg_resources where setuptools is installed, and repoze.lru itself. It also
+lists the modules imported by repoze.lru itself, and flags those known to be
+slow to import, which repoze.lru should only import on first use.
+
+Times are taken with the bytecode cache warm, as for an installed package:
+a first run, not counted, writes it, even if PYTHONDONTWRITEBYTECODE is set.
+
+With repoze.lru importable (installed, or PYTHONPATH set to the checkout),
+run: python benchmarks/import_time.py [runs]
+"""
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+
+# Modules repoze.lru imports lazily, if at all.
+SLOW = ('uuid', 'platform', 'ctypes', 'random', 'concurrent.futures',
+        'zlib', 'lzma', 'bz2')
+
+CHILD = '''
+import json, sys, time
+timer = getattr(time, 'perf_counter', time.time)
+start = timer()
+import repoze
+middle = timer()
+before = set(sys.modules)
+import repoze.lru
+end = timer()
+print(json.dumps([middle - start, end - middle,
+                  sorted(set(sys.modules) - before)]))
+'''
+
+
+def run_child(env):
+    output = subprocess.check_output([sys.executable, '-c', CHILD], env=env)
+    return json.loads(output.decode('ascii'))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv):
+    runs = int(argv[1]) if len(argv) > 1 else 20
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    run_child(env)
+    results = [run_child(env) for i in range(runs)]
+    print('%d runs, ms' % runs)
+    print('%-12s %8s %8s' % ('', 'median', 'best'))
+    for i, name in enumerate(['repoze', 'repoze.lru']):
+        times = [result[i] * 1e3 for result in results]
+        print('%-12s %8.2f %8.2f' % (name, median(times), min(times)))
+    modules = results[-1][2]
+    print('modules imported by repoze.lru: %s' % ', '.join(modules))
+    slow = [name for name in modules if name in SLOW]
+    if slow:
+        print('slow to import: %s' % ', '.join(slow))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
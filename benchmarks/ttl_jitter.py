@@ -0,0 +1,87 @@
+""" Reloads per second after a warm-up burst, with and without TTL jitter
+
+Simulates a cache warmed up by a burst: all keys are put within the first
+simulated second, with the same timeout. Afterwards, every key is requested
+once per simulated second and reloaded (put again) when it has expired.
+Without jitter, the keys keep expiring together and every reload cycle hits
+the backend with all of them at once; with jitter, the reloads spread out
+over the cycles.
+
+Time is simulated by replacing the clock of repoze.lru, and the pure-Python
+cache is used, as the C get() reads the real clock.
+
+With repoze.lru importable (installed, or PYTHONPATH set to the checkout),
+run: python benchmarks/ttl_jitter.py [keys] [timeout] [seconds]
+"""
+from __future__ import print_function
+
+import random
+import sys
+
+import repoze.lru
+from repoze.lru import _MARKER
+from repoze.lru import ExpiringLRUCachePy
+
+
+class SimulatedClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+def simulate(keys, timeout, seconds, jitter, clock):
+    cache = ExpiringLRUCachePy(keys, default_timeout=timeout, jitter=jitter)
+    clock.now = 0.0
+    for key in range(keys):
+        clock.now = key / float(keys)
+        cache.put(key, key)
+    reloads = []
+    for second in range(1, seconds + 1):
+        clock.now = float(second)
+        count = 0
+        for key in range(keys):
+            if cache.get(key, _MARKER) is _MARKER:
+                cache.put(key, key)
+                count += 1
+        reloads.append(count)
+    return reloads
+
+
+def gaussian(timeout):
+    # Normal around 90% of the timeout, never above it.
+    return min(timeout, random.gauss(0.9 * timeout, 0.05 * timeout))
+
+
+def main(argv):
+    keys = int(argv[1]) if len(argv) > 1 else 5000
+    timeout = float(argv[2]) if len(argv) > 2 else 30
+    seconds = int(argv[3]) if len(argv) > 3 else 300
+    random.seed(42)
+    clock = SimulatedClock()
+    real_time = repoze.lru.time
+    repoze.lru.time = clock
+    try:
+        runs = [
+            ('none', None),
+            ('10%', 0.1),
+            ('30%', 0.3),
+            ('gauss', gaussian),
+        ]
+        print('keys=%d timeout=%gs over %ds, reloads per second'
+              % (keys, timeout, seconds))
+        print('%-8s %8s %8s %8s %12s' % (
+            'jitter', 'total', 'mean', 'peak', 'last-cycle'))
+        for name, jitter in runs:
+            reloads = simulate(keys, timeout, seconds, jitter, clock)
+            last = reloads[-int(timeout):]
+            print('%-8s %8d %8.1f %8d %12d' % (
+                name, sum(reloads), sum(reloads) / float(len(reloads)),
+                max(reloads), max(last)))
+    finally:
+        repoze.lru.time = real_time
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,21 +1,323 @@
 """ LRU caching class and decorator """
 from abc import abstractmethod
 from abc import ABCMeta
+from collections import deque
+from collections import OrderedDict
+from itertools import count
+from itertools import islice
 
+import heapq
+import os
+import sys
 import threading
 import time
-import uuid
+import weakref
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: NO COVER  (Python2)
+    from collections import Mapping
+
+# The C implementation of the hot paths is optional; set PURE_PYTHON in the
+# environment to disable it.
+if os.environ.get('PURE_PYTHON'):  # pragma: NO COVER
+    _speedups = None
+else:
+    try:
+        from repoze.lru import _speedups
+    except ImportError:  # pragma: NO COVER
+        _speedups = None
 
 _MARKER = object()
 # By default, expire items after 2**60 seconds. This fits into 64 bit
 # integers and is close enough to "never" for practical purposes.
 _DEFAULT_TIMEOUT = 2 ** 60
+# put() examines at most this many CLOCK slots before forcing an eviction.
+_DEFAULT_SWEEP_BUDGET = 1024
+# The CLOCK of a cache starts with this many slots and doubles in size
+# whenever the hand reaches its end, up to the size of the cache.
+_INITIAL_CLOCK = 8
+# Values shorter than this are not compressed by default.
+_DEFAULT_CODEC_THRESHOLD = 1024
+# Codecs that can be named by a string: modules with compress() and
+# decompress() functions.
+_CODECS = ('zlib', 'lzma', 'bz2')
+_TEXT_TYPE = type(u'')
+# Threads of the executor refreshing entries ahead of their expiration,
+# created on first use.
+_REFRESH_WORKERS = 4
+_refresh_executor = None
+# random.random, imported by the first jittered put(): importing random
+# costs more than the rest of this module.
+_random = None
+# Guards the lazy creation of optional per-cache helpers.
+_INIT_LOCK = threading.Lock()
+# All caches, so that their locks can be reset in forked children.
+_CACHES = weakref.WeakSet()
+# WriteBehindCache instances, whose worker threads are gone in forked children.
+_WRITE_BEHIND = weakref.WeakSet()
+
+
+class _TagIndex(object):
+    """ Secondary index mapping tags to the keys tagged with them """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys_by_tag = {}
+        self.tags_by_key = {}
+
+    def set(self, key, tags):
+        """Replace the tags of key"""
+        with self.lock:
+            self._discard(key)
+            if tags:
+                tags = frozenset(tags)
+                self.tags_by_key[key] = tags
+                keys_by_tag = self.keys_by_tag
+                for tag in tags:
+                    keys = keys_by_tag.get(tag)
+                    if keys is None:
+                        keys = keys_by_tag[tag] = set()
+                    keys.add(key)
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        tags = self.tags_by_key.pop(key, None)
+        if tags:
+            keys_by_tag = self.keys_by_tag
+            for tag in tags:
+                keys = keys_by_tag[tag]
+                keys.discard(key)
+                if not keys:
+                    del keys_by_tag[tag]
+
+    def pop_tag(self, tag):
+        """Forget all keys tagged with tag and return them"""
+        with self.lock:
+            keys = list(self.keys_by_tag.get(tag, ()))
+            for key in keys:
+                self._discard(key)
+        return keys
+
+    def clear(self):
+        with self.lock:
+            self.keys_by_tag.clear()
+            self.tags_by_key.clear()
+
+
+class _Flight(object):
+    """ A load of a single key in progress """
+    __slots__ = ('event', 'value', 'owner')
+
+    def __init__(self, owner):
+        self.event = threading.Event()
+        self.value = _MARKER
+        self.owner = owner  # the loading thread
+
+
+class _LoadCoordinator(object):
+    """ Tracks loads in progress, so that concurrent misses load a key once """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def claim(self, keys):
+        """Return (claimed, pending)
+
+        claimed is the list of keys the caller must load, pending maps the
+        keys loaded by other threads to their flights.
+        """
+        claimed = []
+        pending = {}
+        flights = self.flights
+        owner = threading.current_thread()
+        with self.lock:
+            for key in keys:
+                flight = flights.get(key)
+                if flight is None:
+                    flights[key] = _Flight(owner)
+                    claimed.append(key)
+                else:
+                    pending[key] = flight
+        return claimed, pending
+
+    def release(self, keys, values):
+        """Publish the values of claimed keys and wake up waiting threads"""
+        with self.lock:
+            released = [self.flights.pop(key) for key in keys]
+        for key, flight in zip(keys, released):
+            flight.value = values.get(key, _MARKER)
+            flight.event.set()
+
+
+class _Compressed(object):
+    """ A value stored compressed by a ValueCodec """
+    __slots__ = ('codec', 'payload', 'text')
+
+    def __init__(self, codec, payload, text):
+        self.codec = codec
+        self.payload = payload
+        self.text = text
+
+    def value(self):
+        val = self.codec.decompress(self.payload)
+        if self.text:
+            val = val.decode('utf-8')
+        return val
+
+    def __reduce__(self):
+        # Pickle the value itself: the codec may not be picklable, and the
+        # loaded cache has no ValueCodec.
+        val = self.value()
+        return type(val), (val,)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.payload)
+
+
+def _decoded(val):
+    if type(val) is _Compressed:
+        return val.value()
+    return val
+
+
+def _reconstruct(cls):
+    # Unpickle caches: __setstate__() initializes the instance.
+    return cls.__new__(cls)
+
+
+class ValueCodec(object):
+    """ Compresses the values put into a cache, see Cache.compress_values()
+
+    Statistics cover all values compressed so far: 'compressed' counts them,
+    'raw_bytes' and 'stored_bytes' sum their sizes before and after
+    compression, and 'ratio' is raw_bytes / stored_bytes.
+    """
+    def __init__(self, codec='zlib', threshold=_DEFAULT_CODEC_THRESHOLD):
+        if isinstance(codec, str):
+            if codec not in _CODECS:
+                raise ValueError('unknown codec %r' % codec)
+            codec = __import__(codec)
+        threshold = int(threshold)
+        if threshold < 0:
+            raise ValueError('threshold must be >=0')
+        self.codec = codec
+        self.threshold = threshold
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    @property
+    def ratio(self):
+        if not self.stored_bytes:
+            return 1.0
+        return self.raw_bytes / float(self.stored_bytes)
+
+    def encode(self, val):
+        """Return what to store for val: val itself, or it compressed"""
+        kind = type(val)
+        if kind is bytes:
+            raw = val
+        elif kind is _TEXT_TYPE:
+            raw = val.encode('utf-8')
+        else:
+            return val
+        if len(raw) < self.threshold:
+            return val
+        payload = self.codec.compress(raw)
+        if len(payload) >= len(raw):
+            # Not compressible, e.g. compressed already.
+            return val
+        self.compressed += 1
+        self.raw_bytes += len(raw)
+        self.stored_bytes += len(payload)
+        return _Compressed(self.codec, payload, kind is _TEXT_TYPE)
+
+
+if _speedups is not None:  # pragma: NO BRANCH
+    _speedups.set_compressed_type(_Compressed)
+
+
+class InternPool(object):
+    """ Shares one copy of equal values among caches, see Cache.intern_values()
+
+    Each copy counts the cache entries holding it, and leaves the pool with
+    the last of them. Values that are not hashable are not interned.
+
+    Equal values must be interchangeable: values of different types are
+    never merged, but the items of containers are not checked, so e.g.
+    (1, 2) and (1.0, 2) are. 'hits' counts the values put which were
+    replaced by a copy held already.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (type, value) -> [value, count]
+        self.copies = {}
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.copies)
+
+    def intern(self, val):
+        """Return the shared copy of val, counting one more holder"""
+        key = (type(val), val)
+        copies = self.copies
+        with self.lock:
+            try:
+                copy = copies.get(key)
+            except TypeError:
+                return val
+            if copy is None:
+                copies[key] = [val, 1]
+                return val
+            copy[1] += 1
+            self.hits += 1
+            return copy[0]
+
+    def release(self, val):
+        """Count one holder less of val, which intern() returned"""
+        key = (type(val), val)
+        copies = self.copies
+        with self.lock:
+            try:
+                copy = copies.get(key)
+            except TypeError:
+                return
+            if copy is not None and copy[0] is val:
+                copy[1] -= 1
+                if not copy[1]:
+                    del copies[key]
 
 
 class Cache(object):
     __metaclass__ = ABCMeta
 
+    # Created on the first put() with tags.
+    _tag_index = None
+    # Created on the first get_or_set() miss.
+    _load_coordinator = None
+    # Set while a repoze.lru.events.EventLog records this cache.
+    _event_log = None
+    # Bumped whenever an entry is removed or its value replaced, so that
+    # FrontCache can tell whether its copies are still valid.
+    _generation = 0
+    # If true, the cache is cleared in children created by os.fork().
+    clear_after_fork = False
+    # Set by compress_values().
+    value_codec = None
+    # Set by intern_values().
+    intern_pool = None
+    # (callback, background) pairs registered by on_evict(). The list is
+    # replaced, not changed, so that it can be read without locking.
+    _evict_callbacks = None
+    # Set by the first FrontCache over the cache, which reads _generation.
+    _fronted = False
+    # True while any of the features above hooks into put(), see
+    # _update_hooks().
+    _hooked = False
+
     @abstractmethod
     def clear(self):
         """Remove all entries from the cache"""
@@ -32,281 +334,2029 @@ class Cache(object):
     def invalidate(self, key):
         """Remove key from the cache"""
 
+    def invalidate_tag(self, tag):
+        """Remove all entries tagged with tag from the cache"""
+        index = self._tag_index
+        if index is not None:
+            for key in index.pop_tag(tag):
+                self.invalidate(key)
+
+    def peek(self, key, default=None):
+        """Return value for key without marking it as used, else default
+
+        Unlike get(), peek() does not count as a lookup either. Caches
+        which cannot list their entries fall back to get().
+        """
+        try:
+            entries = self._entries()
+        except NotImplementedError:
+            return self.get(key, default)
+        for entry_key, val in entries:
+            if entry_key == key:
+                return val
+        return default
+
+    def __contains__(self, key):
+        return self.peek(key, _MARKER) is not _MARKER
+
+    def keys(self):
+        """Return a list of the keys, most recently used first
+
+        The order is approximate for the CLOCK based caches. Expired entries
+        are left out. Caches which cannot list their entries raise
+        NotImplementedError.
+        """
+        return [key for key, val in self._entries()]
+
+    def items(self):
+        """Return a list of the (key, value) pairs, most recently used first
+
+        See keys().
+        """
+        return list(self._entries())
+
+    def compress_values(self, codec='zlib',
+                        threshold=_DEFAULT_CODEC_THRESHOLD):
+        """Store large values compressed, and return the ValueCodec doing it
+
+        codec is 'zlib', 'lzma' or 'bz2', or any object with compress() and
+        decompress() methods taking and returning bytes. Byte strings and
+        text of at least threshold bytes are compressed by put(), outside of
+        the lock, unless that does not make them smaller; text is encoded to
+        UTF-8 first. Reads decompress them again, each time.
+
+        Values already in the cache are left as they are. A pickled cache
+        holds its values uncompressed and has no codec once loaded.
+        """
+        if self.value_codec is not None:
+            raise ValueError('cache values are compressed already')
+        if self.intern_pool is not None:
+            raise ValueError('interned values cannot be compressed')
+        self.value_codec = ValueCodec(codec, threshold)
+        self._update_hooks()
+        return self.value_codec
+
+    def intern_values(self, pool=None):
+        """Store values through an InternPool, and return the pool
+
+        put() stores the copy of its value held by the pool, if any, so that
+        caches sharing the pool hold one copy of equal values. The copy is
+        released from the pool when the last entry holding it is removed.
+        If pool is None, a new one is created.
+
+        Values already in the cache are left out.
+        """
+        if self.intern_pool is not None:
+            raise ValueError('cache values are interned already')
+        if self.value_codec is not None:
+            raise ValueError('compressed values cannot be interned')
+        if pool is None:
+            pool = InternPool()
+        self.intern_pool = pool
+        self._update_hooks()
+        return pool
+
+    def on_evict(self, callback, background=False):
+        """Call callback(key, value, reason) for each entry leaving the cache
+
+        reason is 'capacity' for entries evicted to make room, 'expiry' for
+        expired entries evicted or purged, 'invalidate' for invalidate(),
+        invalidate_tag() and values replaced by put(), and 'clear'.
+
+        Callbacks are called after the cache lock is released, by the thread
+        removing the entries, and their exceptions propagate to it. If
+        background is true, they are called on a worker thread shared by all
+        caches instead, in the order the entries left; see
+        flush_evictions(). Entries dropped by clear() are always reported
+        from that thread, as it releases them. Entries removed because their
+        weakly referenced key or value died are not reported.
+
+        Return callback, so that this can be used as a decorator.
+        """
+        callbacks = list(self._evict_callbacks or ())
+        callbacks.append((callback, background))
+        self._evict_callbacks = callbacks
+        self._update_hooks()
+        return callback
+
+    def flush_evictions(self):
+        """Wait until the background on_evict() callbacks have been called
+
+        Covers the entries removed so far, from any cache, including those
+        dropped by clear(), which are released by then. Return the number of
+        background callbacks that raised an exception so far.
+        """
+        _DISPOSER.flush()
+        return _DISPOSER.failed
+
+    def view(self, snapshot=False):
+        """Return a read-only mapping view of the cache
+
+        The view reads the cache without marking entries as used. If
+        snapshot is true, the view holds a copy of the entries instead,
+        taken while put() and clear() are locked out.
+        """
+        return CacheView(self, snapshot)
+
+    def _entries(self):
+        # Yield (key, value) pairs, most recently used first.
+        raise NotImplementedError(
+            '%s cannot list its entries' % type(self).__name__)
+
+    def _snapshot(self):
+        return list(self._entries())
+
+    def _entry_value(self, entry):
+        # Return the value of an entry of the cache's dict.
+        return entry[1]
+
+    def _entry_key(self, key):
+        # Return the key of the cache's dict as seen by callers, or _MARKER
+        # if it is dead.
+        return key
+
+    def _report_evicted(self, reason, entries):
+        # Call the on_evict() callbacks for entries, a list of (key, entry)
+        # pairs removed from the cache's dict. Must not be called while
+        # holding self.lock.
+        callbacks = self._evict_callbacks
+        background = [cb for cb, in_background in callbacks if in_background]
+        if background:
+            _DISPOSER.submit((self, background, reason, entries))
+        if len(background) < len(callbacks):
+            _call_evict_callbacks(
+                (self, [cb for cb, in_background in callbacks
+                        if not in_background], reason, entries))
+
+    def _update_hooks(self):
+        # put() checks self._hooked only, and leaves the work of the
+        # optional features to _put_hooked() while one is enabled, so that
+        # they cost nothing otherwise. Called whenever one is enabled or
+        # disabled.
+        self._hooked = (self.value_codec is not None or
+                        self.intern_pool is not None or
+                        self._tag_index is not None or
+                        self._event_log is not None or
+                        self._evict_callbacks is not None or
+                        self._fronted)
+
+    def _touch(self, keys):
+        # Account for hits on keys served by a FrontCache.
+        self.lookups += len(keys)
+        self.hits += len(keys)
+
+    def _expires(self, key):
+        # Return the expiration time of the entry for key, None for never.
+        return None
+
+    def _retire(self, data):
+        # Called by clear(), after releasing self.lock, with the dict of
+        # entries it dropped. Releasing all entries at once would stall the
+        # caller for as long as deallocating them takes: the worker thread
+        # releases them instead, one at a time, see _release_cleared().
+        if data:
+            _DISPOSER.submit((self, None, 'clear', data))
+
+    def get_or_set(self, key, loader, timeout=None):
+        """Return value for key. If not in cache, put loader(key) and return it
+
+        Concurrent misses for the same key call loader only once; the other
+        threads wait for its result. A loader needing the value of the key it
+        loads raises RuntimeError instead of waiting for itself. timeout is
+        passed on to put() unless it is None; it needs an ExpiringLRUCache.
+        """
+        if timeout is not None and not isinstance(self, ExpiringLRUCachePy):
+            raise ValueError('timeout needs an ExpiringLRUCache')
+        val = self.get(key, _MARKER)
+        if val is not _MARKER:
+            return val
+        return self._load([key], lambda keys: {key: loader(key)}, timeout)[key]
+
+    def get_or_set_many(self, keys, bulk_loader, timeout=None):
+        """Return a dict mapping keys to their values
+
+        bulk_loader is called once with the list of keys not in cache and
+        must return a dict of their values, which are put into the cache.
+        Keys missing from that dict are missing from the result as well.
+        See get_or_set() for timeout.
+        """
+        if timeout is not None and not isinstance(self, ExpiringLRUCachePy):
+            raise ValueError('timeout needs an ExpiringLRUCache')
+        result = {}
+        missing = []
+        seen = set()
+        for key in keys:
+            if key in seen:
+                continue
+            seen.add(key)
+            val = self.get(key, _MARKER)
+            if val is _MARKER:
+                missing.append(key)
+            else:
+                result[key] = val
+        if missing:
+            result.update(self._load(missing, bulk_loader, timeout))
+        return result
+
+    def _load(self, keys, bulk_loader, timeout):
+        coordinator = self._load_coordinator
+        if coordinator is None:
+            with _INIT_LOCK:
+                coordinator = self._load_coordinator
+                if coordinator is None:  # pragma: NO BRANCH (lost a race)
+                    coordinator = self._load_coordinator = _LoadCoordinator()
+        claimed, pending = coordinator.claim(keys)
+        loaded = {}
+        try:
+            current = threading.current_thread()
+            for key, flight in pending.items():
+                if flight.owner is current:
+                    # Waiting would deadlock.
+                    raise RuntimeError('recursive load of key %r' % (key,))
+            if claimed:
+                loaded = bulk_loader(claimed)
+                self._put_many(claimed, loaded, timeout)
+        finally:
+            coordinator.release(claimed, loaded)
+        result = dict((key, loaded[key]) for key in claimed if key in loaded)
+        retry = []
+        for key, flight in pending.items():
+            flight.event.wait()
+            if flight.value is _MARKER:
+                # The other thread failed to load key, try on our own.
+                retry.append(key)
+            else:
+                result[key] = flight.value
+        if retry:
+            loaded = bulk_loader(retry)
+            self._put_many(retry, loaded, timeout)
+            for key in retry:
+                if key in loaded:
+                    result[key] = loaded[key]
+        return result
+
+    def _put_many(self, keys, values, timeout):
+        for key in keys:
+            if key in values:
+                if timeout is None:
+                    self.put(key, values[key])
+                else:
+                    self.put(key, values[key], timeout=timeout)
+
+    def _reinit_after_fork(self):
+        # Locks may have been held by threads which do not exist in the
+        # child, so replace them all.
+        if getattr(self, 'lock', None) is not None:
+            self.lock = threading.Lock()
+        if self._tag_index is not None:
+            self._tag_index.lock = threading.Lock()
+        if self.intern_pool is not None:
+            self.intern_pool.lock = threading.Lock()
+        self._load_coordinator = None
+        if self.clear_after_fork:
+            self.clear()
+
+    def _get_tags_state(self):
+        index = self._tag_index
+        if index is None:
+            return {}
+        with index.lock:
+            return dict((key, tuple(tags))
+                        for key, tags in index.tags_by_key.items())
+
+    def _set_tags_state(self, tags):
+        for key, key_tags in tags.items():
+            self._set_tags(key, key_tags)
 
-class UnboundedCache(Cache):
+    def _set_tags(self, key, tags):
+        index = self._tag_index
+        if index is None:
+            with _INIT_LOCK:
+                index = self._tag_index
+                if index is None:  # pragma: NO BRANCH (lost a race)
+                    index = self._tag_index = _TagIndex()
+                    self._update_hooks()
+        index.set(key, tags)
+
+
+class UnboundedCachePy(Cache):
     """
     a simple unbounded cache backed by a dictionary
+
+    If maxsize is given, it is a soft cap: once the cache grows beyond it,
+    entries are evicted in a batch until the cache is 10% below maxsize
+    again. The oldest entries go first on Python 3.7+, where dicts keep
+    insertion order; on older versions, the entries evicted and the order of
+    keys() and items() are arbitrary.
+
+    This is the pure-Python implementation; UnboundedCache uses the C
+    implementation of get() where available.
     """
 
-    def __init__(self):
+    def __init__(self, maxsize=None):
+        if maxsize is not None:
+            maxsize = int(maxsize)
+            if maxsize < 1:
+                raise ValueError('maxsize must be >0')
+        self.maxsize = maxsize
         self._data = dict()
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+        self._update_hooks()
+        _CACHES.add(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def peek(self, key, default=None):
+        """Return value for key without marking it as used, else default"""
+        return _decoded(self._data.get(key, default))
+
+    def _entry_value(self, entry):
+        return entry
+
+    def _entries(self):
+        # Insertion order is all there is; newest first.
+        for key, val in reversed(list(self._data.items())):
+            yield key, _decoded(val)
+
+    def __reduce__(self):
+        # Spelled out so that protocols 0 and 1 work too: copyreg cannot
+        # reconstruct the C base classes.
+        return _reconstruct, (type(self),), self.__getstate__()
+
+    def __getstate__(self):
+        return {
+            'maxsize': self.maxsize,
+            'data': dict(self._data),
+            'tags': self._get_tags_state(),
+            'evictions': self.evictions,
+            'hits': self.hits,
+            'misses': self.misses,
+            'lookups': self.lookups,
+        }
+
+    def __setstate__(self, state):
+        UnboundedCachePy.__init__(self, state['maxsize'])
+        self._data.update(state['data'])
+        self._set_tags_state(state['tags'])
+        self.evictions = state['evictions']
+        self.hits = state['hits']
+        self.misses = state['misses']
+        self.lookups = state['lookups']
 
     def get(self, key, default=None):
-        return self._data.get(key, default)
+        self.lookups += 1
+        try:
+            val = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        if type(val) is _Compressed:
+            return val.value()
+        return val
 
     def clear(self):
-        self._data.clear()
+        data = self._data
+        self._data = {}
+        self._generation += 1
+        self._retire(data)
+        if self._tag_index is not None:
+            self._tag_index.clear()
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
 
     def invalidate(self, key):
+        val = self._data.pop(key, _MARKER)
+        if val is not _MARKER:
+            self._generation += 1
+            if self.intern_pool is not None:
+                self.intern_pool.release(val)
+        if self._tag_index is not None:
+            self._tag_index.discard(key)
+        if val is not _MARKER and self._evict_callbacks is not None:
+            self._report_evicted('invalidate', [(key, val)])
+
+    def put(self, key, val, tags=None):
+        if tags or self._hooked:
+            self._put_hooked(key, val, tags)
+        else:
+            self._data[key] = val
+
+    def _put_hooked(self, key, val, tags):
+        # put() with the optional features, see Cache._update_hooks().
+        if self.value_codec is not None:
+            val = self.value_codec.encode(val)
+        pool = self.intern_pool
+        if pool is not None:
+            val = pool.intern(val)
+        data = self._data
+        old = data.get(key, _MARKER)
+        data[key] = val
+        if old is not _MARKER:
+            self._generation += 1
+            if pool is not None:
+                pool.release(old)
+        if tags or self._tag_index is not None:
+            self._set_tags(key, tags)
+        maxsize = self.maxsize
+        if maxsize is not None and len(data) > maxsize:
+            self._trim(maxsize - maxsize // 10)
+        if (old is not _MARKER and old is not val and
+                self._evict_callbacks is not None):
+            self._report_evicted('invalidate', [(key, old)])
+
+    def _update_hooks(self):
+        Cache._update_hooks(self)
+        if self.maxsize is not None:
+            self._hooked = True
+
+    def _trim(self, size):
+        data = self._data
+        evicted = []
+        # Another thread may trim concurrently, so pop() instead of del.
+        for oldkey in list(islice(data, max(len(data) - size, 0))):
+            old = data.pop(oldkey, _MARKER)
+            if old is not _MARKER:  # pragma: NO BRANCH (lost a race)
+                evicted.append((oldkey, old))
+                self.evictions += 1
+                self._generation += 1
+                if self.intern_pool is not None:
+                    self.intern_pool.release(old)
+                if self._tag_index is not None:
+                    self._tag_index.discard(oldkey)
+                if self._event_log is not None:
+                    self._event_log.record('evict', oldkey)
+        if evicted and self._evict_callbacks is not None:
+            self._report_evicted('capacity', evicted)
+
+    def footprint(self):
+        """Return the approximate memory used by the cache, in bytes
+
+        Counts the dictionary and the keys and values themselves, but not
+        objects referenced by them. This walks all entries.
+        """
+        getsizeof = sys.getsizeof
+        total = getsizeof(self._data)
+        for key, val in list(self._data.items()):
+            total += getsizeof(key) + getsizeof(val)
+        return total
+
+    def _keys(self):
+        return list(self._data)
+
+
+if _speedups is not None:
+    class UnboundedCache(_speedups.UnboundedCacheBase, UnboundedCachePy):
+        __doc__ = UnboundedCachePy.__doc__
+else:  # pragma: NO COVER
+    class UnboundedCache(UnboundedCachePy):
+        __doc__ = UnboundedCachePy.__doc__
+
+
+def _clear_refs(clock_refs, start, count):
+    # Clear count reference bits starting at start, wrapping around.
+    size = len(clock_refs)
+    end = start + count
+    if end <= size:
+        clock_refs[start:end] = [False] * count
+    else:
+        clock_refs[start:] = [False] * (size - start)
+        clock_refs[:end - size] = [False] * (end - size)
+
+
+def _clock_victim(clock_refs, hand, budget):
+    # Return the CLOCK slot to evict next, starting the search at hand.
+    #
+    # This is the classic sweep: referenced slots get a second chance, i.e.
+    # their reference bit is cleared, until an unreferenced slot is found.
+    # list.index() does the search and slice assignment the clearing, so the
+    # cost per slot is paid in C. After budget referenced slots the next slot
+    # is evicted regardless, which bounds the work per call.
+    try:
+        # list.index() clamps the end of the range to the list.
+        victim = clock_refs.index(False, hand, hand + budget)
+    except ValueError:
+        return _clock_victim_wrapping(clock_refs, hand, budget)
+    if victim - hand < 8:
+        # Short runs are the common case, where slicing does not pay off.
+        for pos in range(hand, victim):
+            clock_refs[pos] = False
+    else:
+        clock_refs[hand:victim] = [False] * (victim - hand)
+    return victim
+
+
+def _clock_victim_wrapping(clock_refs, hand, budget):
+    # _clock_victim() when the search goes past the end of the clock or
+    # exhausts the budget.
+    size = len(clock_refs)
+    budget = min(budget, size)
+    stop = hand + budget
+    victim = None
+    if stop > size:
         try:
-            del self._data[key]
-        except KeyError:
+            victim = clock_refs.index(False, 0, stop - size)
+        except ValueError:
             pass
+    if victim is None:
+        _clear_refs(clock_refs, hand, budget)
+        return stop % size
+    _clear_refs(clock_refs, hand, size - hand + victim)
+    return victim
 
-    def put(self, key, val):
-        self._data[key] = val
+
+def _grow_clock(cache):
+    # Called when the hand of a CLOCK cache passes its last slot. Return the
+    # slot to move the hand to: the first of the slots added, unless the
+    # clock has all its slots already and the hand wraps around.
+    clock_keys = cache.clock_keys
+    length = len(clock_keys)
+    grow = min(length, cache.size - length)
+    if grow <= 0:
+        return 0
+    # In place, as get() may be reading the lists concurrently.
+    clock_keys.extend([_MARKER] * grow)
+    cache.clock_refs.extend([False] * grow)
+    cache.maxpos = length + grow - 1
+    return length
+
+
+def _clock_order(cache):
+    # Yield the (key, entry) pairs of a CLOCK cache, approximately most
+    # recently used first: the entries whose reference bit is set, then the
+    # others, each newest first, i.e. from the slot behind the hand
+    # backwards. Stale slots are skipped.
+    data = cache.data
+    clock_keys = cache.clock_keys
+    clock_refs = cache.clock_refs
+    size = len(clock_keys)
+    hand = cache.hand
+    unreferenced = []
+    for i in range(1, size + 1):
+        pos = (hand - i) % size
+        key = clock_keys[pos]
+        entry = data.get(key)
+        if entry is None or entry[0] != pos:
+            continue
+        if clock_refs[pos]:
+            yield key, entry
+        else:
+            unreferenced.append((key, entry))
+    for item in unreferenced:
+        yield item
 
 
-class LRUCache(Cache):
+class LRUCachePy(Cache):
     """ Implements a pseudo-LRU algorithm (CLOCK)
 
     The Clock algorithm is not kept strictly to improve performance, e.g. to
     allow get() and invalidate() to work without acquiring the lock.
+
+    put() examines at most 'sweep_budget' referenced slots to find an entry
+    to evict before it evicts the next one regardless. This bounds the time
+    put() holds the lock when nearly all entries are in use.
+
+    This is the pure-Python implementation; LRUCache uses the C
+    implementation of get() where available.
     """
-    def __init__(self, size):
+    def __init__(self, size, sweep_budget=_DEFAULT_SWEEP_BUDGET):
         size = int(size)
         if size < 1:
             raise ValueError('size must be >0')
+        sweep_budget = int(sweep_budget)
+        if sweep_budget < 1:
+            raise ValueError('sweep_budget must be >0')
         self.size = size
+        self.sweep_budget = sweep_budget
         self.lock = threading.Lock()
         self.hand = 0
-        self.maxpos = size - 1
-        self.clock_keys = None
-        self.clock_refs = None
-        self.data = None
+        # The clock grows on demand, see _grow_clock().
+        capacity = min(size, _INITIAL_CLOCK)
+        self.maxpos = capacity - 1
+        self.clock_keys = [_MARKER] * capacity
+        self.clock_refs = [False] * capacity
+        self.data = {}
         self.evictions = 0
         self.hits = 0
         self.misses = 0
         self.lookups = 0
-        self.clear()
+        self._update_hooks()
+        _CACHES.add(self)
+
+    def __reduce__(self):
+        # Spelled out so that protocols 0 and 1 work too: copyreg cannot
+        # reconstruct the C base classes.
+        return _reconstruct, (type(self),), self.__getstate__()
+
+    def __getstate__(self):
+        # Only the entries are stored, in clock order starting at the hand.
+        with self.lock:
+            entries = []
+            data = self.data
+            clock_keys = self.clock_keys
+            clock_refs = self.clock_refs
+            size = len(clock_keys)
+            for i in range(size):
+                pos = (self.hand + i) % size
+                entry = data.get(clock_keys[pos])
+                if entry is not None and entry[0] == pos:
+                    entries.append(
+                        (clock_keys[pos], entry[1], clock_refs[pos]))
+            return {
+                'size': self.size,
+                'sweep_budget': self.sweep_budget,
+                'entries': entries,
+                'tags': self._get_tags_state(),
+                'evictions': self.evictions,
+                'hits': self.hits,
+                'misses': self.misses,
+                'lookups': self.lookups,
+            }
+
+    def __setstate__(self, state):
+        LRUCachePy.__init__(self, state['size'], state['sweep_budget'])
+        data = self.data
+        for pos, (key, val, ref) in enumerate(state['entries']):
+            if pos > self.maxpos:
+                _grow_clock(self)
+            self.clock_keys[pos] = key
+            self.clock_refs[pos] = ref
+            data[key] = (pos, val)
+        self.hand = len(state['entries'])
+        if self.hand > self.maxpos:
+            self.hand = _grow_clock(self)
+        self._set_tags_state(state['tags'])
+        self.evictions = state['evictions']
+        self.hits = state['hits']
+        self.misses = state['misses']
+        self.lookups = state['lookups']
 
     def clear(self):
         """Remove all entries from the cache"""
         with self.lock:
-            # If really clear()ing a full cache, clean up self.data first to
-            # give garbage collection a chance to reduce memorey usage.
-            # Instantiating "[_MARKER] * size" will temporarily have 2 lists
-            # in memory -> high peak memory usage for tiny amount of time.
-            # With self.data already clear, that peak should not exceed what
-            # we normally use.
+            # The clock lists keep their size: put() reuses the slots of the
+            # dropped entries as the hand comes by. Their keys are dropped
+            # here, their values by another thread, see _retire().
+            data = self.data
             self.data = {}
-            size = self.size
-            self.clock_keys = [_MARKER] * size
-            self.clock_refs = [False] * size
-            self.hand = 0
+            clock_keys = self.clock_keys
+            clock_keys[:] = [_MARKER] * len(clock_keys)
+            self._generation += 1
+            if self._tag_index is not None:
+                self._tag_index.clear()
             self.evictions = 0
             self.hits = 0
             self.misses = 0
             self.lookups = 0
+        self._retire(data)
+
+    def get(self, key, default=None):
+        """Return value for key. If not in cache, return default"""
+        self.lookups += 1
+        try:
+            pos, val = self.data[key]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            return default
+        self.clock_refs[pos] = True
+        if type(val) is _Compressed:
+            return val.value()
+        return val
+
+    def put(self, key, val, tags=None):
+        """Add key to the cache with value val
+
+        tags is an optional iterable of tags for use with invalidate_tag().
+        They replace any tags key had before.
+        """
+        if tags or self._hooked:
+            return self._put_hooked(key, val, tags)
+        # These do not change or they are just references, no need for locking.
+        clock_refs = self.clock_refs
+        clock_keys = self.clock_keys
+        data = self.data
+
+        with self.lock:
+            entry = data.get(key)
+            if entry is not None:
+                # We already have key. Only make sure data is up to date
+                # and to remember that it was used.
+                pos = entry[0]
+                if entry[1] is not val:
+                    data[key] = (pos, val)
+                clock_refs[pos] = True
+                return
+            # else: key is not yet in cache. Search place to insert it.
+
+            hand = self.hand
+            if clock_refs[hand]:
+                hand = _clock_victim(clock_refs, hand, self.sweep_budget)
+            oldkey = clock_keys[hand]
+            # See _put_hooked().
+            oldentry = data.get(oldkey)
+            if (oldentry is not None and oldentry[0] == hand and
+                    data.pop(oldkey, _MARKER) is not _MARKER):
+                self.evictions += 1
+            clock_keys[hand] = key
+            clock_refs[hand] = True
+            data[key] = (hand, val)
+            hand += 1
+            if hand > self.maxpos:
+                hand = _grow_clock(self)
+            self.hand = hand
+
+    def _put_hooked(self, key, val, tags):
+        # put() with the optional features, see Cache._update_hooks().
+        if self.value_codec is not None:
+            val = self.value_codec.encode(val)
+        pool = self.intern_pool
+        if pool is not None:
+            val = pool.intern(val)
+        clock_refs = self.clock_refs
+        clock_keys = self.clock_keys
+        data = self.data
+
+        # on_evict() callbacks are called once the lock is released.
+        removed = None
+        try:
+            with self.lock:
+                entry = data.get(key)
+                if entry is not None:
+                    # We already have key. Only make sure data is up to date
+                    # and to remember that it was used.
+                    pos, old_val = entry
+                    if old_val is not val:
+                        data[key] = (pos, val)
+                        self._generation += 1
+                        # WeakValueLRUCache puts a new reference to the
+                        # same value.
+                        if (self._evict_callbacks is not None and
+                                self._entry_value(entry) is not
+                                self._entry_value(data[key])):
+                            removed = ('invalidate', [(key, entry)])
+                    if pool is not None:
+                        pool.release(old_val)
+                    self.clock_refs[pos] = True
+                    if tags or self._tag_index is not None:
+                        self._set_tags(key, tags)
+                    return
+                # else: key is not yet in cache. Search place to insert it.
+
+                hand = self.hand
+                if clock_refs[hand]:
+                    hand = _clock_victim(clock_refs, hand, self.sweep_budget)
+                oldkey = clock_keys[hand]
+                # The slot is stale if oldkey is not in self.data, e.g. after
+                # clear(), or if it was put again into another slot after
+                # invalidate(). Else self.invalidate() in another thread might
+                # remove it concurrently. del() would raise KeyError, so pop().
+                oldentry = data.get(oldkey)
+                if oldentry is not None and oldentry[0] == hand:
+                    oldentry = data.pop(oldkey, _MARKER)
+                else:
+                    oldentry = _MARKER
+                if oldentry is not _MARKER:
+                    self.evictions += 1
+                    self._generation += 1
+                    if pool is not None:
+                        pool.release(oldentry[1])
+                    if self._tag_index is not None:
+                        self._tag_index.discard(oldkey)
+                    if self._event_log is not None:
+                        self._event_log.record('evict', oldkey)
+                    if self._evict_callbacks is not None:
+                        removed = ('capacity', [(oldkey, oldentry)])
+                clock_keys[hand] = key
+                clock_refs[hand] = True
+                data[key] = (hand, val)
+                hand += 1
+                if hand > self.maxpos:
+                    hand = _grow_clock(self)
+                self.hand = hand
+                if tags or self._tag_index is not None:
+                    self._set_tags(key, tags)
+        finally:
+            if removed is not None:
+                self._report_evicted(*removed)
+
+    def invalidate(self, key):
+        """Remove key from the cache"""
+        # pop with default arg will not raise KeyError
+        entry = self.data.pop(key, _MARKER)
+        if entry is not _MARKER:
+            self._generation += 1
+            if self.intern_pool is not None:
+                self.intern_pool.release(entry[1])
+            # We have no lock, but worst thing that can happen is that we
+            # set another key's entry to False.
+            self.clock_refs[entry[0]] = False
+            if self._tag_index is not None:
+                self._tag_index.discard(key)
+            if self._evict_callbacks is not None:
+                self._report_evicted('invalidate', [(key, entry)])
+        # else: key was not in cache. Nothing to do.
+
+    def _keys(self):
+        return list(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def peek(self, key, default=None):
+        """Return value for key without marking it as used, else default"""
+        entry = self.data.get(key)
+        if entry is None:
+            return default
+        return _decoded(entry[1])
+
+    def _entries(self):
+        for key, entry in _clock_order(self):
+            yield key, _decoded(entry[1])
+
+    def _snapshot(self):
+        with self.lock:
+            return list(self._entries())
+
+    def _touch(self, keys):
+        data = self.data
+        clock_refs = self.clock_refs
+        for key in keys:
+            entry = data.get(key)
+            if entry is not None:
+                clock_refs[entry[0]] = True
+        Cache._touch(self, keys)
+
+
+if _speedups is not None:
+    class LRUCache(_speedups.LRUCacheBase, LRUCachePy):
+        __doc__ = LRUCachePy.__doc__
+else:  # pragma: NO COVER
+    class LRUCache(LRUCachePy):
+        __doc__ = LRUCachePy.__doc__
+
+
+class _WeakLRUCache(LRUCache):
+    """ Base class for the LRUCache variants holding weak references """
+    def __init__(self, size, sweep_budget=_DEFAULT_SWEEP_BUDGET):
+        LRUCache.__init__(self, size, sweep_budget)
+        # Keys removed by weak reference callbacks whose tags are still to be
+        # dropped from the tag index.
+        self._dead_keys = []
+        selfref = weakref.ref(self)
+
+        def remove(wr, selfref=selfref):
+            self = selfref()
+            if self is not None:
+                self._remove_dead(wr)
+        self._remove = remove
+
+    def __getstate__(self):
+        raise TypeError('cannot pickle %s objects' % type(self).__name__)
+
+    def intern_values(self, pool=None):
+        """Not supported: entries leave when the garbage collector says so"""
+        raise TypeError(
+            'cannot intern the values of %s objects' % type(self).__name__)
+
+    def _forget(self, key, entry):
+        # Called by the garbage collector, possibly while this thread holds
+        # self.lock or the tag index lock: must not acquire locks.
+        self.data.pop(key, None)
+        self.clock_refs[entry[0]] = False
+        if self._tag_index is not None:
+            self._dead_keys.append(key)
+
+    def _drop_dead_tags(self):
+        dead_keys = self._dead_keys
+        while dead_keys:
+            key = dead_keys.pop()
+            if key not in self.data:
+                self._tag_index.discard(key)
+
+
+class WeakValueLRUCache(_WeakLRUCache):
+    """ LRUCache holding weak references to its values
+
+    Entries whose value is garbage collected are removed and their slot is
+    freed for reuse. Values must support weak references.
+    """
+    def _remove_dead(self, wr):
+        entry = self.data.get(wr.key)
+        if entry is not None and entry[1] is wr:
+            self._forget(wr.key, entry)
+
+    def _entry_value(self, entry):
+        val = entry[1]()
+        if val is None:
+            return _MARKER
+        return val
+
+    def get(self, key, default=None):
+        """Return value for key. If not in cache, return default"""
+        self.lookups += 1
+        try:
+            pos, wr = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        val = wr()
+        if val is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.clock_refs[pos] = True
+        return val
+
+    def put(self, key, val, tags=None):
+        """Add key to the cache with value val
+
+        See LRUCache.put().
+        """
+        if self._dead_keys:
+            self._drop_dead_tags()
+        LRUCache.put(self, key, weakref.KeyedRef(val, self._remove, key), tags)
+
+    def peek(self, key, default=None):
+        """Return value for key without marking it as used, else default"""
+        entry = self.data.get(key)
+        if entry is None:
+            return default
+        val = entry[1]()
+        if val is None:
+            return default
+        return val
+
+    def _entries(self):
+        for key, entry in _clock_order(self):
+            val = entry[1]()
+            if val is not None:
+                yield key, val
+
+
+class WeakKeyLRUCache(_WeakLRUCache):
+    """ LRUCache holding weak references to its keys
+
+    Entries whose key is garbage collected are removed and their slot is
+    freed for reuse. Keys must support weak references and be hashable.
+    """
+    def _remove_dead(self, wr):
+        # Dead weak references only compare equal to themselves, so wr
+        # still finds its entry.
+        entry = self.data.get(wr)
+        if entry is not None:
+            self._forget(wr, entry)
+        elif self._tag_index is not None:
+            # wr may have been used to re-tag an entry with another
+            # reference to the same key.
+            self._dead_keys.append(wr)
+
+    def _entry_key(self, key):
+        key = key()
+        if key is None:
+            return _MARKER
+        return key
+
+    def get(self, key, default=None):
+        """Return value for key. If not in cache, return default"""
+        return LRUCache.get(self, weakref.ref(key), default)
+
+    def put(self, key, val, tags=None):
+        """Add key to the cache with value val
+
+        See LRUCache.put().
+        """
+        if self._dead_keys:
+            self._drop_dead_tags()
+        LRUCache.put(self, weakref.ref(key, self._remove), val, tags)
+
+    def invalidate(self, key):
+        """Remove key from the cache"""
+        LRUCache.invalidate(self, weakref.ref(key))
+
+    def _touch(self, keys):
+        LRUCache._touch(self, [weakref.ref(key) for key in keys])
+
+    def peek(self, key, default=None):
+        """Return value for key without marking it as used, else default"""
+        return LRUCache.peek(self, weakref.ref(key), default)
+
+    def _entries(self):
+        for wr, entry in _clock_order(self):
+            key = wr()
+            if key is not None:
+                yield key, _decoded(entry[1])
+
+    def invalidate_tag(self, tag):
+        """Remove all entries tagged with tag from the cache"""
+        index = self._tag_index
+        if index is not None:
+            for wr in index.pop_tag(tag):
+                LRUCache.invalidate(self, wr)
+
+    def _keys(self):
+        keys = [wr() for wr in list(self.data)]
+        return [key for key in keys if key is not None]
+
+
+class _ExpiryIndex(object):
+    """ Bucketed index of expiration times (a simple timing wheel)
+
+    Keys are grouped into buckets of 'granularity' seconds; a heap holds the
+    bucket numbers so the earliest buckets can be found without scanning the
+    whole cache. Each bucket number is on the heap once, for as long as the
+    bucket exists. Emptied buckets are kept until their number reaches the
+    top of the heap, where they are pruned, so that moving a key back into a
+    bucket does not push its number again.
+
+    Not thread-safe: callers must hold the owning cache's lock.
+    """
+    def __init__(self, granularity):
+        granularity = float(granularity)
+        if granularity <= 0:
+            raise ValueError('granularity must be >0')
+        self.granularity = granularity
+        self.buckets = {}  # bucket number -> {key: expires}
+        self.heap = []
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def add(self, key, expires):
+        number = int(expires // self.granularity)
+        bucket = self.buckets.get(number)
+        if bucket is None:
+            self._prune()
+            bucket = self.buckets[number] = {}
+            heapq.heappush(self.heap, number)
+        bucket[key] = expires
+
+    def discard(self, key, expires):
+        bucket = self.buckets.get(int(expires // self.granularity))
+        if bucket is not None:
+            bucket.pop(key, None)
+
+    def _prune(self):
+        # Drop the emptied buckets at the top of the heap.
+        heap = self.heap
+        buckets = self.buckets
+        while heap and not buckets[heap[0]]:
+            del buckets[heapq.heappop(heap)]
+
+    def _due_buckets(self, now):
+        # Yield (number, bucket) for all buckets which may contain entries
+        # expiring at or before 'now', earliest first.
+        heap = self.heap
+        buckets = self.buckets
+        last = int(now // self.granularity)
+        popped = []
+        try:
+            while heap and heap[0] <= last:
+                number = heapq.heappop(heap)
+                bucket = buckets[number]
+                if not bucket:
+                    del buckets[number]
+                    continue
+                popped.append(number)
+                yield number, bucket
+        finally:
+            for number in popped:
+                heapq.heappush(heap, number)
+
+    def expired(self, now):
+        """Return a list of keys which expired at or before 'now'"""
+        result = []
+        for number, bucket in self._due_buckets(now):
+            for key, expires in bucket.items():
+                if expires <= now:
+                    result.append(key)
+        return result
+
+    def next_expiry(self):
+        """Return the earliest expiration time in the index, or None"""
+        self._prune()
+        if self.heap:
+            return min(self.buckets[self.heap[0]].values())
+        return None
+
+    def clear(self):
+        self.buckets.clear()
+        del self.heap[:]
+
+
+def _check_jitter(jitter):
+    if jitter is not None and not callable(jitter):
+        jitter = float(jitter)
+        if not 0 <= jitter < 1:
+            raise ValueError('jitter must be >=0 and <1, or a callable')
+    return jitter
+
+
+def _jittered(timeout, jitter):
+    # Shorten timeout by up to the fraction jitter, uniformly at random.
+    global _random
+    if callable(jitter):
+        return jitter(timeout)
+    if _random is None:
+        from random import random as _random
+    return timeout * (1.0 - jitter * _random())
+
+
+class ExpiringLRUCachePy(Cache):
+    """ Implements a pseudo-LRU algorithm (CLOCK) with expiration times
+
+    The Clock algorithm is not kept strictly to improve performance, e.g. to
+    allow get() and invalidate() to work without acquiring the lock.
+
+    If 'expiry_granularity' (in seconds) is given, an index of expiration
+    times is maintained on put() and invalidate(). It makes purge_expired(),
+    next_expiry() and expired_count() cost O(expired entries) instead of
+    O(size), at the price of some extra memory per entry.
+
+    'sweep_budget' bounds the work of put(), see LRUCache.
+
+    If 'jitter' is given, put() shortens timeouts at random, so that entries
+    put together do not all expire together. It is either a fraction: each
+    timeout is cut by up to that fraction of itself, uniformly; or a
+    callable, which is passed the timeout and returns the one to use.
+
+    This is the pure-Python implementation; ExpiringLRUCache uses the C
+    implementation of get() where available.
+    """
+    def __init__(self, size, default_timeout=_DEFAULT_TIMEOUT,
+                 expiry_granularity=None,
+                 sweep_budget=_DEFAULT_SWEEP_BUDGET,
+                 jitter=None):
+        self.default_timeout = default_timeout
+        self.jitter = _check_jitter(jitter)
+        size = int(size)
+        if size < 1:
+            raise ValueError('size must be >0')
+        sweep_budget = int(sweep_budget)
+        if sweep_budget < 1:
+            raise ValueError('sweep_budget must be >0')
+        self.size = size
+        self.sweep_budget = sweep_budget
+        self.lock = threading.Lock()
+        self.hand = 0
+        # The clock grows on demand, see _grow_clock().
+        capacity = min(size, _INITIAL_CLOCK)
+        self.maxpos = capacity - 1
+        self.clock_keys = [_MARKER] * capacity
+        self.clock_refs = [False] * capacity
+        # self.data contains (pos, val, expires) triplets
+        self.data = {}
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+        self._expiry_index = None
+        if expiry_granularity is not None:
+            self._expiry_index = _ExpiryIndex(expiry_granularity)
+        self._update_hooks()
+        _CACHES.add(self)
+
+    def __reduce__(self):
+        # Spelled out so that protocols 0 and 1 work too: copyreg cannot
+        # reconstruct the C base classes.
+        return _reconstruct, (type(self),), self.__getstate__()
+
+    def __getstate__(self):
+        # Only the entries are stored, in clock order starting at the hand.
+        # Expiration times are absolute (time.time() based).
+        with self.lock:
+            entries = []
+            data = self.data
+            clock_keys = self.clock_keys
+            clock_refs = self.clock_refs
+            size = len(clock_keys)
+            for i in range(size):
+                pos = (self.hand + i) % size
+                entry = data.get(clock_keys[pos])
+                if entry is not None and entry[0] == pos:
+                    entries.append(
+                        (clock_keys[pos], entry[1], clock_refs[pos], entry[2]))
+            index = self._expiry_index
+            return {
+                'size': self.size,
+                'sweep_budget': self.sweep_budget,
+                'default_timeout': self.default_timeout,
+                'jitter': self.jitter,
+                'expiry_granularity':
+                    index.granularity if index is not None else None,
+                'entries': entries,
+                'tags': self._get_tags_state(),
+                'evictions': self.evictions,
+                'hits': self.hits,
+                'misses': self.misses,
+                'lookups': self.lookups,
+            }
+
+    def __setstate__(self, state):
+        ExpiringLRUCachePy.__init__(
+            self, state['size'], state['default_timeout'],
+            state['expiry_granularity'], state['sweep_budget'],
+            state['jitter'])
+        data = self.data
+        index = self._expiry_index
+        for pos, (key, val, ref, expires) in enumerate(state['entries']):
+            if pos > self.maxpos:
+                _grow_clock(self)
+            self.clock_keys[pos] = key
+            self.clock_refs[pos] = ref
+            data[key] = (pos, val, expires)
+            if index is not None:
+                index.add(key, expires)
+        self.hand = len(state['entries'])
+        if self.hand > self.maxpos:
+            self.hand = _grow_clock(self)
+        self._set_tags_state(state['tags'])
+        self.evictions = state['evictions']
+        self.hits = state['hits']
+        self.misses = state['misses']
+        self.lookups = state['lookups']
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        with self.lock:
+            # See LRUCache.clear().
+            data = self.data
+            self.data = {}
+            clock_keys = self.clock_keys
+            clock_keys[:] = [_MARKER] * len(clock_keys)
+            self._generation += 1
+            if self._expiry_index is not None:
+                self._expiry_index.clear()
+            if self._tag_index is not None:
+                self._tag_index.clear()
+            self.evictions = 0
+            self.hits = 0
+            self.misses = 0
+            self.lookups = 0
+        self._retire(data)
+
+    def get(self, key, default=None):
+        """Return value for key. If not in cache or expired, return default"""
+        self.lookups += 1
+        try:
+            pos, val, expires = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires > time.time():
+            # cache entry still valid
+            self.hits += 1
+            self.clock_refs[pos] = True
+            if type(val) is _Compressed:
+                return val.value()
+            return val
+        else:
+            # cache entry has expired. Make sure the space in the cache can
+            # be recycled soon.
+            self.misses += 1
+            self.clock_refs[pos] = False
+            return default
+
+    def put(self, key, val, timeout=None, tags=None, jitter=None):
+        """Add key to the cache with value val
+
+        key will expire in $timeout seconds. If key is already in cache, val
+        and timeout will be updated.
+
+        jitter overrides the jitter of the cache for this entry; pass 0 to
+        use timeout as is.
+
+        tags is an optional iterable of tags for use with invalidate_tag().
+        They replace any tags key had before.
+        """
+        if tags or jitter is not None or self._hooked:
+            return self._put_hooked(key, val, timeout, tags, jitter)
+        if timeout is None:
+            timeout = self.default_timeout
+        if self.jitter:
+            timeout = _jittered(timeout, self.jitter)
+        # These do not change or they are just references, no need for locking.
+        clock_refs = self.clock_refs
+        clock_keys = self.clock_keys
+        data = self.data
+
+        with self.lock:
+            expires = time.time() + timeout
+            entry = data.get(key)
+            if entry is not None:
+                # We already have key. Only make sure data is up to date
+                # and to remember that it was used.
+                pos = entry[0]
+                data[key] = (pos, val, expires)
+                clock_refs[pos] = True
+                return
+            # else: key is not yet in cache. Search place to insert it.
+
+            hand = self.hand
+            if clock_refs[hand]:
+                hand = _clock_victim(clock_refs, hand, self.sweep_budget)
+            oldkey = clock_keys[hand]
+            # See LRUCache._put_hooked().
+            oldentry = data.get(oldkey)
+            if (oldentry is not None and oldentry[0] == hand and
+                    data.pop(oldkey, _MARKER) is not _MARKER):
+                self.evictions += 1
+            clock_keys[hand] = key
+            clock_refs[hand] = True
+            data[key] = (hand, val, expires)
+            hand += 1
+            if hand > self.maxpos:
+                hand = _grow_clock(self)
+            self.hand = hand
+
+    def _put_hooked(self, key, val, timeout, tags, jitter):
+        # put() with the optional features, see Cache._update_hooks().
+        if self.value_codec is not None:
+            val = self.value_codec.encode(val)
+        pool = self.intern_pool
+        if pool is not None:
+            val = pool.intern(val)
+        clock_refs = self.clock_refs
+        clock_keys = self.clock_keys
+        data = self.data
+        index = self._expiry_index
+        if timeout is None:
+            timeout = self.default_timeout
+        if jitter is None:
+            jitter = self.jitter
+        else:
+            jitter = _check_jitter(jitter)
+        if jitter:
+            timeout = _jittered(timeout, jitter)
+
+        # See LRUCache._put_hooked().
+        removed = None
+        try:
+            with self.lock:
+                now = time.time()
+                expires = now + timeout
+                entry = data.get(key)
+                if entry is not None:
+                    # We already have key. Only make sure data is up to date
+                    # and to remember that it was used.
+                    pos = entry[0]
+                    data[key] = (pos, val, expires)
+                    clock_refs[pos] = True
+                    if entry[1] is not val or expires < entry[2]:
+                        self._generation += 1
+                    if (entry[1] is not val and
+                            self._evict_callbacks is not None):
+                        removed = ('invalidate', [(key, entry)])
+                    if pool is not None:
+                        pool.release(entry[1])
+                    if index is not None:
+                        index.discard(key, entry[2])
+                        index.add(key, expires)
+                    if tags or self._tag_index is not None:
+                        self._set_tags(key, tags)
+                    return
+                # else: key is not yet in cache. Search place to insert it.
+
+                hand = self.hand
+                if clock_refs[hand]:
+                    hand = _clock_victim(clock_refs, hand, self.sweep_budget)
+                oldkey = clock_keys[hand]
+                # The slot is stale if oldkey is not in self.data, e.g. after
+                # clear(), or if it was put again into another slot after
+                # invalidate(). Else self.invalidate() in another thread might
+                # remove it concurrently. del() would raise KeyError, so pop().
+                oldentry = data.get(oldkey)
+                if oldentry is not None and oldentry[0] == hand:
+                    oldentry = data.pop(oldkey, _MARKER)
+                else:
+                    oldentry = _MARKER
+                if oldentry is not _MARKER:
+                    self.evictions += 1
+                    self._generation += 1
+                    if pool is not None:
+                        pool.release(oldentry[1])
+                    if index is not None:
+                        index.discard(oldkey, oldentry[2])
+                    if self._tag_index is not None:
+                        self._tag_index.discard(oldkey)
+                    if self._event_log is not None:
+                        self._event_log.record(
+                            'expire' if oldentry[2] <= now else 'evict',
+                            oldkey)
+                    if self._evict_callbacks is not None:
+                        reason = 'expiry' if oldentry[2] <= now else 'capacity'
+                        removed = (reason, [(oldkey, oldentry)])
+                clock_keys[hand] = key
+                clock_refs[hand] = True
+                data[key] = (hand, val, expires)
+                if index is not None:
+                    index.add(key, expires)
+                if tags or self._tag_index is not None:
+                    self._set_tags(key, tags)
+                hand += 1
+                if hand > self.maxpos:
+                    hand = _grow_clock(self)
+                self.hand = hand
+        finally:
+            if removed is not None:
+                self._report_evicted(*removed)
+
+    def _update_hooks(self):
+        Cache._update_hooks(self)
+        if self._expiry_index is not None:
+            self._hooked = True
+
+    def invalidate(self, key):
+        """Remove key from the cache"""
+        # Unlike LRUCache.invalidate(), this takes the lock: purge_expired()
+        # and the expiry index rely on self.data changing under it only.
+        with self.lock:
+            entry = self.data.pop(key, _MARKER)
+            if entry is _MARKER:
+                return
+            self._generation += 1
+            if self.intern_pool is not None:
+                self.intern_pool.release(entry[1])
+            self.clock_refs[entry[0]] = False
+            if self._expiry_index is not None:
+                self._expiry_index.discard(key, entry[2])
+            if self._tag_index is not None:
+                self._tag_index.discard(key)
+        if self._evict_callbacks is not None:
+            self._report_evicted('invalidate', [(key, entry)])
+
+    def _keys(self):
+        return list(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def peek(self, key, default=None):
+        """Return value for key without marking it as used, else default
+
+        Expired entries count as missing.
+        """
+        entry = self.data.get(key)
+        if entry is None or entry[2] <= time.time():
+            return default
+        return _decoded(entry[1])
+
+    def _entries(self):
+        now = time.time()
+        for key, entry in _clock_order(self):
+            if entry[2] > now:
+                yield key, _decoded(entry[1])
+
+    def _snapshot(self):
+        with self.lock:
+            return list(self._entries())
+
+    def _touch(self, keys):
+        data = self.data
+        clock_refs = self.clock_refs
+        for key in keys:
+            entry = data.get(key)
+            if entry is not None:
+                clock_refs[entry[0]] = True
+        Cache._touch(self, keys)
+
+    def _expires(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return 0
+        return entry[2]
+
+    def _refresh_due(self, key, window):
+        # Whether key is in use, i.e. its reference bit is set, and expires
+        # within window seconds but has not expired yet.
+        entry = self.data.get(key)
+        if entry is None:
+            return False
+        remaining = entry[2] - time.time()
+        return 0 < remaining <= window and self.clock_refs[entry[0]]
+
+    def purge_expired(self):
+        """Remove all expired entries from the cache
+
+        Return the number of entries removed.
+        """
+        now = time.time()
+        data = self.data
+        clock_refs = self.clock_refs
+        index = self._expiry_index
+        purged = []
+        with self.lock:
+            if index is not None:
+                keys = index.expired(now)
+            else:
+                keys = [key for key, entry in data.items() if entry[2] <= now]
+            for key in keys:
+                entry = data.pop(key)
+                clock_refs[entry[0]] = False
+                if self.intern_pool is not None:
+                    self.intern_pool.release(entry[1])
+                if index is not None:
+                    index.discard(key, entry[2])
+                if self._tag_index is not None:
+                    self._tag_index.discard(key)
+                if self._event_log is not None:
+                    self._event_log.record('expire', key)
+                purged.append((key, entry))
+        if purged and self._evict_callbacks is not None:
+            self._report_evicted('expiry', purged)
+        return len(purged)
+
+    def next_expiry(self):
+        """Return the earliest expiration time of any entry in the cache
+
+        Expired entries still held by the cache count as well. Return None
+        if the cache is empty.
+        """
+        with self.lock:
+            if self._expiry_index is not None:
+                return self._expiry_index.next_expiry()
+            expires = [entry[2] for entry in self.data.values()]
+        return min(expires) if expires else None
+
+    def expired_count(self):
+        """Return the number of expired entries still held by the cache"""
+        now = time.time()
+        with self.lock:
+            if self._expiry_index is not None:
+                return len(self._expiry_index.expired(now))
+            return len([1 for entry in self.data.values() if entry[2] <= now])
+
+
+if _speedups is not None:
+    class ExpiringLRUCache(_speedups.ExpiringLRUCacheBase, ExpiringLRUCachePy):
+        __doc__ = ExpiringLRUCachePy.__doc__
+else:  # pragma: NO COVER
+    class ExpiringLRUCache(ExpiringLRUCachePy):
+        __doc__ = ExpiringLRUCachePy.__doc__
+
+
+class CacheView(Mapping):
+    """ Read-only mapping view of a cache, see Cache.view()
+
+    Reading through the view does not mark entries as used and does not
+    count as lookups. Iteration is most recently used first.
+    """
+    def __init__(self, cache, snapshot=False):
+        self.cache = cache
+        self._snapshot = None
+        if snapshot:
+            self._snapshot = OrderedDict(cache._snapshot())
+
+    def __getitem__(self, key):
+        if self._snapshot is not None:
+            return self._snapshot[key]
+        val = self.cache.peek(key, _MARKER)
+        if val is _MARKER:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key):
+        if self._snapshot is not None:
+            return key in self._snapshot
+        return key in self.cache
+
+    def __iter__(self):
+        if self._snapshot is not None:
+            return iter(self._snapshot)
+        return iter(self.cache.keys())
+
+    def __len__(self):
+        if self._snapshot is not None:
+            return len(self._snapshot)
+        # Counts live entries only, consistent with iteration.
+        return len(self.cache.keys())
+
+
+class _FrontState(threading.local):
+    # Per-thread state of a FrontCache.
+    def __init__(self):
+        self.entries = {}  # key -> (val, expires)
+        self.generation = None
+        self.pending = []  # keys of hits not yet reported to the cache
+
+
+class FrontCache(object):
+    """ Thread-local front cache (L0) over a shared cache
+
+    Each thread keeps copies of up to 'size' entries it read from 'cache'.
+    Hits on these copies touch no shared state; they are reported to the
+    cache, which sets their reference bits and counts them as hits, in
+    batches of 'flush_every' or when flush() is called.
+
+    The copies of a thread are dropped as soon as the cache's generation
+    changes, i.e. when an entry is invalidated, replaced or evicted, or the
+    cache is cleared. Expiration times of ExpiringLRUCache entries are kept
+    with the copies. A full front cache is emptied and filled again by the
+    next misses, so it holds the keys currently hot in the thread.
+
+    The front cache holds strong references to keys and values, also over
+    WeakValueLRUCache and WeakKeyLRUCache.
+    """
+    def __init__(self, cache, size=32, flush_every=64):
+        size = int(size)
+        if size < 1:
+            raise ValueError('size must be >0')
+        flush_every = int(flush_every)
+        if flush_every < 1:
+            raise ValueError('flush_every must be >0')
+        self.cache = cache
+        self.size = size
+        self.flush_every = flush_every
+        self._local = _FrontState()
+        # put() only bumps the generation while the cache is fronted.
+        cache._fronted = True
+        cache._update_hooks()
+
+    def get(self, key, default=None):
+        """Return value for key. If not in cache, return default"""
+        local = self._local
+        cache = self.cache
+        generation = cache._generation
+        if local.generation != generation:
+            self._reset(local, generation)
+        entries = local.entries
+        entry = entries.get(key)
+        if entry is not None:
+            val, expires = entry
+            if expires is None or expires > time.time():
+                pending = local.pending
+                pending.append(key)
+                if len(pending) >= self.flush_every:
+                    self.flush()
+                return val
+            del entries[key]
+        val = cache.get(key, _MARKER)
+        if val is _MARKER:
+            return default
+        if len(entries) >= self.size:
+            entries.clear()
+        entries[key] = (val, cache._expires(key))
+        return val
+
+    def put(self, key, val, *args, **kw):
+        """Add key to the cache with value val
+
+        Arguments are passed on to the put() of the cache.
+        """
+        self._local.entries.pop(key, None)
+        self.cache.put(key, val, *args, **kw)
+
+    def invalidate(self, key):
+        """Remove key from the cache"""
+        self.cache.invalidate(key)
+
+    def invalidate_tag(self, tag):
+        """Remove all entries tagged with tag from the cache"""
+        self.cache.invalidate_tag(tag)
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        self.cache.clear()
+
+    def flush(self):
+        """Report the hits of this thread to the cache"""
+        local = self._local
+        pending = local.pending
+        if pending:
+            local.pending = []
+            self.cache._touch(pending)
+
+    def _keys(self):
+        return self.cache._keys()
+
+    def _reset(self, local, generation):
+        self.flush()
+        local.entries.clear()
+        local.generation = generation
+
+
+def _call_evict_callbacks(batch):
+    cache, callbacks, reason, entries = batch
+    for key, entry in entries:
+        key = cache._entry_key(key)
+        val = cache._entry_value(entry)
+        if key is _MARKER or val is _MARKER:
+            continue
+        val = _decoded(val)
+        for callback in callbacks:
+            callback(key, val, reason)
+
+
+class _Flush(object):
+    """ Queued by _QueueWorker.flush() """
+    __slots__ = ('event',)
+
+    def __init__(self):
+        self.event = threading.Event()
+
+
+class _QueueWorker(object):
+    """ Thread calling handle(item) for each queued item, in order
+
+    The thread is started by the first submit(). It drains the queue in
+    batches of up to 'batch_size' items. Exceptions raised by handle are
+    counted in 'failed'.
+    """
+    def __init__(self, handle, name, batch_size=256):
+        self.handle = handle
+        self.name = name
+        self.batch_size = batch_size
+        self.failed = 0
+        self.queue = deque()
+        self.wakeup = threading.Event()
+        self.start_lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, item):
+        self.queue.append(item)
+        if not self.wakeup.is_set():
+            self.wakeup.set()
+        if self.thread is None:
+            self._start()
+
+    def flush(self):
+        """Wait until the items queued so far are handled"""
+        if self.thread is None:
+            return
+        flush = _Flush()
+        self.submit(flush)
+        flush.event.wait()
+
+    def close(self):
+        """Handle the queued items and stop the thread"""
+        with self.start_lock:
+            thread = self.thread
+            if thread is None:
+                return
+            self.submit(None)
+            thread.join()
+            self.thread = None
+
+    def stop(self):
+        """Stop the thread once the queued items are handled, without waiting
+        """
+        # Called by the garbage collector when the owner of the worker is
+        # gone: must not acquire locks.
+        if self.thread is not None:
+            self.queue.append(None)
+            self.wakeup.set()
+
+    def _start(self):
+        with self.start_lock:
+            if self.thread is None:  # pragma: NO BRANCH (lost a race)
+                thread = threading.Thread(target=self._run, name=self.name)
+                thread.daemon = True
+                thread.start()
+                self.thread = thread
+
+    def _run(self):
+        queue = self.queue
+        wakeup = self.wakeup
+        handle = self.handle
+        while True:
+            wakeup.wait()
+            # Items queued from now on set the event again.
+            wakeup.clear()
+            while queue:
+                count = min(len(queue), self.batch_size)
+                batch = [queue.popleft() for i in range(count)]
+                for i, item in enumerate(batch):
+                    if item is None:
+                        # close(); leave later items to the next thread.
+                        queue.extendleft(reversed(batch[i + 1:]))
+                        return
+                    if type(item) is _Flush:
+                        item.event.set()
+                        continue
+                    try:
+                        handle(item)
+                    except Exception:
+                        self.failed += 1
+
+    def reinit_after_fork(self):
+        # The thread did not survive the fork.
+        self.start_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.wakeup.set()
+        self.thread = None
+        if self.queue:
+            self._start()
+
+
+def _release_cleared(cache, data):
+    # Release the entries of data, a dict dropped by cache.clear(), and
+    # report them to all the on_evict() callbacks of cache. Entries are
+    # popped one at a time, so that each is released as soon as it has been
+    # reported, and other threads get the GIL in between.
+    callbacks = [callback for callback, background
+                 in cache._evict_callbacks or ()]
+    pool = cache.intern_pool
+    while data:
+        key, entry = data.popitem()
+        if pool is not None:
+            pool.release(cache._entry_value(entry))
+        if callbacks:
+            try:
+                _call_evict_callbacks(
+                    (cache, callbacks, 'clear', [(key, entry)]))
+            except Exception:
+                _DISPOSER.failed += 1
+
+
+def _dispose(item):
+    cache, callbacks, reason, entries = item
+    if callbacks is None:
+        _release_cleared(cache, entries)
+    else:
+        _call_evict_callbacks(item)
+
+
+# Calls the on_evict() callbacks registered with background=True, and
+# releases the entries dropped by clear().
+_DISPOSER = _QueueWorker(_dispose, 'repoze.lru disposal')
+
+
+class _Deferred(object):
+    """ A put() or invalidate() queued by a WriteBehindCache """
+    __slots__ = ('key', 'val', 'args', 'kw', 'pending', 'lock')
+
+    def __init__(self, key, val, args, kw, pending, lock):
+        self.key = key
+        self.val = val  # _MARKER for invalidate()
+        self.args = args
+        self.kw = kw
+        # Queued operations of the calling thread, by key
+        self.pending = pending
+        self.lock = lock
+
+
+class _WriteBehindState(threading.local):
+    # Per-thread state of a WriteBehindCache.
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+
+class WriteBehindCache(object):
+    """ Applies the put() and invalidate() calls of a cache in the background
+
+    put() and invalidate() queue the call and return. A worker thread,
+    started on first use, applies the queued calls in order, in batches of
+    up to 'batch_size', so that the CLOCK sweep and the release of evicted
+    or replaced values happen off the calling threads.
+
+    Until then, get() in the thread which queued a call sees its effect;
+    other threads see the cache as it is. flush() waits until all calls
+    queued so far are applied. clear() and invalidate_tag() flush first.
+    Exceptions raised by the cache in the worker are counted in 'failed'.
+
+    The queue is unbounded: nothing slows down callers queueing calls faster
+    than the worker applies them, and the queued values stay alive until
+    then. Call flush() now and then to apply backpressure.
+
+    close() stops the worker thread. It also stops, once the queued calls
+    are applied, when the WriteBehindCache is garbage collected.
+    """
+    def __init__(self, cache, batch_size=256):
+        batch_size = int(batch_size)
+        if batch_size < 1:
+            raise ValueError('batch_size must be >0')
+        self.cache = cache
+        self.batch_size = batch_size
+        self.failed = 0
+        self._local = _WriteBehindState()
+
+        def apply(op):
+            try:
+                if op.val is _MARKER:
+                    cache.invalidate(op.key)
+                else:
+                    cache.put(op.key, op.val, *op.args, **op.kw)
+            except Exception:
+                self = selfref()
+                if self is not None:
+                    self.failed += 1
+            with op.lock:
+                if op.pending.get(op.key) is op:
+                    del op.pending[op.key]
+
+        # The worker only references self weakly, so that self can be
+        # collected, which stops the thread.
+        worker = self._worker = _QueueWorker(
+            apply, 'repoze.lru write-behind', batch_size)
+        selfref = weakref.ref(self, lambda ref: worker.stop())
+        _WRITE_BEHIND.add(self)
 
     def get(self, key, default=None):
         """Return value for key. If not in cache, return default"""
-        self.lookups += 1
-        try:
-            pos, val = self.data[key]
-            self.hits += 1
-        except KeyError:
-            self.misses += 1
+        op = self._local.pending.get(key)
+        if op is None:
+            return self.cache.get(key, default)
+        if op.val is _MARKER:
             return default
-        self.clock_refs[pos] = True
-        return val
-
-    def put(self, key, val):
-        """Add key to the cache with value val"""
-        # These do not change or they are just references, no need for locking.
-        maxpos = self.maxpos
-        clock_refs = self.clock_refs
-        clock_keys = self.clock_keys
-        data = self.data
+        return op.val
 
-        with self.lock:
-            entry = data.get(key)
-            if entry is not None:
-                # We already have key. Only make sure data is up to date and
-                # to remember that it was used.
-                pos, old_val = entry
-                if old_val is not val:
-                    data[key] = (pos, val)
-                self.clock_refs[pos] = True
-                return
-            # else: key is not yet in cache. Search place to insert it.
+    def put(self, key, val, *args, **kw):
+        """Queue adding key to the cache with value val
 
-            hand = self.hand
-            count = 0
-            max_count = 107
-            while 1:
-                ref = clock_refs[hand]
-                if ref == True:
-                    clock_refs[hand] = False
-                    hand += 1
-                    if hand > maxpos:
-                        hand = 0
-
-                    count += 1
-                    if count >= max_count:
-                        # We have been searching long enough. Force eviction of
-                        # next entry, no matter what its status is.
-                        clock_refs[hand] = False
-                else:
-                    oldkey = clock_keys[hand]
-                    # Maybe oldkey was not in self.data to begin with. If it
-                    # was, self.invalidate() in another thread might have
-                    # already removed it. del() would raise KeyError, so pop().
-                    oldentry = data.pop(oldkey, _MARKER)
-                    if oldentry is not _MARKER:
-                        self.evictions += 1
-                    clock_keys[hand] = key
-                    clock_refs[hand] = True
-                    data[key] = (hand, val)
-                    hand += 1
-                    if hand > maxpos:
-                        hand = 0
-                    self.hand = hand
-                    break
+        Arguments are passed on to the put() of the cache.
+        """
+        self._defer(key, val, args, kw)
 
     def invalidate(self, key):
-        """Remove key from the cache"""
-        # pop with default arg will not raise KeyError
-        entry = self.data.pop(key, _MARKER)
-        if entry is not _MARKER:
-            # We have no lock, but worst thing that can happen is that we
-            # set another key's entry to False.
-            self.clock_refs[entry[0]] = False
-        # else: key was not in cache. Nothing to do.
-
+        """Queue removing key from the cache"""
+        self._defer(key, _MARKER, None, None)
 
-class ExpiringLRUCache(Cache):
-    """ Implements a pseudo-LRU algorithm (CLOCK) with expiration times
-
-    The Clock algorithm is not kept strictly to improve performance, e.g. to
-    allow get() and invalidate() to work without acquiring the lock.
-    """
-    def __init__(self, size, default_timeout=_DEFAULT_TIMEOUT):
-        self.default_timeout = default_timeout
-        size = int(size)
-        if size < 1:
-            raise ValueError('size must be >0')
-        self.size = size
-        self.lock = threading.Lock()
-        self.hand = 0
-        self.maxpos = size - 1
-        self.clock_keys = None
-        self.clock_refs = None
-        self.data = None
-        self.evictions = 0
-        self.hits = 0
-        self.misses = 0
-        self.lookups = 0
-        self.clear()
+    def invalidate_tag(self, tag):
+        """Remove all entries tagged with tag from the cache"""
+        self.flush()
+        self.cache.invalidate_tag(tag)
 
     def clear(self):
         """Remove all entries from the cache"""
-        with self.lock:
-            # If really clear()ing a full cache, clean up self.data first to
-            # give garbage collection a chance to reduce memorey usage.
-            # Instantiating "[_MARKER] * size" will temporarily have 2 lists
-            # in memory -> high peak memory usage for tiny amount of time.
-            # With self.data already clear, that peak should not exceed what
-            # we normally use.
-            # self.data contains (pos, val, expires) triplets
-            self.data = {}
-            size = self.size
-            self.clock_keys = [_MARKER] * size
-            self.clock_refs = [False] * size
-            self.hand = 0
-            self.evictions = 0
-            self.hits = 0
-            self.misses = 0
-            self.lookups = 0
+        self.flush()
+        self.cache.clear()
 
-    def get(self, key, default=None):
-        """Return value for key. If not in cache or expired, return default"""
-        self.lookups += 1
-        try:
-            pos, val, expires = self.data[key]
-        except KeyError:
-            self.misses += 1
-            return default
-        if expires > time.time():
-            # cache entry still valid
-            self.hits += 1
-            self.clock_refs[pos] = True
-            return val
-        else:
-            # cache entry has expired. Make sure the space in the cache can
-            # be recycled soon.
-            self.misses += 1
-            self.clock_refs[pos] = False
-            return default
+    def flush(self):
+        """Wait until the calls queued so far are applied"""
+        self._worker.flush()
 
-    def put(self, key, val, timeout=None):
-        """Add key to the cache with value val
+    def close(self):
+        """Apply the queued calls and stop the worker thread"""
+        self._worker.close()
 
-        key will expire in $timeout seconds. If key is already in cache, val
-        and timeout will be updated.
-        """
-        # These do not change or they are just references, no need for locking.
-        maxpos = self.maxpos
-        clock_refs = self.clock_refs
-        clock_keys = self.clock_keys
-        data = self.data
-        lock = self.lock
-        if timeout is None:
-            timeout = self.default_timeout
+    def _keys(self):
+        return self.cache._keys()
 
-        with self.lock:
-            entry = data.get(key)
-            if entry is not None:
-                # We already have key. Only make sure data is up to date and
-                # to remember that it was used.
-                pos = entry[0]
-                data[key] = (pos, val, time.time() + timeout)
-                clock_refs[pos] = True
-                return
-            # else: key is not yet in cache. Search place to insert it.
+    def _defer(self, key, val, args, kw):
+        local = self._local
+        op = _Deferred(key, val, args, kw, local.pending, local.lock)
+        with local.lock:
+            local.pending[key] = op
+        self._worker.submit(op)
 
-            hand = self.hand
-            count = 0
-            max_count = 107
-            while 1:
-                ref = clock_refs[hand]
-                if ref == True:
-                    clock_refs[hand] = False
-                    hand += 1
-                    if hand > maxpos:
-                        hand = 0
-
-                    count += 1
-                    if count >= max_count:
-                        # We have been searching long enough. Force eviction of
-                        # next entry, no matter what its status is.
-                        clock_refs[hand] = False
-                else:
-                    oldkey = clock_keys[hand]
-                    # Maybe oldkey was not in self.data to begin with. If it
-                    # was, self.invalidate() in another thread might have
-                    # already removed it. del() would raise KeyError, so pop().
-                    oldentry = data.pop(oldkey, _MARKER)
-                    if oldentry is not _MARKER:
-                        self.evictions += 1
-                    clock_keys[hand] = key
-                    clock_refs[hand] = True
-                    data[key] = (hand, val, time.time() + timeout)
-                    hand += 1
-                    if hand > maxpos:
-                        hand = 0
-                    self.hand = hand
-                    break
+    def _reinit_after_fork(self):
+        self._worker.reinit_after_fork()
 
-    def invalidate(self, key):
-        """Remove key from the cache"""
-        # pop with default arg will not raise KeyError
-        entry = self.data.pop(key, _MARKER)
-        if entry is not _MARKER:
-            # We have no lock, but worst thing that can happen is that we
-            # set another key's entry to False.
-            self.clock_refs[entry[0]] = False
-        # else: key was not in cache. Nothing to do.
+
+class HashedKeyPy(tuple):
+    """ Tuple that computes its hash once
+
+    Hashing a tuple hashes all of its items, every time, and a cache miss
+    hashes the key several times: in get(), twice in put(), and again for the
+    key evicted to make room. A HashedKey equals, and hashes like, the plain
+    tuple with the same items, so it can be used as key of any cache, and
+    entries stored under it are found by the plain tuple and vice versa.
+
+    Building one costs more than hashing a small tuple: this pays off for
+    wide or nested keys only. The C implementation stores the hash after the
+    items, 8 bytes per key on 64-bit builds. This pure-Python one keeps it in
+    an instance dict, about 200 bytes per key, since tuple subclasses cannot
+    have __slots__.
+    """
+    def __new__(cls, items=()):
+        self = tuple.__new__(cls, items)
+        self.hashvalue = tuple.__hash__(self)
+        return self
+
+    def __hash__(self):
+        return self.hashvalue
+
+    def __reduce__(self):
+        # String hashes differ between processes: hash again on load.
+        return (type(self), (tuple(self),))
+
+
+if _speedups is not None:
+    class HashedKey(_speedups.HashedKeyBase):
+        __doc__ = HashedKeyPy.__doc__
+        __slots__ = ()
+else:  # pragma: NO COVER
+    class HashedKey(HashedKeyPy):
+        __doc__ = HashedKeyPy.__doc__
+
+
+def _split_key(key):
+    # Inverse of the key building in lru_cache: return (args, kwargs).
+    # A call passing exactly a tuple and a frozenset as positional arguments
+    # cannot be told apart from a call with keyword arguments.
+    if isinstance(key, (HashedKey, HashedKeyPy)):
+        key = tuple(key)
+    if (type(key) is tuple and len(key) == 2 and
+            type(key[0]) is tuple and type(key[1]) is frozenset):
+        return key[0], dict(key[1])
+    return key, {}
 
 
 class lru_cache(object):
@@ -314,25 +2364,146 @@ class lru_cache(object):
 
     timeout parameter specifies after how many seconds a cached entry should
     be considered invalid.
+
+    tags is an optional iterable of tags attached to every entry the
+    decorated function puts into the cache (see Cache.invalidate_tag()).
+
+    The decorated function grows methods to drop cached results:
+
+    - invalidate(*args, **kwargs) drops the result of that call.
+
+    - invalidate_prefix(*args) drops the results of all calls whose leading
+      positional arguments equal args. If prefix_index is N > 0, entries are
+      indexed by their first 1..N positional arguments when they are put into
+      the cache, so that prefixes up to N arguments long are invalidated
+      without scanning the cache. This needs a cache supporting tags.
+
+    - invalidate_where(predicate) drops the results of all calls for which
+      predicate(args, kwargs) is true. This scans the whole cache.
+
+    If weak_values is true, results are held through weak references (see
+    WeakValueLRUCache). If weak_keys is true, the decorated function must
+    take a single positional argument, which is held through a weak
+    reference and serves as the key (see WeakKeyLRUCache). Both need a
+    maxsize and no timeout.
+
+    If hashed_keys is true, the arguments are wrapped in a HashedKey, so that
+    they are hashed once per call instead of several times per cache miss.
+    This helps with wide or nested argument tuples, and costs some time on
+    every call otherwise. Each key then also takes 8 more bytes, or about 200
+    with the pure-Python HashedKey (see HashedKey).
+
+    If codec is given, results that are large byte strings or text are
+    stored compressed (see Cache.compress_values()); codec_threshold is the
+    size from which they are.
+
+    refresh_ahead is an optional fraction of the timeout. A call hitting an
+    entry that expires within that fraction of the timeout, and whose
+    reference bit shows it was used since the CLOCK hand last passed, gets
+    the cached result while the function is called again in the background
+    to replace it. Hot entries are thus refreshed before they expire.
+    refresh_executor runs these calls; it must have a submit() method, like
+    a concurrent.futures executor. By default, a thread pool shared by all
+    decorated functions is created on first use; on Python 2, that needs the
+    'futures' backport. refresh_ahead needs an ExpiringLRUCache.
+
+    jitter is an optional fraction or callable to randomize the timeout of
+    each entry, see ExpiringLRUCache.
     """
+    # C implementation of the wrapper, if available.
+    _CachedWrapper = getattr(_speedups, 'CachedWrapper', None)
+
     def __init__(self,
                  maxsize,
                  cache=None, # cache is an arg to serve tests
                  timeout=None,
-                 ignore_unhashable_args=False):
+                 ignore_unhashable_args=False,
+                 tags=None,
+                 prefix_index=0,
+                 weak_keys=False,
+                 weak_values=False,
+                 hashed_keys=False,
+                 codec=None,
+                 codec_threshold=_DEFAULT_CODEC_THRESHOLD,
+                 refresh_ahead=None,
+                 refresh_executor=None,
+                 jitter=None):
         if cache is None:
-            if maxsize is None:
+            if weak_keys or weak_values:
+                if weak_keys and weak_values:
+                    raise ValueError(
+                        'weak_keys and weak_values are mutually exclusive')
+                if maxsize is None or timeout is not None:
+                    raise ValueError(
+                        'weak references need a maxsize and no timeout')
+                if weak_keys:
+                    cache = WeakKeyLRUCache(maxsize)
+                else:
+                    cache = WeakValueLRUCache(maxsize)
+            elif maxsize is None:
                 cache = UnboundedCache()
             elif timeout is None:
                 cache = LRUCache(maxsize)
             else:
                 cache = ExpiringLRUCache(maxsize, default_timeout=timeout)
+        weak_keys = weak_keys or isinstance(cache, WeakKeyLRUCache)
+        if weak_keys and prefix_index:
+            raise ValueError('prefix_index cannot be used with weak_keys')
+        if weak_keys and hashed_keys:
+            raise ValueError('hashed_keys cannot be used with weak_keys')
+        if codec is not None:
+            cache.compress_values(codec, codec_threshold)
+        self._refresh_window = None
+        if refresh_ahead is not None:
+            if not 0 < refresh_ahead < 1:
+                raise ValueError('refresh_ahead must be >0 and <1')
+            if not isinstance(cache, ExpiringLRUCachePy):
+                raise ValueError('refresh_ahead needs an ExpiringLRUCache')
+            if refresh_executor is None:
+                # Fail here rather than on the first hit to refresh.
+                try:
+                    import concurrent.futures
+                except ImportError:
+                    raise ValueError(
+                        'refresh_ahead needs a refresh_executor where '
+                        'concurrent.futures is not available')
+            if timeout is None:
+                timeout = cache.default_timeout
+            self._refresh_window = refresh_ahead * timeout
+        self._refresh_executor = refresh_executor
+        if jitter is not None:
+            if not isinstance(cache, ExpiringLRUCachePy):
+                raise ValueError('jitter needs an ExpiringLRUCache')
+            cache.jitter = _check_jitter(jitter)
         self.cache = cache
         self._ignore_unhashable_args = ignore_unhashable_args
+        self._tags = frozenset(tags) if tags else None
+        self._prefix_index = int(prefix_index)
+        self._weak_keys = weak_keys
+        self._hashed_keys = hashed_keys
 
     def __call__(self, func):
         cache = self.cache
         marker = _MARKER
+        tags = self._tags
+        prefix_index = self._prefix_index
+        # Distinguishes the prefix tags of this function from those of other
+        # functions sharing the cache.
+        prefix_marker = object()
+
+        def entry_tags(args):
+            result = set(tags or ())
+            for i in range(1, min(prefix_index, len(args)) + 1):
+                result.add((prefix_marker, args[:i]))
+            return result
+
+        def store(key, args, val):
+            if prefix_index:
+                cache.put(key, val, tags=entry_tags(args))
+            elif tags:
+                cache.put(key, val, tags=tags)
+            else:
+                cache.put(key, val)
 
         def cached_wrapper(*args, **kwargs):
             try:
@@ -346,9 +2517,143 @@ class lru_cache(object):
                 val = cache.get(key, marker)
                 if val is marker:
                     val = func(*args, **kwargs)
-                    cache.put(key, val)
+                    store(key, args, val)
+                return val
+
+        def make_key(args, kwargs):
+            return (args, frozenset(kwargs.items())) if kwargs else args
+
+        split_key = _split_key
+
+        if self._refresh_window is not None:
+            window = self._refresh_window
+            hashed_keys = self._hashed_keys
+            # Keys being refreshed
+            refreshing = set()
+            refresh_lock = threading.Lock()
+
+            def refresh(key, args, kwargs):
+                try:
+                    val = func(*args, **kwargs)
+                    # Unless the entry was invalidated meanwhile
+                    if cache._expires(key):
+                        store(key, args, val)
+                finally:
+                    with refresh_lock:
+                        refreshing.discard(key)
+
+            def schedule_refresh(key, args, kwargs):
+                with refresh_lock:
+                    if key in refreshing:
+                        return
+                    refreshing.add(key)
+                executor = self._refresh_executor or _get_refresh_executor()
+                try:
+                    executor.submit(refresh, key, args, kwargs)
+                except RuntimeError:
+                    # Shut down, e.g. at exit: let the entry expire.
+                    with refresh_lock:
+                        refreshing.discard(key)
+
+            def cached_wrapper(*args, **kwargs):
+                try:
+                    key = (args, frozenset(kwargs.items())) if kwargs else args
+                    if hashed_keys:
+                        key = HashedKey(key)
+                    # Before get(), which sets the reference bit.
+                    due = cache._refresh_due(key, window)
+                except TypeError as e:
+                    if self._ignore_unhashable_args:
+                        return func(*args, **kwargs)
+                    else:
+                        raise e
+                val = cache.get(key, marker)
+                if val is marker:
+                    val = func(*args, **kwargs)
+                    store(key, args, val)
+                elif due:
+                    schedule_refresh(key, args, kwargs)
+                return val
+
+        elif self._CachedWrapper is not None and not self._weak_keys:
+            def miss(key, args, kwargs):
+                val = func(*args, **kwargs)
+                store(key, args, val)
+                return val
+
+            key_type = HashedKey if self._hashed_keys else None
+            cached_wrapper = self._CachedWrapper(func, cache, miss, marker,
+                                                 self, key_type)
+
+        elif self._hashed_keys:
+            def cached_wrapper(*args, **kwargs):
+                try:
+                    key = HashedKey((args, frozenset(kwargs.items()))
+                                    if kwargs else args)
+                except TypeError as e:
+                    if self._ignore_unhashable_args:
+                        return func(*args, **kwargs)
+                    else:
+                        raise e
+                else:
+                    val = cache.get(key, marker)
+                    if val is marker:
+                        val = func(*args, **kwargs)
+                        store(key, args, val)
+                    return val
+
+        if self._weak_keys:
+            def cached_wrapper(obj):
+                val = cache.get(obj, marker)
+                if val is marker:
+                    val = func(obj)
+                    if tags:
+                        cache.put(obj, val, tags=tags)
+                    else:
+                        cache.put(obj, val)
                 return val
 
+            def make_key(args, kwargs):
+                if kwargs or len(args) != 1:
+                    raise TypeError(
+                        'weak_keys needs a single positional argument')
+                return args[0]
+
+            def split_key(key):
+                return (key,), {}
+
+        def invalidate(*args, **kwargs):
+            try:
+                key = make_key(args, kwargs)
+            except TypeError:
+                if self._ignore_unhashable_args:
+                    # Such calls are never cached.
+                    return
+                raise
+            cache.invalidate(key)
+
+        def invalidate_where(predicate):
+            for key in cache._keys():
+                args, kwargs = split_key(key)
+                if predicate(args, kwargs):
+                    cache.invalidate(key)
+
+        def invalidate_prefix(*args):
+            if 0 < len(args) <= prefix_index:
+                cache.invalidate_tag((prefix_marker, args))
+            else:
+                count = len(args)
+                invalidate_where(lambda a, kw: a[:count] == args)
+
+        def put_result(args, val):
+            # Store the result of func(*args) computed elsewhere.
+            store(make_key(args, {}), args, val)
+
+        cached_wrapper.invalidate = invalidate
+        cached_wrapper.invalidate_where = invalidate_where
+        cached_wrapper.invalidate_prefix = invalidate_prefix
+        cached_wrapper._put_result = put_result
+
         def _maybe_copy(source, target, attr):
             value = getattr(source, attr, source)
             if value is not source:
@@ -356,31 +2661,324 @@ class lru_cache(object):
 
         _maybe_copy(func, cached_wrapper, '__module__')
         _maybe_copy(func, cached_wrapper, '__name__')
+        _maybe_copy(func, cached_wrapper, '__qualname__')
         _maybe_copy(func, cached_wrapper, '__doc__')
         cached_wrapper._cache = cache
+        cached_wrapper.__wrapped__ = func
         return cached_wrapper
 
 
+class batch_cached(object):
+    """ Decorator for functions computing a batch of results at once
+
+    The decorated function takes a sequence of items (a list, tuple or
+    one-dimensional NumPy array) as first argument and returns a sequence of
+    as many results, in the same order. Each item is cached on its own: the
+    function is called once per call of the wrapper, with only the items
+    missing from the cache, and the results are scattered back into order.
+
+    Further arguments are passed on and are part of the cache key. The
+    wrapper returns a list, or a NumPy array for NumPy array input.
+
+    maxsize and timeout select the cache like for lru_cache.
+    """
+    def __init__(self, maxsize, cache=None, timeout=None):
+        if cache is None:
+            if maxsize is None:
+                cache = UnboundedCache()
+            elif timeout is None:
+                cache = LRUCache(maxsize)
+            else:
+                cache = ExpiringLRUCache(maxsize, default_timeout=timeout)
+        self.cache = cache
+
+    def __call__(self, func):
+        cache = self.cache
+        marker = _MARKER
+
+        def batch_wrapper(items, *args, **kwargs):
+            extra = (args, frozenset(kwargs.items())) if kwargs else args
+            numpy = None
+            if type(items).__module__ == 'numpy':
+                # NumPy is imported already if we got one of its arrays.
+                numpy = sys.modules['numpy']
+                elements = items.tolist()
+            else:
+                if not isinstance(items, (list, tuple)):
+                    items = list(items)
+                elements = items
+            results = [None] * len(elements)
+            missing = {}  # key -> positions of its item
+            order = []  # first position of each missing key
+            for pos, item in enumerate(elements):
+                key = (item, extra) if extra else item
+                val = cache.get(key, marker)
+                if val is not marker:
+                    results[pos] = val
+                elif key in missing:
+                    missing[key].append(pos)
+                else:
+                    missing[key] = [pos]
+                    order.append(pos)
+            dtype = None
+            if order:
+                if numpy is not None:
+                    batch = items[order]
+                else:
+                    batch = [items[pos] for pos in order]
+                computed = func(batch, *args, **kwargs)
+                if len(computed) != len(order):
+                    raise ValueError(
+                        '%s returned %d results for %d items' %
+                        (getattr(func, '__name__', func), len(computed),
+                         len(order)))
+                dtype = getattr(computed, 'dtype', None)
+                for pos, val in zip(order, computed):
+                    item = elements[pos]
+                    key = (item, extra) if extra else item
+                    cache.put(key, val)
+                    for other in missing[key]:
+                        results[other] = val
+            if numpy is not None:
+                return numpy.array(results, dtype=dtype)
+            return results
+
+        for attr in ('__module__', '__name__', '__qualname__', '__doc__'):
+            value = getattr(func, attr, batch_wrapper)
+            if value is not batch_wrapper:
+                setattr(batch_wrapper, attr, value)
+        batch_wrapper._cache = cache
+        batch_wrapper.__wrapped__ = func
+        return batch_wrapper
+
+
+class _PoolCall(object):
+    """ Picklable reference to the function wrapped by a decorated function
+
+    Decorated functions cannot be pickled by reference: their module
+    attribute is the wrapper, not the function. Workers look the wrapper up
+    by name instead and call the wrapped function, bypassing their own cache.
+    """
+    def __init__(self, module, qualname):
+        self.module = module
+        self.qualname = qualname
+
+    def __call__(self, args):
+        __import__(self.module)
+        func = sys.modules[self.module]
+        for name in self.qualname.split('.'):
+            func = getattr(func, name)
+        return getattr(func, '__wrapped__', func)(*args)
+
+
+def pool_map(executor, func, *iterables, **kw):
+    """Like executor.map(func, *iterables), using func's cache in this process
+
+    func must be a module-level function decorated with lru_cache (or a
+    CacheMaker decorator), and executor an executor with a map() method,
+    typically a concurrent.futures.ProcessPoolExecutor.
+
+    Calls are deduplicated, results in func's cache are served directly, and
+    only the misses are sent to the executor. Their results are put into the
+    cache of this process. Keyword arguments are passed on to executor.map()
+    (e.g. chunksize).
+
+    Return the list of results.
+    """
+    cache = func._cache
+    calls = list(zip(*iterables))
+    results = {}
+    misses = []
+    for args in calls:
+        if args in results:
+            continue
+        val = cache.get(args, _MARKER)
+        if val is _MARKER:
+            misses.append(args)
+        results[args] = val
+    if misses:
+        target = _PoolCall(
+            func.__module__, getattr(func, '__qualname__', func.__name__))
+        for args, val in zip(misses, executor.map(target, misses, **kw)):
+            func._put_result(args, val)
+            results[args] = val
+    return [results[args] for args in calls]
+
+
+def _live(objref):
+    # Return a callable returning the referent of objref, or raising
+    # ReferenceError if it is gone.
+    def live():
+        obj = objref()
+        if obj is None:
+            raise ReferenceError('the instance of the method is gone')
+        return obj
+    return live
+
+
+class cached_method(object):
+    """ Decorator for LRU-cached methods, with a cache per instance
+
+    Unlike lru_cache, the instance is not part of the cache key, so it is
+    not kept alive by the cache and instances do not share entries.
+
+    The cache of an instance is stored in its attribute '_<name>_cache',
+    where <name> is the method name; classes using __slots__ need to provide
+    such a slot. The bound method exposes it as '_cache' and grows a clear()
+    method dropping the cached results of that instance only. The cache
+    starts small and grows up to maxsize entries as it fills.
+
+    The bound method is built on first access and kept by the decorator,
+    keyed by the identity of the instance, so later accesses cost a dict
+    lookup; nothing but the cache is stored on the instance, which can be
+    copied and pickled as usual. A copy still holding the cache of its
+    original gets a fresh one on first access. The kept method references
+    the instance weakly; calling it once the instance is gone raises
+    ReferenceError on a miss. Instances without weak reference support get a
+    new bound method on each access.
+
+    timeout parameter specifies after how many seconds a cached entry should
+    be considered invalid.
+
+    If shared is true, all instances use a single cache of maxsize entries,
+    i.e. they share a global size budget. Entries are tagged per instance so
+    clear() still drops the results of one instance only.
+    """
+    def __init__(self, maxsize, timeout=None, shared=False):
+        if maxsize is None:
+            raise ValueError('cached_method needs a maxsize')
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.cache = self._makeCache() if shared else None
+        self._func = None
+        self._attr = None
+        self._name = None
+        # id(instance) -> (weak reference to it, its bound method), and
+        # id(cache or token) -> weak reference to the instance using it.
+        self._bound = {}
+        self._owners = {}
+
+    def _makeCache(self):
+        if self.timeout is None:
+            return LRUCache(self.maxsize)
+        return ExpiringLRUCache(self.maxsize, default_timeout=self.timeout)
+
+    def __call__(self, func):
+        self._func = func
+        self._attr = '_%s_cache' % func.__name__
+        self._name = func.__name__
+        self.__doc__ = getattr(func, '__doc__', None)
+        return self
+
+    def __set_name__(self, owner, name):
+        self._name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        bound = self._bound
+        entry = bound.get(id(obj))
+        if entry is not None and entry[0]() is obj:
+            return entry[1]
+        state = self._state(obj)
+        owners = self._owners
+        obj_id, state_id = id(obj), id(state)
+
+        def forget(objref):
+            bound.pop(obj_id, None)
+            owners.pop(state_id, None)
+
+        try:
+            objref = weakref.ref(obj, forget)
+        except TypeError:
+            return self._bind(state, lambda: obj)
+        # The kept method only references obj weakly, else obj would be kept
+        # alive by the decorator. The one returned here keeps it alive, e.g.
+        # for obj().method().
+        bound[obj_id] = (objref, self._bind(state, _live(objref)))
+        owners[state_id] = objref
+        return self._bind(state, lambda: obj)
+
+    def _state(self, obj):
+        # Return the cache of obj, or its token in the shared cache. A copy
+        # of an instance starts with the state of its original: it gets its
+        # own while the original is alive.
+        attr = self._attr
+        state = getattr(obj, attr, None)
+        if state is not None:
+            owner = self._owners.get(id(state))
+            if owner is None or owner() is obj:
+                return state
+        state = self._makeCache() if self.cache is None else object()
+        setattr(obj, attr, state)
+        return state
+
+    def _bind(self, state, objref):
+        # Return the bound method using state; it calls objref() to get obj.
+        func = self._func
+        marker = _MARKER
+        shared = self.cache
+        if shared is None:
+            cache = state
+
+            def method(*args, **kwargs):
+                key = (args, frozenset(kwargs.items())) if kwargs else args
+                val = cache.get(key, marker)
+                if val is marker:
+                    val = func(objref(), *args, **kwargs)
+                    cache.put(key, val)
+                return val
+
+            method.clear = cache.clear
+        else:
+            # The token identifies the entries of obj without referencing it.
+            cache = shared
+            token = state
+            tags = (token,)
+
+            def method(*args, **kwargs):
+                key = (token, args,
+                       frozenset(kwargs.items()) if kwargs else None)
+                val = cache.get(key, marker)
+                if val is marker:
+                    val = func(objref(), *args, **kwargs)
+                    cache.put(key, val, tags=tags)
+                return val
+
+            method.clear = lambda: cache.invalidate_tag(token)
+        method.__name__ = func.__name__
+        method.__doc__ = func.__doc__
+        method._cache = cache
+        return method
+
+
 class CacheMaker(object):
     """Generates decorators that can be cleared later
     """
-    def __init__(self, maxsize=None, timeout=_DEFAULT_TIMEOUT):
+    def __init__(self, maxsize=None, timeout=_DEFAULT_TIMEOUT,
+                 intern_values=False):
         """Create cache decorator factory.
 
         - maxsize : the default size for created caches.
 
         - timeout : the defaut expiraiton time for created caches.
+
+        - intern_values : if true, the created caches share an InternPool
+          (see Cache.intern_values()), except those holding weak references.
         """
         self._maxsize = maxsize
         self._timeout = timeout
         self._cache = {}
+        self.intern_pool = InternPool() if intern_values else None
+        # Numbers the caches created without a name.
+        self._anonymous = count(1)
 
     def _resolve_setting(self, name=None, maxsize=None, timeout=None):
         if name is None:
             while True:
-                name = str(uuid.uuid4())
-                ## the probability of collision is so low ....
-                if name not in self._cache:  # pragma: NO COVER
+                name = 'anonymous-%d' % next(self._anonymous)
+                # Skip names given to other caches explicitly.
+                if name not in self._cache:
                     break
 
         if name in self._cache:
@@ -397,24 +2995,54 @@ class CacheMaker(object):
 
         return name, maxsize, timeout
 
-    def memoized(self, name=None):
-        name, maxsize, _ = self._resolve_setting(name, 0)
-        cache = self._cache[name] = UnboundedCache()
-        return lru_cache(None, cache)
+    def memoized(self, name=None, tags=None, maxsize=None):
+        """Named arguments:
+
+        - name (optional) is a string, and should be unique amongst all caches
+
+        - tags (optional) is an iterable of tags attached to every cached
+          entry, see invalidate_tag()
+
+        - maxsize (optional) is an int, a soft cap on the number of entries
+          (see UnboundedCache). The default value set by the constructor is
+          not used.
+        """
+        name, _, _ = self._resolve_setting(name, 0)
+        cache = self._cache[name] = UnboundedCache(maxsize)
+        self._share_values(cache)
+        return lru_cache(None, cache, tags=tags)
 
-    def lrucache(self, name=None, maxsize=None):
+    def lrucache(self, name=None, maxsize=None, tags=None,
+                 weak_keys=False, weak_values=False):
         """Named arguments:
         
         - name (optional) is a string, and should be unique amongst all caches
 
         - maxsize (optional) is an int, overriding any default value set by
           the constructor
+
+        - tags (optional) is an iterable of tags attached to every cached
+          entry, see invalidate_tag()
+
+        - weak_keys, weak_values (optional) select WeakKeyLRUCache or
+          WeakValueLRUCache, see lru_cache
         """
         name, maxsize, _ = self._resolve_setting(name, maxsize)
-        cache = self._cache[name] = LRUCache(maxsize)
-        return lru_cache(maxsize, cache)
+        if weak_keys and weak_values:
+            raise ValueError(
+                'weak_keys and weak_values are mutually exclusive')
+        if weak_keys:
+            cache = WeakKeyLRUCache(maxsize)
+        elif weak_values:
+            cache = WeakValueLRUCache(maxsize)
+        else:
+            cache = LRUCache(maxsize)
+            self._share_values(cache)
+        self._cache[name] = cache
+        return lru_cache(maxsize, cache, tags=tags)
 
-    def expiring_lrucache(self, name=None, maxsize=None, timeout=None):
+    def expiring_lrucache(self, name=None, maxsize=None, timeout=None,
+                          tags=None, refresh_ahead=None, jitter=None):
         """Named arguments:
 
         - name (optional) is a string, and should be unique amongst all caches
@@ -424,10 +3052,26 @@ class CacheMaker(object):
 
         - timeout (optional) is an int, overriding any default value set by
           the constructor or the default value (%d seconds)
+
+        - tags (optional) is an iterable of tags attached to every cached
+          entry, see invalidate_tag()
+
+        - refresh_ahead (optional) is a fraction of the timeout, see
+          lru_cache
+
+        - jitter (optional) is a fraction of the timeout or a callable,
+          see ExpiringLRUCache
         """ % _DEFAULT_TIMEOUT
         name, maxsize, timeout = self._resolve_setting(name, maxsize, timeout)
-        cache = self._cache[name] = ExpiringLRUCache(maxsize, timeout)
-        return lru_cache(maxsize, cache, timeout)
+        cache = self._cache[name] = ExpiringLRUCache(maxsize, timeout,
+                                                     jitter=jitter)
+        self._share_values(cache)
+        return lru_cache(maxsize, cache, timeout, tags=tags,
+                         refresh_ahead=refresh_ahead)
+
+    def _share_values(self, cache):
+        if self.intern_pool is not None:
+            cache.intern_values(self.intern_pool)
 
     def clear(self, *names):
         """Clear the given cache(s).
@@ -439,3 +3083,33 @@ class CacheMaker(object):
 
         for name in names:
             self._cache[name].clear()
+
+    def invalidate_tag(self, tag):
+        """Remove all entries tagged with tag from all caches."""
+        for cache in list(self._cache.values()):
+            cache.invalidate_tag(tag)
+
+
+def _get_refresh_executor():
+    global _refresh_executor
+    if _refresh_executor is None:
+        with _INIT_LOCK:
+            if _refresh_executor is None:  # pragma: NO BRANCH (lost a race)
+                from concurrent.futures import ThreadPoolExecutor
+                _refresh_executor = ThreadPoolExecutor(_REFRESH_WORKERS)
+    return _refresh_executor
+
+
+def _after_fork_in_child():  # pragma: NO COVER (runs in forked children)
+    global _INIT_LOCK, _refresh_executor
+    _INIT_LOCK = threading.Lock()
+    # Its threads did not survive the fork.
+    _refresh_executor = None
+    _DISPOSER.reinit_after_fork()
+    for cache in list(_CACHES):
+        cache._reinit_after_fork()
+    for cache in list(_WRITE_BEHIND):
+        cache._reinit_after_fork()
+
+if hasattr(os, 'register_at_fork'):  # pragma: NO COVER (Python < 3.7)
+    os.register_at_fork(after_in_child=_after_fork_in_child)
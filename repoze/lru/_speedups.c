@@ -0,0 +1,1010 @@
+/*****************************************************************************
+ *
+ * Copyright (c) 2009 Agendaless Consulting and Contributors.
+ * All Rights Reserved.
+ *
+ * This software is subject to the provisions of the BSD-like license at
+ * http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+ * this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+ * EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+ * THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+ * FITNESS FOR A PARTICULAR PURPOSE
+ *
+ ****************************************************************************/
+
+/* C implementations of the hot paths of repoze.lru.
+ *
+ * UnboundedCacheBase, LRUCacheBase and ExpiringLRUCacheBase only provide
+ * get(); they are mixed into UnboundedCache, LRUCache and ExpiringLRUCache
+ * in front of the pure-Python classes.
+ * The state get() touches is held in slots of the mixin, all other state in
+ * ordinary instance attributes.  CachedWrapper is
+ * the callable returned by lru_cache; it handles hits and leaves misses to
+ * a Python callable.  HashedKeyBase is the base of HashedKey.
+ */
+
+#include "Python.h"
+#include "structmember.h"
+#include <stddef.h>
+
+#if PY_MAJOR_VERSION >= 3
+#define INT_CHECK(o) PyLong_Check(o)
+#define INT_AS_SSIZE_T(o) PyLong_AsSsize_t(o)
+#define INT_FROM_LONG(i) PyLong_FromLong(i)
+#define STR_INTERN(s) PyUnicode_InternFromString(s)
+#define DICT_GET_ITEM(d, k) PyDict_GetItemWithError(d, k)
+#else
+#define INT_CHECK(o) (PyInt_Check(o) || PyLong_Check(o))
+#define INT_AS_SSIZE_T(o) PyNumber_AsSsize_t(o, PyExc_IndexError)
+#define INT_FROM_LONG(i) PyInt_FromLong(i)
+#define STR_INTERN(s) PyString_InternFromString(s)
+/* Swallows errors raised by __hash__ or __eq__ of the key. */
+#define DICT_GET_ITEM(d, k) PyDict_GetItem(d, k)
+#endif
+
+#if PY_VERSION_HEX < 0x03020000
+typedef long Py_hash_t;
+#endif
+
+#ifndef Py_SETREF
+#define Py_SETREF(target, value) do {           \
+        PyObject *_tmp = (PyObject *)(target);  \
+        (target) = (value);                     \
+        Py_DECREF(_tmp);                        \
+    } while (0)
+#endif
+
+/* *target = value, taking a new reference to value */
+#define REPLACE(target, value) do {             \
+        PyObject *_old = (PyObject *)(target);  \
+        Py_INCREF(value);                       \
+        (target) = (value);                     \
+        Py_XDECREF(_old);                       \
+    } while (0)
+
+static PyObject *str_get;
+static PyObject *unbounded_get_descr;
+static PyObject *lru_get_descr;
+static PyObject *expiring_get_descr;
+static PyObject *str_ignore_unhashable_args;
+static PyObject *int_one;
+/* The time module: time.time is looked up on each call, like the pure
+ * Python code does, so that patched clocks are honoured. */
+static PyObject *time_module;
+static PyObject *str_time;
+static PyObject *str_value;
+/* repoze.lru._Compressed, registered by set_compressed_type() */
+static PyObject *compressed_type;
+
+
+/* State shared with the pure-Python classes.  These attributes live in
+ * slots rather than in the instance dict, so that get() can reach them
+ * without going through the attribute protocol.  The attributes after
+ * 'lookups' are only used by put(), in Python: slots are faster to reach
+ * from Python code as well, where the instance dict of a subclass of a C
+ * type is not. */
+typedef struct {
+    PyObject_HEAD
+    PyObject *data;
+    PyObject *clock_refs;
+    PyObject *hits;
+    PyObject *misses;
+    PyObject *lookups;
+    PyObject *clock_keys;
+    PyObject *hand;
+    PyObject *maxpos;
+    PyObject *lock;
+    PyObject *sweep_budget;
+    PyObject *evictions;
+    PyObject *hooked;
+    PyObject *default_timeout;
+    PyObject *jitter;
+} CacheBase;
+
+#define MEMBER(name, field) \
+    {name, T_OBJECT_EX, offsetof(CacheBase, field), 0, NULL}
+#define CACHE_MEMBERS                           \
+    MEMBER("data", data),                       \
+    MEMBER("clock_refs", clock_refs),           \
+    MEMBER("hits", hits),                       \
+    MEMBER("misses", misses),                   \
+    MEMBER("lookups", lookups),                 \
+    MEMBER("clock_keys", clock_keys),           \
+    MEMBER("hand", hand),                       \
+    MEMBER("maxpos", maxpos),                   \
+    MEMBER("lock", lock),                       \
+    MEMBER("sweep_budget", sweep_budget),       \
+    MEMBER("evictions", evictions),             \
+    MEMBER("_hooked", hooked)
+
+static PyMemberDef cache_members[] = {
+    CACHE_MEMBERS,
+    {NULL}
+};
+
+/* UnboundedCache keeps its dict in '_data' and has no clock. */
+static PyMemberDef unbounded_members[] = {
+    MEMBER("_data", data),
+    MEMBER("hits", hits),
+    MEMBER("misses", misses),
+    MEMBER("lookups", lookups),
+    MEMBER("evictions", evictions),
+    MEMBER("_hooked", hooked),
+    {NULL}
+};
+
+static PyMemberDef expiring_members[] = {
+    CACHE_MEMBERS,
+    MEMBER("default_timeout", default_timeout),
+    MEMBER("jitter", jitter),
+    {NULL}
+};
+
+static int
+cache_traverse(CacheBase *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->data);
+    Py_VISIT(self->clock_refs);
+    Py_VISIT(self->hits);
+    Py_VISIT(self->misses);
+    Py_VISIT(self->lookups);
+    Py_VISIT(self->clock_keys);
+    Py_VISIT(self->hand);
+    Py_VISIT(self->maxpos);
+    Py_VISIT(self->lock);
+    Py_VISIT(self->sweep_budget);
+    Py_VISIT(self->evictions);
+    Py_VISIT(self->hooked);
+    Py_VISIT(self->default_timeout);
+    Py_VISIT(self->jitter);
+    return 0;
+}
+
+static int
+cache_clear(CacheBase *self)
+{
+    Py_CLEAR(self->data);
+    Py_CLEAR(self->clock_refs);
+    Py_CLEAR(self->hits);
+    Py_CLEAR(self->misses);
+    Py_CLEAR(self->lookups);
+    Py_CLEAR(self->clock_keys);
+    Py_CLEAR(self->hand);
+    Py_CLEAR(self->maxpos);
+    Py_CLEAR(self->lock);
+    Py_CLEAR(self->sweep_budget);
+    Py_CLEAR(self->evictions);
+    Py_CLEAR(self->hooked);
+    Py_CLEAR(self->default_timeout);
+    Py_CLEAR(self->jitter);
+    return 0;
+}
+
+static void
+cache_dealloc(CacheBase *self)
+{
+    PyObject_GC_UnTrack(self);
+    cache_clear(self);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+/* Check that a slot is set, raising AttributeError otherwise */
+static int
+check_slot(PyObject *value, const char *name)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, name);
+        return -1;
+    }
+    return 0;
+}
+
+/* *counter += 1 */
+static int
+increment(PyObject **counter, const char *name)
+{
+    PyObject *result;
+
+    if (check_slot(*counter, name) < 0)
+        return -1;
+    result = PyNumber_Add(*counter, int_one);
+    if (result == NULL)
+        return -1;
+    Py_SETREF(*counter, result);
+    return 0;
+}
+
+/* self.clock_refs[pos] = flag */
+static int
+set_ref(CacheBase *self, PyObject *pos, PyObject *flag)
+{
+    PyObject *refs = self->clock_refs;
+    int status;
+
+    if (check_slot(refs, "clock_refs") < 0)
+        return -1;
+    if (PyList_CheckExact(refs) && INT_CHECK(pos)) {
+        Py_ssize_t index = INT_AS_SSIZE_T(pos);
+        if (index >= 0 && index < PyList_GET_SIZE(refs)) {
+            Py_INCREF(flag);
+            return PyList_SetItem(refs, index, flag);
+        }
+        if (index == -1 && PyErr_Occurred())
+            return -1;
+    }
+    Py_INCREF(refs);
+    status = PyObject_SetItem(refs, pos, flag);
+    Py_DECREF(refs);
+    return status;
+}
+
+/* Return a new reference to self.data[key] and set *found, or return NULL
+ * with *found == 0 on KeyError, or NULL with an exception set. */
+static PyObject *
+lookup(CacheBase *self, PyObject *key, int *found)
+{
+    PyObject *data = self->data, *entry;
+
+    *found = 0;
+    if (check_slot(data, "data") < 0)
+        return NULL;
+    /* The __eq__ of a key may replace self.data, dropping the last
+     * reference to the dict being searched. */
+    if (PyDict_CheckExact(data)) {
+        Py_INCREF(data);
+        entry = DICT_GET_ITEM(data, key);
+        Py_XINCREF(entry);
+        Py_DECREF(data);
+    }
+    else {
+        Py_INCREF(data);
+        entry = PyObject_GetItem(data, key);
+        Py_DECREF(data);
+    }
+    if (entry == NULL) {
+        if (PyErr_Occurred()) {
+            if (!PyErr_ExceptionMatches(PyExc_KeyError))
+                return NULL;
+            PyErr_Clear();
+        }
+        return NULL;
+    }
+    *found = 1;
+    return entry;
+}
+
+/* Return val, or its decompressed value if it is stored compressed.
+ * Steals the reference to val. */
+static PyObject *
+decoded(PyObject *val)
+{
+    PyObject *result;
+
+    if (compressed_type == NULL ||
+        (PyObject *)Py_TYPE(val) != compressed_type)
+        return val;
+    result = PyObject_CallMethodObjArgs(val, str_value, NULL);
+    Py_DECREF(val);
+    return result;
+}
+
+static PyObject *
+unpack_error(PyObject *entry, Py_ssize_t expected)
+{
+    PyErr_Format(PyExc_ValueError,
+                 "cache entry must be a tuple of %zd items", expected);
+    Py_DECREF(entry);
+    return NULL;
+}
+
+static char *get_kwlist[] = {"key", "default", NULL};
+
+/* Parse (key, default=None) */
+static int
+parse_get_args(PyObject *args, PyObject *kwargs, PyObject **key,
+               PyObject **dflt)
+{
+    Py_ssize_t nargs = PyTuple_GET_SIZE(args);
+
+    *dflt = Py_None;
+    if (kwargs == NULL && (nargs == 1 || nargs == 2)) {
+        *key = PyTuple_GET_ITEM(args, 0);
+        if (nargs == 2)
+            *dflt = PyTuple_GET_ITEM(args, 1);
+        return 1;
+    }
+    return PyArg_ParseTupleAndKeywords(args, kwargs, "O|O:get", get_kwlist,
+                                       key, dflt);
+}
+
+static PyObject *
+unbounded_get_impl(CacheBase *self, PyObject *key, PyObject *dflt)
+{
+    PyObject *val;
+    int found;
+
+    if (increment(&self->lookups, "lookups") < 0)
+        return NULL;
+    val = lookup(self, key, &found);
+    if (!found) {
+        if (PyErr_Occurred() || increment(&self->misses, "misses") < 0)
+            return NULL;
+        Py_INCREF(dflt);
+        return dflt;
+    }
+    if (increment(&self->hits, "hits") < 0) {
+        Py_DECREF(val);
+        return NULL;
+    }
+    return decoded(val);
+}
+
+static PyObject *
+lru_get_impl(CacheBase *self, PyObject *key, PyObject *dflt)
+{
+    PyObject *entry, *val;
+    int found;
+
+    if (increment(&self->lookups, "lookups") < 0)
+        return NULL;
+    entry = lookup(self, key, &found);
+    if (!found) {
+        if (PyErr_Occurred() || increment(&self->misses, "misses") < 0)
+            return NULL;
+        Py_INCREF(dflt);
+        return dflt;
+    }
+    if (!PyTuple_Check(entry) || PyTuple_GET_SIZE(entry) != 2)
+        return unpack_error(entry, 2);
+    if (increment(&self->hits, "hits") < 0 ||
+        set_ref(self, PyTuple_GET_ITEM(entry, 0), Py_True) < 0) {
+        Py_DECREF(entry);
+        return NULL;
+    }
+    val = PyTuple_GET_ITEM(entry, 1);
+    Py_INCREF(val);
+    Py_DECREF(entry);
+    return decoded(val);
+}
+
+static PyObject *
+expiring_get_impl(CacheBase *self, PyObject *key, PyObject *dflt)
+{
+    PyObject *entry, *val, *now;
+    int found, valid;
+
+    if (increment(&self->lookups, "lookups") < 0)
+        return NULL;
+    entry = lookup(self, key, &found);
+    if (!found) {
+        if (PyErr_Occurred() || increment(&self->misses, "misses") < 0)
+            return NULL;
+        Py_INCREF(dflt);
+        return dflt;
+    }
+    if (!PyTuple_Check(entry) || PyTuple_GET_SIZE(entry) != 3)
+        return unpack_error(entry, 3);
+    now = PyObject_CallMethodObjArgs(time_module, str_time, NULL);
+    if (now == NULL) {
+        Py_DECREF(entry);
+        return NULL;
+    }
+    valid = PyObject_RichCompareBool(PyTuple_GET_ITEM(entry, 2), now, Py_GT);
+    Py_DECREF(now);
+    if (valid < 0) {
+        Py_DECREF(entry);
+        return NULL;
+    }
+    if (valid) {
+        /* cache entry still valid */
+        if (increment(&self->hits, "hits") < 0 ||
+            set_ref(self, PyTuple_GET_ITEM(entry, 0), Py_True) < 0) {
+            Py_DECREF(entry);
+            return NULL;
+        }
+        val = PyTuple_GET_ITEM(entry, 1);
+        Py_INCREF(val);
+        Py_DECREF(entry);
+        return decoded(val);
+    }
+    /* cache entry has expired. Make sure the space in the cache can be
+     * recycled soon. */
+    if (increment(&self->misses, "misses") < 0 ||
+        set_ref(self, PyTuple_GET_ITEM(entry, 0), Py_False) < 0) {
+        Py_DECREF(entry);
+        return NULL;
+    }
+    Py_DECREF(entry);
+    Py_INCREF(dflt);
+    return dflt;
+}
+
+typedef PyObject *(*get_impl)(CacheBase *, PyObject *, PyObject *);
+
+PyDoc_STRVAR(lru_get_doc,
+"Return value for key. If not in cache, return default");
+
+static PyObject *
+unbounded_get(CacheBase *self, PyObject *args, PyObject *kwargs)
+{
+    PyObject *key, *dflt;
+
+    if (!parse_get_args(args, kwargs, &key, &dflt))
+        return NULL;
+    return unbounded_get_impl(self, key, dflt);
+}
+
+static PyObject *
+lru_get(CacheBase *self, PyObject *args, PyObject *kwargs)
+{
+    PyObject *key, *dflt;
+
+    if (!parse_get_args(args, kwargs, &key, &dflt))
+        return NULL;
+    return lru_get_impl(self, key, dflt);
+}
+
+PyDoc_STRVAR(expiring_get_doc,
+"Return value for key. If not in cache or expired, return default");
+
+static PyObject *
+expiring_get(CacheBase *self, PyObject *args, PyObject *kwargs)
+{
+    PyObject *key, *dflt;
+
+    if (!parse_get_args(args, kwargs, &key, &dflt))
+        return NULL;
+    return expiring_get_impl(self, key, dflt);
+}
+
+static PyMethodDef unbounded_methods[] = {
+    {"get", (PyCFunction)unbounded_get, METH_VARARGS | METH_KEYWORDS,
+     lru_get_doc},
+    {NULL, NULL}
+};
+
+static PyMethodDef lru_methods[] = {
+    {"get", (PyCFunction)lru_get, METH_VARARGS | METH_KEYWORDS, lru_get_doc},
+    {NULL, NULL}
+};
+
+static PyMethodDef expiring_methods[] = {
+    {"get", (PyCFunction)expiring_get, METH_VARARGS | METH_KEYWORDS,
+     expiring_get_doc},
+    {NULL, NULL}
+};
+
+static PyTypeObject UnboundedCacheBaseType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "repoze.lru._speedups.UnboundedCacheBase", /* tp_name */
+    sizeof(CacheBase),                      /* tp_basicsize */
+};
+
+static PyTypeObject LRUCacheBaseType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "repoze.lru._speedups.LRUCacheBase",    /* tp_name */
+    sizeof(CacheBase),                      /* tp_basicsize */
+};
+
+static PyTypeObject ExpiringLRUCacheBaseType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "repoze.lru._speedups.ExpiringLRUCacheBase", /* tp_name */
+    sizeof(CacheBase),                      /* tp_basicsize */
+};
+
+
+/* HashedKeyBase
+ *
+ * A tuple subtype storing its hash after the items, so that keys do not
+ * need an instance dict to hold it.
+ */
+
+static PyTypeObject HashedKeyBaseType;
+
+#define HASHED_KEY_HASH(op)                                             \
+    (*(Py_hash_t *)((char *)(op) + PyTuple_Type.tp_basicsize +          \
+                    Py_SIZE(op) * sizeof(PyObject *)))
+
+/* type(items), hashing the items once */
+static PyObject *
+hashed_key_build(PyTypeObject *type, PyObject *items)
+{
+    PyObject *tuple, *self, *item;
+    Py_ssize_t i, n;
+    Py_hash_t hash;
+
+    tuple = PySequence_Tuple(items);
+    if (tuple == NULL)
+        return NULL;
+    hash = PyObject_Hash(tuple);
+    if (hash == -1) {
+        Py_DECREF(tuple);
+        return NULL;
+    }
+    n = PyTuple_GET_SIZE(tuple);
+    self = type->tp_alloc(type, n);
+    if (self != NULL) {
+        for (i = 0; i < n; i++) {
+            item = PyTuple_GET_ITEM(tuple, i);
+            Py_INCREF(item);
+            PyTuple_SET_ITEM(self, i, item);
+        }
+        HASHED_KEY_HASH(self) = hash;
+    }
+    Py_DECREF(tuple);
+    return self;
+}
+
+static PyObject *
+hashed_key_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"items", NULL};
+    PyObject *items = NULL, *self;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O:HashedKey", kwlist,
+                                     &items))
+        return NULL;
+    if (items != NULL)
+        return hashed_key_build(type, items);
+    items = PyTuple_New(0);
+    if (items == NULL)
+        return NULL;
+    self = hashed_key_build(type, items);
+    Py_DECREF(items);
+    return self;
+}
+
+static Py_hash_t
+hashed_key_hash(PyObject *self)
+{
+    return HASHED_KEY_HASH(self);
+}
+
+/* String hashes differ between processes: hash again on load. */
+static PyObject *
+hashed_key_reduce(PyObject *self)
+{
+    PyObject *items;
+
+    items = PyTuple_GetSlice(self, 0, PyTuple_GET_SIZE(self));
+    if (items == NULL)
+        return NULL;
+    return Py_BuildValue("(O(N))", Py_TYPE(self), items);
+}
+
+static PyObject *
+hashed_key_get_hashvalue(PyObject *self, void *closure)
+{
+#if PY_MAJOR_VERSION >= 3
+    return PyLong_FromSsize_t(HASHED_KEY_HASH(self));
+#else
+    return PyInt_FromLong(HASHED_KEY_HASH(self));
+#endif
+}
+
+static PyMethodDef hashed_key_methods[] = {
+    {"__reduce__", (PyCFunction)hashed_key_reduce, METH_NOARGS, NULL},
+    {NULL, NULL}
+};
+
+static PyGetSetDef hashed_key_getset[] = {
+    {"hashvalue", (getter)hashed_key_get_hashvalue, NULL, NULL, NULL},
+    {NULL}
+};
+
+static PyTypeObject HashedKeyBaseType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "repoze.lru._speedups.HashedKeyBase",   /* tp_name */
+};
+
+
+/* CachedWrapper */
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *func;
+    PyObject *cache;
+    PyObject *miss;
+    PyObject *marker;
+    PyObject *decorator;
+    PyObject *key_type;
+    PyObject *dict;
+    PyObject *weakreflist;
+} CachedWrapper;
+
+static int
+wrapper_init(CachedWrapper *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"func", "cache", "miss", "marker", "decorator",
+                             "key_type", NULL};
+    PyObject *func, *cache, *miss, *marker, *decorator;
+    PyObject *key_type = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOOOO|O:CachedWrapper",
+                                     kwlist, &func, &cache, &miss, &marker,
+                                     &decorator, &key_type))
+        return -1;
+    REPLACE(self->func, func);
+    REPLACE(self->cache, cache);
+    REPLACE(self->miss, miss);
+    REPLACE(self->marker, marker);
+    REPLACE(self->decorator, decorator);
+    REPLACE(self->key_type, key_type);
+    return 0;
+}
+
+static int
+wrapper_traverse(CachedWrapper *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->func);
+    Py_VISIT(self->cache);
+    Py_VISIT(self->miss);
+    Py_VISIT(self->marker);
+    Py_VISIT(self->decorator);
+    Py_VISIT(self->key_type);
+    Py_VISIT(self->dict);
+    return 0;
+}
+
+static int
+wrapper_clear(CachedWrapper *self)
+{
+    Py_CLEAR(self->func);
+    Py_CLEAR(self->cache);
+    Py_CLEAR(self->miss);
+    Py_CLEAR(self->marker);
+    Py_CLEAR(self->decorator);
+    Py_CLEAR(self->key_type);
+    Py_CLEAR(self->dict);
+    return 0;
+}
+
+static void
+wrapper_dealloc(CachedWrapper *self)
+{
+    PyObject_GC_UnTrack(self);
+    if (self->weakreflist != NULL)
+        PyObject_ClearWeakRefs((PyObject *)self);
+    wrapper_clear(self);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+/* key = (args, frozenset(kwargs.items())) if kwargs else args */
+static PyObject *
+make_key(PyObject *args, PyObject *kwargs)
+{
+    PyObject *items, *frozen, *key;
+
+    if (kwargs == NULL || PyDict_Size(kwargs) == 0) {
+        Py_INCREF(args);
+        return args;
+    }
+    items = PyDict_Items(kwargs);
+    if (items == NULL)
+        return NULL;
+    frozen = PyFrozenSet_New(items);
+    Py_DECREF(items);
+    if (frozen == NULL)
+        return NULL;
+    key = PyTuple_Pack(2, args, frozen);
+    Py_DECREF(frozen);
+    return key;
+}
+
+/* cache.get(key, dflt), calling the C implementation directly unless get()
+ * is overridden by a subclass or shadowed on the instance. */
+static PyObject *
+cache_get(PyObject *cache, PyObject *key, PyObject *dflt)
+{
+    PyObject *descr, **dictptr;
+    get_impl impl;
+
+    descr = _PyType_Lookup(Py_TYPE(cache), str_get);
+    if (descr != NULL && descr == unbounded_get_descr)
+        impl = unbounded_get_impl;
+    else if (descr != NULL && descr == lru_get_descr)
+        impl = lru_get_impl;
+    else if (descr != NULL && descr == expiring_get_descr)
+        impl = expiring_get_impl;
+    else
+        return PyObject_CallMethodObjArgs(cache, str_get, key, dflt, NULL);
+    dictptr = _PyObject_GetDictPtr(cache);
+    if (dictptr != NULL && *dictptr != NULL &&
+        PyDict_GetItem(*dictptr, str_get) != NULL)
+        return PyObject_CallMethodObjArgs(cache, str_get, key, dflt, NULL);
+    return impl((CacheBase *)cache, key, dflt);
+}
+
+static PyObject *
+wrapper_call(CachedWrapper *self, PyObject *args, PyObject *kwargs)
+{
+    PyObject *key, *val, *ignore, *miss_args;
+    PyObject *exc_type, *exc_value, *exc_tb;
+    int ignore_unhashable;
+
+    key = make_key(args, kwargs);
+    if (key != NULL && self->key_type != Py_None) {
+        /* key = key_type(key), e.g. a HashedKey */
+        if (PyType_Check(self->key_type) &&
+            PyType_IsSubtype((PyTypeObject *)self->key_type,
+                             &HashedKeyBaseType))
+            Py_SETREF(key, hashed_key_build((PyTypeObject *)self->key_type,
+                                            key));
+        else
+            Py_SETREF(key, PyObject_CallFunctionObjArgs(self->key_type, key,
+                                                        NULL));
+    }
+    if (key == NULL) {
+        if (!PyErr_ExceptionMatches(PyExc_TypeError))
+            return NULL;
+        /* The attribute lookup must not run with the TypeError pending */
+        PyErr_Fetch(&exc_type, &exc_value, &exc_tb);
+        ignore = PyObject_GetAttr(self->decorator,
+                                  str_ignore_unhashable_args);
+        ignore_unhashable = -1;
+        if (ignore != NULL) {
+            ignore_unhashable = PyObject_IsTrue(ignore);
+            Py_DECREF(ignore);
+        }
+        if (ignore_unhashable < 0) {
+            Py_XDECREF(exc_type);
+            Py_XDECREF(exc_value);
+            Py_XDECREF(exc_tb);
+            return NULL;
+        }
+        if (ignore_unhashable == 0) {
+            PyErr_Restore(exc_type, exc_value, exc_tb);
+            return NULL;  /* re-raise the TypeError */
+        }
+        Py_XDECREF(exc_type);
+        Py_XDECREF(exc_value);
+        Py_XDECREF(exc_tb);
+        return PyObject_Call(self->func, args, kwargs);
+    }
+    val = cache_get(self->cache, key, self->marker);
+    if (val == NULL || val != self->marker) {
+        Py_DECREF(key);
+        return val;
+    }
+    Py_DECREF(val);
+    if (kwargs == NULL)
+        miss_args = Py_BuildValue("(OON)", key, args, PyDict_New());
+    else
+        miss_args = PyTuple_Pack(3, key, args, kwargs);
+    Py_DECREF(key);
+    if (miss_args == NULL)
+        return NULL;
+    val = PyObject_CallObject(self->miss, miss_args);
+    Py_DECREF(miss_args);
+    return val;
+}
+
+/* Bind like a function when used as a method */
+static PyObject *
+wrapper_descr_get(PyObject *self, PyObject *obj, PyObject *type)
+{
+    if (obj == NULL || obj == Py_None) {
+        Py_INCREF(self);
+        return self;
+    }
+#if PY_MAJOR_VERSION >= 3
+    return PyMethod_New(self, obj);
+#else
+    return PyMethod_New(self, obj, type);
+#endif
+}
+
+static PyObject *
+wrapper_get_dict(CachedWrapper *self, void *closure)
+{
+    if (self->dict == NULL) {
+        self->dict = PyDict_New();
+        if (self->dict == NULL)
+            return NULL;
+    }
+    Py_INCREF(self->dict);
+    return self->dict;
+}
+
+static PyGetSetDef wrapper_getset[] = {
+    {"__dict__", (getter)wrapper_get_dict, NULL, NULL, NULL},
+    {NULL}
+};
+
+static PyTypeObject CachedWrapperType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "repoze.lru._speedups.CachedWrapper",   /* tp_name */
+    sizeof(CachedWrapper),                  /* tp_basicsize */
+};
+
+
+static int
+init_types(void)
+{
+    UnboundedCacheBaseType.tp_flags =
+        Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC;
+    UnboundedCacheBaseType.tp_members = unbounded_members;
+    UnboundedCacheBaseType.tp_traverse = (traverseproc)cache_traverse;
+    UnboundedCacheBaseType.tp_clear = (inquiry)cache_clear;
+    UnboundedCacheBaseType.tp_dealloc = (destructor)cache_dealloc;
+    UnboundedCacheBaseType.tp_doc =
+        "Mixin providing UnboundedCache.get() and the state it uses";
+    UnboundedCacheBaseType.tp_methods = unbounded_methods;
+    UnboundedCacheBaseType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&UnboundedCacheBaseType) < 0)
+        return -1;
+
+    LRUCacheBaseType.tp_flags =
+        Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC;
+    LRUCacheBaseType.tp_members = cache_members;
+    LRUCacheBaseType.tp_traverse = (traverseproc)cache_traverse;
+    LRUCacheBaseType.tp_clear = (inquiry)cache_clear;
+    LRUCacheBaseType.tp_dealloc = (destructor)cache_dealloc;
+    LRUCacheBaseType.tp_doc = "Mixin providing LRUCache.get() and the state it uses";
+    LRUCacheBaseType.tp_methods = lru_methods;
+    LRUCacheBaseType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&LRUCacheBaseType) < 0)
+        return -1;
+
+    ExpiringLRUCacheBaseType.tp_flags =
+        Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC;
+    ExpiringLRUCacheBaseType.tp_members = expiring_members;
+    ExpiringLRUCacheBaseType.tp_traverse = (traverseproc)cache_traverse;
+    ExpiringLRUCacheBaseType.tp_clear = (inquiry)cache_clear;
+    ExpiringLRUCacheBaseType.tp_dealloc = (destructor)cache_dealloc;
+    ExpiringLRUCacheBaseType.tp_doc = 
+        "Mixin providing ExpiringLRUCache.get() and the state it uses";
+    ExpiringLRUCacheBaseType.tp_methods = expiring_methods;
+    ExpiringLRUCacheBaseType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&ExpiringLRUCacheBaseType) < 0)
+        return -1;
+    unbounded_get_descr = PyDict_GetItem(UnboundedCacheBaseType.tp_dict,
+                                         str_get);
+    lru_get_descr = PyDict_GetItem(LRUCacheBaseType.tp_dict, str_get);
+    expiring_get_descr = PyDict_GetItem(ExpiringLRUCacheBaseType.tp_dict,
+                                        str_get);
+
+    /* Items as in a tuple, followed by the hash */
+    HashedKeyBaseType.tp_basicsize =
+        PyTuple_Type.tp_basicsize + sizeof(Py_hash_t);
+    HashedKeyBaseType.tp_itemsize = sizeof(PyObject *);
+    HashedKeyBaseType.tp_base = &PyTuple_Type;
+    HashedKeyBaseType.tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE;
+    HashedKeyBaseType.tp_doc = "Tuple keeping its hash, base of HashedKey";
+    HashedKeyBaseType.tp_new = hashed_key_new;
+    HashedKeyBaseType.tp_hash = hashed_key_hash;
+    /* Not inherited along with tp_hash otherwise */
+    HashedKeyBaseType.tp_richcompare = PyTuple_Type.tp_richcompare;
+    HashedKeyBaseType.tp_methods = hashed_key_methods;
+    HashedKeyBaseType.tp_getset = hashed_key_getset;
+    if (PyType_Ready(&HashedKeyBaseType) < 0)
+        return -1;
+
+    CachedWrapperType.tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC;
+    CachedWrapperType.tp_doc =
+        "CachedWrapper(func, cache, miss, marker, decorator, "
+        "key_type=None)\n\n"
+        "Look up calls in cache; call miss(key, args, kwargs) on misses.\n"
+        "If key_type is not None, keys are built as key_type(key).";
+    CachedWrapperType.tp_init = (initproc)wrapper_init;
+    CachedWrapperType.tp_new = PyType_GenericNew;
+    CachedWrapperType.tp_dealloc = (destructor)wrapper_dealloc;
+    CachedWrapperType.tp_traverse = (traverseproc)wrapper_traverse;
+    CachedWrapperType.tp_clear = (inquiry)wrapper_clear;
+    CachedWrapperType.tp_call = (ternaryfunc)wrapper_call;
+    CachedWrapperType.tp_descr_get = wrapper_descr_get;
+    CachedWrapperType.tp_getset = wrapper_getset;
+    CachedWrapperType.tp_dictoffset = offsetof(CachedWrapper, dict);
+    CachedWrapperType.tp_weaklistoffset = offsetof(CachedWrapper,
+                                                   weakreflist);
+    if (PyType_Ready(&CachedWrapperType) < 0)
+        return -1;
+    return 0;
+}
+
+static int
+init_constants(void)
+{
+    if (!(str_get = STR_INTERN("get")) ||
+        !(str_ignore_unhashable_args =
+              STR_INTERN("_ignore_unhashable_args")) ||
+        !(str_value = STR_INTERN("value")) ||
+        !(str_time = STR_INTERN("time")) ||
+        !(int_one = INT_FROM_LONG(1)))
+        return -1;
+    time_module = PyImport_ImportModule("time");
+    if (time_module == NULL)
+        return -1;
+    return 0;
+}
+
+static int
+add_types(PyObject *module)
+{
+    Py_INCREF(&UnboundedCacheBaseType);
+    if (PyModule_AddObject(module, "UnboundedCacheBase",
+                           (PyObject *)&UnboundedCacheBaseType) < 0)
+        return -1;
+    Py_INCREF(&LRUCacheBaseType);
+    if (PyModule_AddObject(module, "LRUCacheBase",
+                           (PyObject *)&LRUCacheBaseType) < 0)
+        return -1;
+    Py_INCREF(&ExpiringLRUCacheBaseType);
+    if (PyModule_AddObject(module, "ExpiringLRUCacheBase",
+                           (PyObject *)&ExpiringLRUCacheBaseType) < 0)
+        return -1;
+    Py_INCREF(&HashedKeyBaseType);
+    if (PyModule_AddObject(module, "HashedKeyBase",
+                           (PyObject *)&HashedKeyBaseType) < 0)
+        return -1;
+    Py_INCREF(&CachedWrapperType);
+    if (PyModule_AddObject(module, "CachedWrapper",
+                           (PyObject *)&CachedWrapperType) < 0)
+        return -1;
+    return 0;
+}
+
+PyDoc_STRVAR(set_compressed_type_doc,
+"Set the type of values that get() decompresses");
+
+static PyObject *
+set_compressed_type(PyObject *module, PyObject *type)
+{
+    if (!PyType_Check(type)) {
+        PyErr_SetString(PyExc_TypeError, "expected a type");
+        return NULL;
+    }
+    REPLACE(compressed_type, type);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef module_methods[] = {
+    {"set_compressed_type", (PyCFunction)set_compressed_type, METH_O,
+     set_compressed_type_doc},
+    {NULL, NULL}
+};
+
+PyDoc_STRVAR(module_doc, "C implementations of the hot paths of repoze.lru");
+
+#if PY_MAJOR_VERSION >= 3
+
+static struct PyModuleDef moduledef = {
+    PyModuleDef_HEAD_INIT,
+    "_speedups",
+    module_doc,
+    -1,
+    module_methods,
+};
+
+PyMODINIT_FUNC
+PyInit__speedups(void)
+{
+    PyObject *module;
+
+    if (init_constants() < 0 || init_types() < 0)
+        return NULL;
+    module = PyModule_Create(&moduledef);
+    if (module == NULL)
+        return NULL;
+    if (add_types(module) < 0) {
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
+
+#else
+
+PyMODINIT_FUNC
+init_speedups(void)
+{
+    PyObject *module;
+
+    if (init_constants() < 0 || init_types() < 0)
+        return;
+    module = Py_InitModule3("_speedups", module_methods, module_doc);
+    if (module != NULL)
+        add_types(module);
+}
+
+#endif
@@ -0,0 +1,153 @@
+""" Event log for debugging cache churn
+
+EventLog records get hits and misses, puts, evictions and expirations of a
+cache into a bounded ring buffer, with timestamps. Events can be drained as
+a generator, or dumped to a file in a compact binary format and read back
+with load().
+
+Sampling is by key hash, as in repoze.lru.simulator: all events of a
+sampled key are recorded, so its whole history can be followed.
+"""
+from collections import deque
+import hashlib
+import struct
+import time
+
+from repoze.lru import _MARKER
+from repoze.lru import ExpiringLRUCachePy
+from repoze.lru.simulator import _sample_threshold
+from repoze.lru.simulator import _sampled
+
+KINDS = ('hit', 'miss', 'put', 'evict', 'expire')
+_CODES = dict((kind, code) for code, kind in enumerate(KINDS))
+
+# File header, and one record per event: timestamp, kind, key digest.
+_MAGIC = b'RLRUEV2\n'
+_RECORD = struct.Struct('<dBq')
+_DIGEST = struct.Struct('<q')
+
+
+def key_digest(key):
+    """Return the 64-bit digest of key stored by EventLog.dump()
+
+    It is taken from repr(key), so unlike hash(key) for strings it is the
+    same in every process.
+    """
+    digest = hashlib.sha1(repr(key).encode('utf-8')).digest()
+    return _DIGEST.unpack(digest[:_DIGEST.size])[0]
+
+
+class EventLog(object):
+    """ Record cache events into a ring buffer of at most capacity events
+
+    cache is an UnboundedCache, LRUCache or ExpiringLRUCache, or a function
+    decorated with lru_cache. Events are (timestamp, kind, key) tuples, kind
+    being one of KINDS. Once the buffer is full, the oldest events are
+    dropped.
+
+    While recording, get() and put() of the cache are shadowed by instance
+    attributes, like TraceRecorder does; a cache that is not recorded pays
+    nothing for this feature. Expirations are seen by get() and by
+    ExpiringLRUCache.put() and purge_expired().
+
+    Use as a context manager, or call start() and stop().
+    """
+    def __init__(self, cache, capacity=65536, sample_rate=1.0):
+        if capacity < 1:
+            raise ValueError('capacity must be >0')
+        self.cache = getattr(cache, '_cache', cache)
+        self.sample_rate = sample_rate
+        self.events = deque(maxlen=capacity)
+        # Number of events recorded, including those dropped since.
+        self.recorded = 0
+        self._threshold = _sample_threshold(sample_rate)
+
+    def __len__(self):
+        return len(self.events)
+
+    def record(self, kind, key):
+        """Record an event for key, if key is sampled"""
+        if _sampled(key, self._threshold):
+            self.events.append((time.time(), kind, key))
+            self.recorded += 1
+
+    def start(self):
+        cache = self.cache
+        if 'get' in cache.__dict__ or 'put' in cache.__dict__:
+            raise ValueError('cache is already being recorded')
+        get = cache.get
+        put = cache.put
+        record = self.record
+        expiring = isinstance(cache, ExpiringLRUCachePy)
+
+        def recording_get(key, default=None):
+            val = get(key, _MARKER)
+            if val is not _MARKER:
+                record('hit', key)
+                return val
+            if expiring and key in cache.data:
+                # Expired entries stay until their slot is reused.
+                record('expire', key)
+            else:
+                record('miss', key)
+            return default
+
+        def recording_put(key, val, *args, **kw):
+            record('put', key)
+            return put(key, val, *args, **kw)
+
+        cache.get = recording_get
+        cache.put = recording_put
+        cache._event_log = self
+        cache._update_hooks()
+
+    def stop(self):
+        cache = self.cache
+        cache.__dict__.pop('get', None)
+        cache.__dict__.pop('put', None)
+        cache.__dict__.pop('_event_log', None)
+        cache._update_hooks()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def drain(self):
+        """Remove and yield the recorded events, oldest first"""
+        popleft = self.events.popleft
+        while True:
+            try:
+                yield popleft()
+            except IndexError:
+                return
+
+    def dump(self, fileobj):
+        """Drain the events into fileobj, a binary file
+
+        Keys are stored as their key_digest(), so that dumps of different
+        processes can be compared. Return the number of events written.
+        """
+        pack = _RECORD.pack
+        fileobj.write(_MAGIC)
+        count = 0
+        for timestamp, kind, key in self.drain():
+            fileobj.write(pack(timestamp, _CODES[kind], key_digest(key)))
+            count += 1
+        return count
+
+
+def load(fileobj):
+    """Yield the (timestamp, kind, key digest) events dumped into fileobj"""
+    if fileobj.read(len(_MAGIC)) != _MAGIC:
+        raise ValueError('not an event log dump')
+    size = _RECORD.size
+    unpack = _RECORD.unpack
+    while True:
+        record = fileobj.read(size)
+        if len(record) < size:
+            return
+        timestamp, code, digest = unpack(record)
+        yield timestamp, KINDS[code], digest
@@ -0,0 +1,168 @@
+""" Cache size advisor: key trace sampling and miss-ratio curves
+
+Record a sampled key trace from a live cache with TraceRecorder, then compute
+the miss ratio for many cache sizes at once with miss_ratio_curve() and pick
+a size with suggest_size().
+
+Sampling is spatial, as in SHARDS: a key is either always or never recorded,
+depending on its hash. A trace sampled at rate R behaves like the full trace
+run against caches R times smaller, so distances and sizes are scaled by R.
+
+The curve uses LRU stack distances, which CLOCK approximates; use
+clock_miss_ratio() to replay a trace against a real LRUCache.
+"""
+from bisect import bisect_left
+
+from repoze.lru import _MARKER
+from repoze.lru import LRUCache
+
+# Sampling takes 24 bits of a multiplicative hash of the key.
+_SAMPLE_BITS = 24
+_SAMPLE_MODULUS = 1 << _SAMPLE_BITS
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_HASH_MASK = (1 << 64) - 1
+
+
+def _sample_threshold(sample_rate):
+    if not 0 < sample_rate <= 1:
+        raise ValueError('sample_rate must be >0 and <=1')
+    return int(sample_rate * _SAMPLE_MODULUS)
+
+
+def _sampled(key, threshold):
+    spread = (hash(key) * _HASH_MULTIPLIER) & _HASH_MASK
+    return spread >> (64 - _SAMPLE_BITS) < threshold
+
+
+class TraceRecorder(object):
+    """ Record the keys looked up in a cache, sampled by key hash
+
+    cache is an LRUCache, ExpiringLRUCache or UnboundedCache, or a function
+    decorated with lru_cache. While recording, get() of the cache is
+    shadowed by an instance attribute; the class, and thus other caches, are
+    not affected. Recording stops silently once maxlen keys are recorded.
+
+    Use as a context manager, or call start() and stop().
+    """
+    def __init__(self, cache, sample_rate=0.01, maxlen=1000000):
+        self.cache = getattr(cache, '_cache', cache)
+        self.sample_rate = sample_rate
+        self.maxlen = maxlen
+        self.trace = []
+        self._threshold = _sample_threshold(sample_rate)
+
+    def start(self):
+        cache = self.cache
+        if 'get' in cache.__dict__:
+            raise ValueError('cache is already being recorded')
+        get = cache.get
+        append = self.trace.append
+        trace = self.trace
+        threshold = self._threshold
+        maxlen = self.maxlen
+
+        def recording_get(key, default=None):
+            if len(trace) < maxlen and _sampled(key, threshold):
+                append(key)
+            return get(key, default)
+
+        cache.get = recording_get
+
+    def stop(self):
+        self.cache.__dict__.pop('get', None)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def stack_distances(trace):
+    """Return the LRU stack distance of each reference in trace
+
+    The distance is the number of distinct other keys referenced since the
+    previous reference to the same key, or None for the first reference.
+    Runs in O(n log n) using a Fenwick tree over reference times.
+    """
+    n = len(trace)
+    tree = [0] * (n + 1)
+    last = {}
+    distances = []
+
+    def add(pos, delta):
+        pos += 1
+        while pos <= n:
+            tree[pos] += delta
+            pos += pos & -pos
+
+    def prefix(pos):
+        # number of marked times <= pos
+        pos += 1
+        total = 0
+        while pos > 0:
+            total += tree[pos]
+            pos -= pos & -pos
+        return total
+
+    for now, key in enumerate(trace):
+        prev = last.get(key)
+        if prev is None:
+            distances.append(None)
+        else:
+            distances.append(len(last) - prefix(prev))
+            add(prev, -1)
+        add(now, 1)
+        last[key] = now
+    return distances
+
+
+def miss_ratio_curve(trace, sizes, sample_rate=1.0):
+    """Return a list of (size, miss ratio) for each of sizes
+
+    trace is a list of keys, e.g. TraceRecorder.trace, sampled at
+    sample_rate. All sizes are computed from a single pass over the trace.
+    """
+    _sample_threshold(sample_rate)
+    if not trace:
+        return [(size, 0.0) for size in sizes]
+    distances = stack_distances(trace)
+    total = float(len(distances))
+    finite = sorted(d for d in distances if d is not None)
+    cold = len(distances) - len(finite)
+    curve = []
+    for size in sizes:
+        # A reference hits if fewer than size distinct keys came in between,
+        # with distances scaled up to the full trace.
+        hits = bisect_left(finite, size * sample_rate)
+        curve.append((size, (cold + len(finite) - hits) / total))
+    return curve
+
+
+def suggest_size(curve, max_miss_ratio):
+    """Return the smallest size in curve with a miss ratio <= max_miss_ratio
+
+    Return None if no size is good enough.
+    """
+    for size, miss_ratio in sorted(curve):
+        if miss_ratio <= max_miss_ratio:
+            return size
+    return None
+
+
+def clock_miss_ratio(trace, size, sample_rate=1.0):
+    """Replay trace against an LRUCache and return its miss ratio
+
+    The cache size is scaled by sample_rate.
+    """
+    _sample_threshold(sample_rate)
+    if not trace:
+        return 0.0
+    cache = LRUCache(max(1, int(round(size * sample_rate))))
+    get = cache.get
+    put = cache.put
+    for key in trace:
+        if get(key, _MARKER) is _MARKER:
+            put(key, True)
+    return cache.misses / float(cache.lookups)
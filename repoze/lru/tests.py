@@ -1,3 +1,4 @@
+import gc
 import random
 import time
 import unittest
@@ -8,18 +9,221 @@ except NameError: # pragma: NO COVER  (Python3)
     pass
 
 
+class CacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import Cache
+        return Cache
+
+    def _makeOne(self, **methods):
+        class DictCache(self._getTargetClass()):
+            def __init__(self):
+                self.data = {}
+            def clear(self):
+                self.data.clear()
+            def get(self, key, default=None):
+                return self.data.get(key, default)
+            def put(self, key, val):
+                self.data[key] = val
+            def invalidate(self, key):
+                self.data.pop(key, None)
+        for name, method in methods.items():
+            setattr(DictCache, name, method)
+        return DictCache()
+
+    def test_defaults_without_entries(self):
+        cache = self._makeOne()
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        # peek() and in fall back to get()
+        self.assertEqual(cache.peek('a'), 1)
+        self.assertEqual(cache.peek('b', 2), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.view()['a'], 1)
+        self.assertRaises(NotImplementedError, cache.keys)
+        self.assertRaises(NotImplementedError, cache.items)
+        self.assertRaises(NotImplementedError, cache.view, snapshot=True)
+        cache.invalidate('a')
+        cache.put('b', 2)
+        cache.clear()
+        self.assertIsNone(cache.get('b'))
+
+    def test_defaults_with_entries(self):
+        cache = self._makeOne(_entries=lambda self: iter(self.data.items()))
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.peek('b'), 2)
+        self.assertEqual(cache.peek('c', 3), 3)
+        self.assertTrue('a' in cache)
+        self.assertEqual(dict(cache.view(snapshot=True)), {'a': 1, 'b': 2})
+
+
 class UnboundedCacheTests(unittest.TestCase):
 
     def _getTargetClass(self):
         from repoze.lru import UnboundedCache
         return UnboundedCache
 
-    def _makeOne(self):
-        return self._getTargetClass()()
+    def _makeOne(self, maxsize=None):
+        return self._getTargetClass()(maxsize)
 
     def test_ctor(self):
         cache = self._makeOne()
         self.assertEqual(cache._data, {})
+        self.assertIsNone(cache.maxsize)
+
+    def test_ctor_maxsize_lessthan_1(self):
+        self.assertRaises(ValueError, self._makeOne, 0)
+
+    def test_counters(self):
+        cache = self._makeOne()
+        cache.put('extant', 1)
+        cache.get('extant')
+        cache.get('extant')
+        cache.get('nonesuch')
+        self.assertEqual(cache.lookups, 3)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+        cache.clear()
+        self.assertEqual(cache.lookups, 0)
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.misses, 0)
+
+    def test_peek_contains_keys_items(self):
+        cache = self._makeOne()
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.peek('a'), 1)
+        self.assertIsNone(cache.peek('c'))
+        self.assertEqual(cache.peek('c', 3), 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('c' in cache)
+        self.assertEqual(cache.lookups, 0)
+        # Newest first where dicts keep insertion order.
+        self.assertEqual(sorted(cache.keys()), ['a', 'b'])
+        self.assertEqual(sorted(cache.items()), [('a', 1), ('b', 2)])
+
+    def test_compress_values(self):
+        cache = self._makeOne()
+        cache.compress_values(threshold=0)
+        cache.put('a', b'abc' * 100)
+        cache.put('b', 42)
+        self.assertEqual(type(cache._data['a']).__name__, '_Compressed')
+        self.assertEqual(cache.get('a'), b'abc' * 100)
+        self.assertEqual(cache.peek('a'), b'abc' * 100)
+        self.assertEqual(sorted(cache.items()),
+                         [('a', b'abc' * 100), ('b', 42)])
+        raw = self._makeOne()
+        raw.put('a', b'abc' * 100)
+        raw.put('b', 42)
+        self.assertTrue(cache.footprint() < raw.footprint() - 150)
+
+    def test_intern_values(self):
+        pool = self._makeOne().intern_values()
+        cache = self._makeOne(10)
+        self.assertIs(cache.intern_values(pool), pool)
+        first = _distinct_copy('value')
+        cache.put('a', first)
+        cache.put('b', _distinct_copy('value'))
+        self.assertIs(cache.get('b'), first)
+        cache.put('b', first)
+        self.assertEqual(pool.copies[(str, 'value')], [first, 2])
+        cache.invalidate('a')
+        cache.invalidate('a')
+        self.assertEqual(pool.copies[(str, 'value')], [first, 1])
+        # Trimming releases the values it evicts.
+        for i in range(11):
+            cache.put(i, i)
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual((str, 'value') in pool.copies, 'b' in cache)
+        self.assertEqual(len(pool), 10)
+        cache.clear()
+        cache.flush_evictions()
+        cache.put('c', [])
+        self.assertEqual(len(pool), 0)
+
+    def test_hooks(self):
+        # put() takes the slow path only while a feature needs it.
+        cache = self._makeOne()
+        self.assertFalse(cache._hooked)
+        cache.on_evict(lambda *args: None)
+        self.assertTrue(cache._hooked)
+        self.assertTrue(self._makeOne(10)._hooked)
+
+    def test_on_evict(self):
+        cache = self._makeOne(10)
+        pool = cache.intern_values()
+        evicted = []
+        cache.on_evict(lambda *args: evicted.append(args))
+        cache.put('a', 1)
+        cache.put('a', 2)
+        cache.put('a', 2)
+        cache.invalidate('a')
+        cache.invalidate('a')
+        self.assertEqual(evicted, [('a', 1, 'invalidate'),
+                                   ('a', 2, 'invalidate')])
+        del evicted[:]
+        for i in range(11):
+            cache.put(i, i)
+        # Which entries are evicted depends on dict order.
+        self.assertEqual(len(evicted), 2)
+        for key, val, reason in evicted:
+            self.assertEqual((val, reason), (key, 'capacity'))
+            self.assertFalse(key in cache)
+        kept = sorted(set(range(11)) - set(key for key, _, _ in evicted))
+        del evicted[:]
+        cache.clear()
+        cache.flush_evictions()
+        self.assertEqual(sorted(evicted), [(i, i, 'clear') for i in kept])
+        self.assertEqual(len(pool), 0)
+
+    def test_clear_releases_entries_without_put(self):
+        import weakref
+
+        class Value(object):
+            pass
+
+        cache = self._makeOne()
+        value = Value()
+        cache.put('a', value)
+        ref = weakref.ref(value)
+        del value
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache.flush_evictions()
+        self.assertIsNone(ref())
+
+    def test_len(self):
+        cache = self._makeOne()
+        self.assertEqual(len(cache), 0)
+        cache.put('one', 1)
+        cache.put('two', 2)
+        self.assertEqual(len(cache), 2)
+
+    def test_soft_maxsize(self):
+        cache = self._makeOne(20)
+        for i in range(20):
+            cache.put(i, i)
+        self.assertEqual(len(cache), 20)
+        self.assertEqual(cache.evictions, 0)
+        cache.put(20, 20, tags=('t',))
+        # Trimmed in one batch to 10% below maxsize
+        self.assertEqual(len(cache), 18)
+        self.assertEqual(cache.evictions, 3)
+        self.assertEqual(cache.get(20), 20)
+        for i in range(100):
+            cache.put(i, i, tags=('t',))
+            self.assertTrue(len(cache) <= 20)
+        self.assertEqual(len(cache._tag_index.tags_by_key), len(cache))
+
+    def test_footprint(self):
+        import sys
+        cache = self._makeOne()
+        empty = cache.footprint()
+        self.assertEqual(empty, sys.getsizeof({}))
+        cache.put('key', 'x' * 1000)
+        self.assertTrue(cache.footprint() > empty + 1000)
 
     def test_get_miss_no_default(self):
         cache = self._makeOne()
@@ -57,6 +261,108 @@ class UnboundedCacheTests(unittest.TestCase):
         cache.put('extant', extant)
         self.assertIs(cache._data['extant'], extant)
 
+    def test_invalidate_tag(self):
+        cache = self._makeOne()
+        cache.put('one', 1, tags=('user:1', 'group:1'))
+        cache.put('two', 2, tags=('user:2', 'group:1'))
+        cache.put('three', 3)
+        cache.invalidate_tag('user:1')
+        self.assertIsNone(cache.get('one'))
+        self.assertEqual(cache.get('two'), 2)
+        cache.invalidate_tag('group:1')
+        self.assertIsNone(cache.get('two'))
+        self.assertEqual(cache.get('three'), 3)
+        self.assertEqual(cache._tag_index.keys_by_tag, {})
+        self.assertEqual(cache._tag_index.tags_by_key, {})
+
+    def test_invalidate_tag_untagged(self):
+        cache = self._makeOne()
+        cache.put('one', 1)
+        cache.invalidate_tag('nonesuch')  # does not raise
+        self.assertIsNone(cache._tag_index)
+        self.assertEqual(cache.get('one'), 1)
+
+    def test_get_or_set(self):
+        cache = self._makeOne()
+        calls = []
+        def loader(key):
+            calls.append(key)
+            return key * 2
+        self.assertEqual(cache.get_or_set(1, loader), 2)
+        self.assertEqual(cache.get_or_set(1, loader), 2)
+        self.assertEqual(calls, [1])
+
+    def test_get_or_set_many(self):
+        cache = self._makeOne()
+        cache.put(1, 'one')
+        calls = []
+        def bulk_loader(keys):
+            calls.append(keys)
+            return dict((key, key * 2) for key in keys)
+        result = cache.get_or_set_many([1, 2, 3, 2], bulk_loader)
+        self.assertEqual(result, {1: 'one', 2: 4, 3: 6})
+        self.assertEqual(calls, [[2, 3]])
+        self.assertEqual(cache.get(3), 6)
+
+    def test_get_or_set_timeout(self):
+        cache = self._makeOne()
+        self.assertRaises(ValueError, cache.get_or_set, 1, str, timeout=5)
+        self.assertRaises(ValueError, cache.get_or_set_many, [1],
+                          lambda keys: {}, timeout=5)
+        self.assertEqual(len(cache), 0)
+
+    def test_pickle(self):
+        import pickle
+        cache = self._makeOne(10)
+        cache.put('one', 1, tags=('t',))
+        cache.put('two', 2)
+        cache.get('one')
+        clone = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(clone._data, {'one': 1, 'two': 2})
+        self.assertEqual(clone.maxsize, 10)
+        self.assertEqual(clone.hits, 1)
+        clone.invalidate_tag('t')
+        self.assertEqual(clone._data, {'two': 2})
+        self.assertEqual(cache._data, {'one': 1, 'two': 2})
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            clone = pickle.loads(pickle.dumps(cache, protocol))
+            self.assertEqual(clone._data, {'one': 1, 'two': 2})
+
+    def test_reinit_after_fork(self):
+        cache = self._makeOne()
+        cache.get_or_set('one', lambda key: 1)
+        cache.put('two', 2, tags=('t',))
+        cache._reinit_after_fork()
+        self.assertIsNone(cache._load_coordinator)
+        self.assertEqual(len(cache), 2)
+        cache.clear_after_fork = True
+        cache._reinit_after_fork()
+        self.assertEqual(len(cache), 0)
+
+    def test_reinit_after_fork_intern_pool(self):
+        cache = self._makeOne()
+        pool = cache.intern_values()
+        lock = pool.lock
+        cache._reinit_after_fork()
+        self.assertIsNot(pool.lock, lock)
+        self.assertIsNone(cache._tag_index)
+
+    def test_invalidate_and_clear_drop_tags(self):
+        cache = self._makeOne()
+        cache.put('one', 1, tags=('a',))
+        cache.put('two', 2, tags=('a',))
+        cache.invalidate('one')
+        self.assertEqual(cache._tag_index.keys_by_tag, {'a': set(['two'])})
+        cache.clear()
+        self.assertEqual(cache._tag_index.keys_by_tag, {})
+
+
+class UnboundedCachePyTests(UnboundedCacheTests):
+
+    def _getTargetClass(self):
+        from repoze.lru import UnboundedCachePy
+        return UnboundedCachePy
+
 
 class LRUCacheTests(unittest.TestCase):
 
@@ -72,8 +378,8 @@ class LRUCacheTests(unittest.TestCase):
         # cache.hand/maxpos/size
         self.assertTrue(cache.hand < len(cache.clock_keys))
         self.assertTrue(cache.hand >= 0)
-        self.assertEqual(cache.maxpos, cache.size - 1)
-        self.assertEqual(len(cache.clock_keys), cache.size)
+        self.assertEqual(cache.maxpos, len(cache.clock_keys) - 1)
+        self.assertTrue(len(cache.clock_keys) <= cache.size)
 
         # lengths of data structures
         self.assertEqual(len(cache.clock_keys), len(cache.clock_refs))
@@ -101,6 +407,63 @@ class LRUCacheTests(unittest.TestCase):
     def test_size_lessthan_1(self):
         self.assertRaises(ValueError, self._makeOne, 0)
 
+    def test_sweep_budget_lessthan_1(self):
+        self.assertRaises(ValueError, self._getTargetClass(), 10,
+                          sweep_budget=0)
+
+    def test_sweep_budget_default(self):
+        cache = self._makeOne(10)
+        self.assertEqual(cache.sweep_budget, 1024)
+
+    def test_put_sweep_gives_second_chance(self):
+        cache = self._makeOne(4)
+        for i in range(4):
+            cache.put(i, i)
+        # All slots are referenced: one full turn clears them all and the
+        # slot at the hand is evicted.
+        cache.put(4, 4)
+        self.assertEqual(cache.clock_keys, [4, 1, 2, 3])
+        self.assertEqual(cache.clock_refs, [True, False, False, False])
+        self.assertEqual(cache.hand, 1)
+        # Referenced slots are skipped, the search wraps around.
+        cache.get(1)
+        cache.get(2)
+        cache.get(3)
+        cache.invalidate(4)
+        cache.put(5, 5)
+        self.assertEqual(cache.clock_keys, [5, 1, 2, 3])
+        self.assertEqual(cache.clock_refs, [True, False, False, False])
+        self.assertEqual(cache.hand, 1)
+        self.assertEqual(cache.evictions, 1)
+        self.check_cache_is_consistent(cache)
+
+    def test_put_sweep_budget_forces_eviction(self):
+        cache = self._makeOne(10)
+        cache.sweep_budget = 3
+        for i in range(10):
+            cache.put(i, i)
+        cache.put(10, 10)
+        # Only the slots within the budget lose their reference bit.
+        self.assertEqual(cache.clock_keys[3], 10)
+        self.assertEqual(cache.clock_refs[:4], [False, False, False, True])
+        self.assertEqual(cache.clock_refs[4:], [True] * 6)
+        self.assertEqual(cache.hand, 4)
+        self.assertEqual(cache.get(3), None)
+        self.check_cache_is_consistent(cache)
+
+    def test_put_sweep_budget_wraps(self):
+        cache = self._makeOne(5)
+        cache.sweep_budget = 4
+        for i in range(5):
+            cache.put(i, i)
+        cache.hand = 3
+        cache.clock_refs[1] = False
+        cache.put(5, 5)
+        self.assertEqual(cache.clock_keys, [0, 5, 2, 3, 4])
+        self.assertEqual(cache.clock_refs, [False, True, True, False, False])
+        self.assertEqual(cache.hand, 2)
+        self.check_cache_is_consistent(cache)
+
     def test_get(self):
         cache = self._makeOne(1)
         # Must support different types of keys
@@ -351,6 +714,563 @@ class LRUCacheTests(unittest.TestCase):
 
         self.check_cache_is_consistent(cache)
 
+    def test_invalidate_tag(self):
+        cache = self._makeOne(10)
+        cache.put("one", 1, tags=("user:1", "group:1"))
+        cache.put("two", 2, tags=("user:2", "group:1"))
+        cache.put("three", 3)
+        cache.invalidate_tag("user:1")
+        self.assertIsNone(cache.get("one"))
+        self.assertEqual(cache.get("two"), 2)
+        cache.invalidate_tag("group:1")
+        self.assertIsNone(cache.get("two"))
+        self.assertEqual(cache.get("three"), 3)
+        cache.invalidate_tag("nonesuch")
+        self.assertEqual(cache.get("three"), 3)
+        self.check_cache_is_consistent(cache)
+
+    def test_put_replaces_tags(self):
+        cache = self._makeOne(10)
+        cache.put("one", 1, tags=("a",))
+        cache.put("one", 1, tags=("b",))
+        cache.invalidate_tag("a")
+        self.assertEqual(cache.get("one"), 1)
+        cache.put("one", 1)
+        cache.invalidate_tag("b")
+        self.assertEqual(cache.get("one"), 1)
+        self.assertEqual(cache._tag_index.tags_by_key, {})
+
+    def test_eviction_drops_tags(self):
+        cache = self._makeOne(2)
+        for i in range(10):
+            cache.put(i, i, tags=("all", i))
+        index = cache._tag_index
+        self.assertEqual(set(index.tags_by_key), set(cache.data))
+        self.assertEqual(index.keys_by_tag["all"], set(cache.data))
+        cache.invalidate_tag("all")
+        self.assertEqual(cache.data, {})
+        self.assertEqual(index.keys_by_tag, {})
+        self.check_cache_is_consistent(cache)
+
+    def test_get_or_set(self):
+        cache = self._makeOne(10)
+        calls = []
+        def loader(key):
+            calls.append(key)
+            return key * 2
+        self.assertEqual(cache.get_or_set(1, loader), 2)
+        self.assertEqual(cache.get_or_set(1, loader), 2)
+        self.assertEqual(calls, [1])
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache._load_coordinator.flights, {})
+        self.check_cache_is_consistent(cache)
+
+    def test_get_or_set_recursive(self):
+        cache = self._makeOne(10)
+        def loader(key):
+            return cache.get_or_set(key, loader)
+        self.assertRaises(RuntimeError, cache.get_or_set, 'key', loader)
+        def bulk_loader(keys):
+            return {'a': cache.get_or_set('b', str)}
+        self.assertRaises(RuntimeError, cache.get_or_set_many, ['a', 'b'],
+                          bulk_loader)
+        self.assertEqual(cache._load_coordinator.flights, {})
+        # Other keys load as usual.
+        def outer(key):
+            return cache.get_or_set('inner', lambda key: 1) + 1
+        self.assertEqual(cache.get_or_set('outer', outer), 2)
+        self.assertEqual(cache.get('inner'), 1)
+
+    def test_get_or_set_concurrent_loads_once(self):
+        import threading
+        cache = self._makeOne(10)
+        started = threading.Event()
+        proceed = threading.Event()
+        calls = []
+        def loader(key):
+            calls.append(key)
+            started.set()
+            proceed.wait()
+            return 'value'
+        results = []
+        def worker():
+            results.append(cache.get_or_set('key', loader))
+        first = threading.Thread(target=worker)
+        first.start()
+        started.wait()
+        others = [threading.Thread(target=worker) for i in range(5)]
+        for thread in others:
+            thread.start()
+        time.sleep(0.05)
+        proceed.set()
+        for thread in [first] + others:
+            thread.join()
+        self.assertEqual(calls, ['key'])
+        self.assertEqual(results, ['value'] * 6)
+
+    def test_get_or_set_loader_fails(self):
+        import threading
+        cache = self._makeOne(10)
+        started = threading.Event()
+        proceed = threading.Event()
+        def failing_loader(key):
+            started.set()
+            proceed.wait()
+            raise ValueError(key)
+        errors = []
+        def worker():
+            try:
+                cache.get_or_set('key', failing_loader)
+            except ValueError as e:
+                errors.append(e)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        started.wait()
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(
+                cache.get_or_set('key', lambda key: 'retried')))
+        waiter.start()
+        skipped = []
+        other = threading.Thread(
+            target=lambda: skipped.append(
+                cache.get_or_set_many(['key'], lambda keys: {})))
+        other.start()
+        time.sleep(0.05)
+        proceed.set()
+        thread.join()
+        waiter.join()
+        other.join()
+        self.assertEqual(len(errors), 1)
+        # The waiting threads load the key themselves
+        self.assertEqual(results, ['retried'])
+        self.assertEqual(skipped, [{}])
+        self.assertEqual(cache.get('key'), 'retried')
+
+    def test_get_or_set_many(self):
+        cache = self._makeOne(10)
+        cache.put(1, 'one')
+        calls = []
+        def bulk_loader(keys):
+            calls.append(keys)
+            return dict((key, key * 2) for key in keys if key != 4)
+        result = cache.get_or_set_many([1, 2, 3, 2, 4], bulk_loader)
+        self.assertEqual(result, {1: 'one', 2: 4, 3: 6})
+        self.assertEqual(calls, [[2, 3, 4]])
+        self.assertEqual(cache.get(3), 6)
+        self.assertIsNone(cache.get(4))
+        self.assertEqual(cache.get_or_set_many([], bulk_loader), {})
+        self.assertEqual(len(calls), 1)
+        self.check_cache_is_consistent(cache)
+
+    def test_pickle(self):
+        import pickle
+        cache = self._makeOne(3)
+        for i in range(5):
+            cache.put(i, 'item%s' % i, tags=('even' if i % 2 else 'odd',))
+        cache.get(4)
+        cache.get(5)
+        clone = pickle.loads(pickle.dumps(cache))
+        self.check_cache_is_consistent(clone)
+        self.assertEqual(clone.size, 3)
+        self.assertEqual(dict((key, entry[1])
+                              for key, entry in clone.data.items()),
+                         dict((key, entry[1])
+                              for key, entry in cache.data.items()))
+        for name in ('evictions', 'hits', 'misses', 'lookups',
+                     'sweep_budget'):
+            self.assertEqual(getattr(clone, name), getattr(cache, name))
+        # The lock is a new one
+        self.assertIsNot(clone.lock, cache.lock)
+        # Any protocol will do
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            clone = pickle.loads(pickle.dumps(cache, protocol))
+            self.assertIs(type(clone), type(cache))
+            self.assertEqual(sorted(clone.data), sorted(cache.data))
+        # Tags survive
+        clone.invalidate_tag('odd')
+        self.assertEqual(sorted(clone.data), [3])
+        self.check_cache_is_consistent(clone)
+        # Clock order is kept: the entry at the hand is evicted first
+        victim = cache.clock_keys[cache.hand]
+        clone = pickle.loads(pickle.dumps(cache))
+        clone.clock_refs = [False] * clone.size
+        clone.put('new', 'new')
+        self.assertNotIn(victim, clone.data)
+
+    def test_pickle_grown_clock(self):
+        import pickle
+        cache = self._makeOne(20)
+        for i in range(10):
+            cache.put(i, i)
+        clone = pickle.loads(pickle.dumps(cache))
+        self.check_cache_is_consistent(clone)
+        self.assertEqual(sorted(clone.data), list(range(10)))
+
+    def test_copy(self):
+        import copy
+        cache = self._makeOne(3)
+        cache.put('one', [1])
+        clone = copy.copy(cache)
+        self.assertIs(clone.get('one'), cache.get('one'))
+        clone.put('two', 2)
+        self.assertIsNone(cache.get('two'))
+        clone = copy.deepcopy(cache)
+        self.assertEqual(clone.get('one'), [1])
+        self.assertIsNot(clone.get('one'), cache.get('one'))
+        self.check_cache_is_consistent(clone)
+
+    def test_reinit_after_fork(self):
+        cache = self._makeOne(3)
+        cache.put('one', 1, tags=('t',))
+        lock = cache.lock
+        lock.acquire()
+        try:
+            cache._reinit_after_fork()
+        finally:
+            lock.release()
+        self.assertIsNot(cache.lock, lock)
+        self.assertEqual(cache.get('one'), 1)
+        cache.clear_after_fork = True
+        cache._reinit_after_fork()
+        self.assertIsNone(cache.get('one'))
+
+    def test_fork_with_lock_held(self):
+        import os
+        if not hasattr(os, 'register_at_fork'):  # pragma: NO COVER
+            return
+        cache = self._makeOne(3)
+        with cache.lock:
+            pid = os.fork()
+            if pid == 0:  # pragma: NO COVER (child)
+                import signal
+                signal.alarm(5)
+                cache.put('one', 1)
+                os._exit(0 if cache.get('one') == 1 else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_len(self):
+        cache = self._makeOne(3)
+        self.assertEqual(len(cache), 0)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(len(cache), 2)
+        cache.invalidate('a')
+        self.assertEqual(len(cache), 1)
+
+    def test_get_key_replacing_data(self):
+        # get() must keep the dict it searches alive.
+        cache = self._makeOne(3)
+
+        class Key(object):
+            def __hash__(self):
+                return 1
+
+            def __eq__(self, other):
+                cache.data = {}
+                return False
+
+        cache.put(Key(), 'value')
+        self.assertIsNone(cache.get(Key()))
+        self.assertEqual(cache.data, {})
+
+    def test_peek_does_not_mark_as_used(self):
+        cache = self._makeOne(3)
+        cache.put('a', 1)
+        cache.clock_refs[0] = False
+        self.assertEqual(cache.peek('a'), 1)
+        self.assertIsNone(cache.peek('b'))
+        self.assertEqual(cache.peek('b', 2), 2)
+        self.assertFalse(cache.clock_refs[0])
+        self.assertEqual(cache.lookups, 0)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.lookups, 0)
+
+    def test_keys_items_recency_order(self):
+        cache = self._makeOne(4)
+        for key in 'abcd':
+            cache.put(key, key.upper())
+        cache.put('e', 'E')
+        # 'e' replaced 'a'; the sweep cleared the other reference bits.
+        self.assertEqual(cache.keys(), ['e', 'd', 'c', 'b'])
+        cache.get('c')
+        self.assertEqual(cache.keys(), ['e', 'c', 'd', 'b'])
+        self.assertEqual(cache.items(),
+                         [('e', 'E'), ('c', 'C'), ('d', 'D'), ('b', 'B')])
+        # Stale slots are skipped
+        cache.clear()
+        cache.put('f', 'F')
+        self.assertEqual(cache.keys(), ['f'])
+
+    def test_view(self):
+        cache = self._makeOne(3)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        view = cache.view()
+        self.assertEqual(view['a'], 1)
+        self.assertRaises(KeyError, view.__getitem__, 'c')
+        self.assertTrue('a' in view)
+        self.assertFalse('c' in view)
+        self.assertEqual(list(view), ['b', 'a'])
+        self.assertEqual(len(view), 2)
+        self.assertEqual(dict(view), {'a': 1, 'b': 2})
+        self.assertEqual(view.get('c', 3), 3)
+        self.assertEqual(cache.lookups, 0)
+        # A live view follows the cache
+        cache.put('c', 3)
+        self.assertEqual(len(view), 3)
+        self.assertFalse(hasattr(view, '__setitem__'))
+
+    def test_view_snapshot(self):
+        cache = self._makeOne(3)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        view = cache.view(snapshot=True)
+        cache.put('c', 3)
+        cache.invalidate('a')
+        self.assertEqual(list(view.items()), [('b', 2), ('a', 1)])
+        self.assertEqual(len(view), 2)
+        self.assertTrue('a' in view)
+        self.assertFalse('c' in view)
+        self.assertEqual(view['a'], 1)
+
+    def test_compress_values(self):
+        import pickle
+        cache = self._makeOne(3)
+        codec = cache.compress_values('zlib', threshold=10)
+        self.assertIs(cache.value_codec, codec)
+        blob = b'x' * 1000
+        text = u'\xe9' * 1000
+        cache.put('blob', blob)
+        cache.put('text', text)
+        cache.put('small', b'x')
+        self.assertEqual(type(cache.data['blob'][1]).__name__, '_Compressed')
+        self.assertIs(cache.data['small'][1], cache.get('small'))
+        self.assertEqual(cache.get('blob'), blob)
+        self.assertEqual(cache.get('text'), text)
+        self.assertEqual(cache.peek('text'), text)
+        self.assertEqual(dict(cache.items())['blob'], blob)
+        self.assertEqual(codec.compressed, 2)
+        self.assertEqual(codec.raw_bytes, 3000)
+        self.assertTrue(codec.ratio > 10)
+        loaded = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(loaded.data['blob'][1], blob)
+        self.assertEqual(loaded.get('text'), text)
+        self.assertIsNone(loaded.value_codec)
+        self.assertRaises(ValueError, cache.compress_values)
+
+    def test_intern_values(self):
+        cache = self._makeOne(3)
+        pool = cache.intern_values()
+        first = _distinct_copy('value')
+        cache.put('a', first)
+        cache.put('b', _distinct_copy('value'))
+        self.assertIs(cache.get('b'), first)
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.copies[(str, 'value')], [first, 2])
+        # Replacing a value releases it, also by an equal one
+        cache.put('b', 'other')
+        cache.put('a', _distinct_copy('value'))
+        self.assertEqual(pool.copies[(str, 'value')], [first, 1])
+        cache.invalidate('a')
+        cache.invalidate('a')
+        self.assertEqual(list(pool.copies), [(str, 'other')])
+        # Evicted and cleared entries are released
+        for i in range(4):
+            cache.put(i, float(i))
+        self.assertEqual(len(pool), 3)
+        cache.clear()
+        cache.flush_evictions()
+        cache.put('c', [])
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(cache.get('c'), [])
+        self.assertRaises(ValueError, cache.intern_values)
+        self.assertRaises(ValueError, cache.compress_values)
+        cache = self._makeOne(3)
+        cache.compress_values()
+        self.assertRaises(ValueError, cache.intern_values)
+
+    def test_hooks(self):
+        # put() takes the slow path only while a feature needs it.
+        cache = self._getTargetClass()(3)
+        self.assertFalse(cache._hooked)
+        cache.put('a', 1)
+        self.assertFalse(cache._hooked)
+        cache.put('b', 2, tags=['t'])
+        self.assertTrue(cache._hooked)
+        cache = self._getTargetClass()(3)
+        cache.compress_values()
+        self.assertTrue(cache._hooked)
+
+    def test_on_evict(self):
+        cache = self._makeOne(3)
+        cache.compress_values(threshold=10)
+        evicted = []
+        # Assertions would be swallowed on the thread reporting clear().
+        locked = []
+
+        @cache.on_evict
+        def callback(key, val, reason):
+            locked.append(cache.lock.locked())
+            evicted.append((key, val, reason))
+        self.assertEqual(cache._evict_callbacks, [(callback, False)])
+        blob = b'x' * 100
+        cache.put('a', blob, tags=['t'])
+        cache.put('b', 2, tags=['t'])
+        cache.put('c', 3)
+        cache.put('c', 3)
+        self.assertEqual(evicted, [])
+        cache.put('c', 4)
+        cache.put('d', 5)
+        self.assertEqual(evicted, [('c', 3, 'invalidate'),
+                                   ('a', blob, 'capacity')])
+        del evicted[:]
+        cache.invalidate('c')
+        cache.invalidate('c')
+        cache.invalidate_tag('t')
+        self.assertEqual(evicted, [('c', 4, 'invalidate'),
+                                   ('b', 2, 'invalidate')])
+        del evicted[:]
+        cache.put('e', 6)
+        cache.clear()
+        cache.flush_evictions()
+        self.assertEqual(sorted(evicted), [('d', 5, 'clear'),
+                                           ('e', 6, 'clear')])
+        del evicted[:]
+        cache.clear()
+        cache.flush_evictions()
+        self.assertEqual(evicted, [])
+        self.assertFalse(any(locked))
+
+    def test_clear_releases_keys(self):
+        import weakref
+        cache = self._makeOne(3)
+        key = Referent()
+        keyref = weakref.ref(key)
+        cache.put(key, 1)
+        cache.clear()
+        cache.flush_evictions()
+        del key
+        gc.collect()
+        self.assertIsNone(keyref())
+        cache.put('a', 1)
+        self.check_cache_is_consistent(cache)
+
+    def test_on_evict_raises(self):
+        cache = self._makeOne(3)
+        cache.put('a', 1)
+
+        def callback(key, val, reason):
+            raise KeyError(key)
+        cache.on_evict(callback)
+        self.assertRaises(KeyError, cache.put, 'a', 2)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertFalse(cache.lock.locked())
+
+    def test_on_evict_background(self):
+        import threading
+        cache = self._makeOne(3)
+        evicted = []
+        threads = []
+
+        def callback(key, val, reason):
+            threads.append(threading.current_thread())
+            evicted.append((key, val, reason))
+            if key in ('b', 'd'):
+                raise ValueError(key)
+        cache.on_evict(callback, background=True)
+        failed = cache.flush_evictions()
+        for i, key in enumerate('abcde'):
+            cache.put(key, i)
+        cache.clear()
+        self.assertEqual(cache.flush_evictions(), failed + 2)
+        self.assertEqual(evicted[:2], [('a', 0, 'capacity'),
+                                       ('b', 1, 'capacity')])
+        self.assertEqual(sorted(evicted[2:]), [('c', 2, 'clear'),
+                                               ('d', 3, 'clear'),
+                                               ('e', 4, 'clear')])
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_clock_grows(self):
+        from repoze.lru import _INITIAL_CLOCK
+        size = 4 * _INITIAL_CLOCK + 1
+        cache = self._makeOne(size)
+        self.assertEqual(len(cache.clock_keys), _INITIAL_CLOCK)
+        for i in range(_INITIAL_CLOCK + 1):
+            cache.put(i, i)
+        self.assertEqual(len(cache.clock_keys), 2 * _INITIAL_CLOCK)
+        self.check_cache_is_consistent(cache)
+        for i in range(size):
+            cache.put(i, i)
+        self.assertEqual(len(cache.clock_keys), size)
+        self.assertEqual(len(cache.data), size)
+        self.assertEqual(cache.evictions, 0)
+        self.assertEqual(cache.hand, 0)
+        cache.put('new', 1)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache.clock_keys), size)
+        self.check_cache_is_consistent(cache)
+
+    def test_clear_leaves_slots_to_put(self):
+        from repoze.lru import _MARKER
+        cache = self._makeOne(3)
+        for key in 'abc':
+            cache.put(key, key)
+        clock_keys = cache.clock_keys
+        cache.clear()
+        self.assertEqual(cache.data, {})
+        # The clock is not reallocated, but its keys are dropped.
+        self.assertIs(cache.clock_keys, clock_keys)
+        self.assertEqual(cache.clock_keys, [_MARKER] * 3)
+        self.assertIsNone(cache.get('a'))
+        for key in 'def':
+            cache.put(key, key)
+        self.assertEqual(sorted(cache.data), ['d', 'e', 'f'])
+        self.assertEqual(cache.evictions, 0)
+        self.check_cache_is_consistent(cache)
+
+    def test_clear_releases_entries_without_put(self):
+        import weakref
+
+        class Value(object):
+            pass
+
+        cache = self._makeOne(3)
+        values = [Value() for i in range(3)]
+        for i, value in enumerate(values):
+            cache.put(i, value)
+        refs = [weakref.ref(value) for value in values]
+        del values, value
+        cache.clear()
+        self.assertIsNone(cache.get(0))
+        cache.flush_evictions()
+        self.assertEqual([ref() for ref in refs], [None, None, None])
+        self.check_cache_is_consistent(cache)
+
+    def test_put_keeps_entry_moved_to_other_slot(self):
+        cache = self._makeOne(3)
+        cache.put('a', 1)
+        cache.invalidate('a')
+        # 'a' goes into the next slot, the first one still names it.
+        cache.put('a', 2)
+        self.assertEqual(cache.clock_keys[:2], ['a', 'a'])
+        cache.put('b', 3)
+        # The hand is back at the stale slot.
+        cache.put('c', 4)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertEqual(cache.evictions, 0)
+        self.check_cache_is_consistent(cache)
+
+    def test_clear_drops_tags(self):
+        cache = self._makeOne(2)
+        cache.put("one", 1, tags=("a",))
+        cache.clear()
+        self.assertEqual(cache._tag_index.keys_by_tag, {})
+        self.assertEqual(cache._tag_index.tags_by_key, {})
+
 
 class ExpiringLRUCacheTests(LRUCacheTests):
 
@@ -373,8 +1293,8 @@ class ExpiringLRUCacheTests(LRUCacheTests):
         # cache.hand/maxpos/size
         self.assertTrue(cache.hand < len(cache.clock_keys))
         self.assertTrue(cache.hand >= 0)
-        self.assertEqual(cache.maxpos, cache.size - 1)
-        self.assertEqual(len(cache.clock_keys), cache.size)
+        self.assertEqual(cache.maxpos, len(cache.clock_keys) - 1)
+        self.assertTrue(len(cache.clock_keys) <= cache.size)
 
         # lengths of data structures
         self.assertEqual(len(cache.clock_keys), len(cache.clock_refs))
@@ -539,6 +1459,1091 @@ class ExpiringLRUCacheTests(LRUCacheTests):
         self.check_cache_is_consistent(cache)
 
 
+    def test_peek_contains_keys_skip_expired(self):
+        cache = self._makeOne(3)
+        cache.put('a', 1, timeout=-1)
+        cache.put('b', 2)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.peek('a'))
+        self.assertFalse('a' in cache)
+        self.assertTrue('b' in cache)
+        self.assertEqual(cache.keys(), ['b'])
+        view = cache.view()
+        self.assertEqual(len(view), 1)
+        self.assertRaises(KeyError, view.__getitem__, 'a')
+        self.assertEqual(dict(cache.view(snapshot=True)), {'b': 2})
+
+    def test_get_uses_patched_clock(self):
+        now = [time.time()]
+        cache = self._makeOne(3)
+        cache.put('a', 1, timeout=10)
+        original = time.time
+        time.time = lambda: now[0]
+        self.addCleanup(setattr, time, 'time', original)
+        self.assertEqual(cache.get('a'), 1)
+        now[0] += 20
+        self.assertIsNone(cache.get('a'))
+
+    def test_purge_expired_releases_interned_values(self):
+        cache = self._makeOne(3)
+        pool = cache.intern_values()
+        cache.put('a', 'value', timeout=-1)
+        cache.put('b', 'value')
+        self.assertEqual(pool.copies[(str, 'value')][1], 2)
+        cache.purge_expired()
+        self.assertEqual(pool.copies[(str, 'value')][1], 1)
+
+    def test_pickle_expiry(self):
+        import pickle
+        cache = self._makeOne(3, default_timeout=0.1)
+        cache.put('one', 1)
+        cache.put('two', 2, timeout=10)
+        clone = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(clone.default_timeout, 0.1)
+        self.assertEqual(clone.data['one'][2], cache.data['one'][2])
+        time.sleep(0.1)
+        self.assertIsNone(clone.get('one'))
+        self.assertEqual(clone.get('two'), 2)
+
+    def test_jitter(self):
+        cache = self._makeOne(100, default_timeout=100)
+        cache.jitter = 0.5
+        now = time.time()
+        for i in range(100):
+            cache.put(i, i)
+        timeouts = [entry[2] - now for entry in cache.data.values()]
+        self.assertTrue(min(timeouts) >= 50)
+        self.assertTrue(max(timeouts) <= 101)
+        self.assertTrue(len(set(timeouts)) > 90)
+        # Per entry override
+        cache.put('exact', 1, timeout=10, jitter=0)
+        self.assertTrue(9 < cache.data['exact'][2] - now <= 11)
+        cache.put('custom', 1, timeout=10, jitter=lambda timeout: timeout * 2)
+        self.assertTrue(19 < cache.data['custom'][2] - now <= 21)
+        self.assertRaises(ValueError, cache.put, 'bad', 1, jitter=1)
+
+    def test_jitter_argument(self):
+        cache = self._getTargetClass()(3, jitter=0.1)
+        self.assertEqual(cache.jitter, 0.1)
+        self.assertRaises(ValueError, self._getTargetClass(), 3, jitter=-0.1)
+        self.assertRaises(ValueError, self._getTargetClass(), 3, jitter=1)
+        self.assertRaises(ValueError, self._getTargetClass(), 3,
+                          jitter='nonesuch')
+
+    def test_pickle_jitter(self):
+        import pickle
+        cache = self._makeOne(3)
+        cache.jitter = 0.25
+        self.assertEqual(pickle.loads(pickle.dumps(cache)).jitter, 0.25)
+
+    def test_get_or_set_timeout(self):
+        cache = self._makeOne(10)
+        cache.get_or_set('one', lambda key: 1, timeout=0.1)
+        cache.get_or_set_many(['two'], lambda keys: {'two': 2}, timeout=0.1)
+        self.assertEqual(cache.get('one'), 1)
+        self.assertEqual(cache.get('two'), 2)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('one'))
+        self.assertIsNone(cache.get('two'))
+
+    def test_invalidate_purge_and_put_concurrently(self):
+        import sys
+        import threading
+        cache = self._makeOne(1000, default_timeout=0.0005)
+        errors = []
+        def run(func):
+            try:
+                for i in range(20000):
+                    func(i % 200)
+            except Exception as e:  # pragma: NO COVER
+                errors.append(e)
+        if hasattr(sys, 'setswitchinterval'):  # pragma: NO BRANCH
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+            self.addCleanup(sys.setswitchinterval, interval)
+        threads = [
+            threading.Thread(target=run, args=(lambda i: cache.put(i, i),)),
+            threading.Thread(target=run, args=(cache.invalidate,)),
+            threading.Thread(target=run,
+                             args=(lambda i: cache.purge_expired(),)),
+            threading.Thread(target=run,
+                             args=(lambda i: cache.expired_count(),)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.check_cache_is_consistent(cache)
+
+    def test_purge_expired(self):
+        cache = self._makeOne(5, default_timeout=0.1)
+        cache.put("one", 1)
+        cache.put("two", 2)
+        cache.put("three", 3, timeout=10)
+        self.assertEqual(cache.purge_expired(), 0)
+        time.sleep(0.1)
+        self.assertEqual(cache.purge_expired(), 2)
+        self.assertEqual(list(cache.data.keys()), ["three"])
+        self.assertEqual(cache.get("three"), 3)
+        self.assertEqual(cache.purge_expired(), 0)
+        self.check_cache_is_consistent(cache)
+
+    def test_purge_expired_drops_tags(self):
+        cache = self._makeOne(5)
+        cache.put('one', 1, timeout=-1, tags=('t',))
+        cache.put('two', 2, tags=('t',))
+        self.assertEqual(cache.purge_expired(), 1)
+        self.assertEqual(cache._tag_index.keys_by_tag, {'t': set(['two'])})
+        self.check_cache_is_consistent(cache)
+
+    def test_on_evict_expiry(self):
+        cache = self._makeOne(2)
+        evicted = []
+        cache.on_evict(lambda *args: evicted.append(args))
+        cache.put('a', 1, timeout=-1)
+        cache.put('b', 2, timeout=-1)
+        cache.put('c', 3)
+        self.assertEqual(evicted, [('a', 1, 'expiry')])
+        self.assertEqual(cache.purge_expired(), 1)
+        self.assertEqual(evicted[1:], [('b', 2, 'expiry')])
+        cache.put('d', 4)
+        cache.put('e', 5)
+        self.assertEqual(evicted[2:], [('c', 3, 'capacity')])
+
+    def test_next_expiry(self):
+        cache = self._makeOne(5)
+        self.assertIsNone(cache.next_expiry())
+        before = time.time()
+        cache.put("one", 1, timeout=20)
+        cache.put("two", 2, timeout=10)
+        after = time.time()
+        expiry = cache.next_expiry()
+        self.assertTrue(before + 10 <= expiry <= after + 10)
+        cache.invalidate("two")
+        expiry = cache.next_expiry()
+        self.assertTrue(before + 20 <= expiry <= after + 20)
+        cache.invalidate("one")
+        self.assertIsNone(cache.next_expiry())
+
+    def test_expired_count(self):
+        cache = self._makeOne(5, default_timeout=0.1)
+        cache.put("one", 1)
+        cache.put("two", 2, timeout=10)
+        self.assertEqual(cache.expired_count(), 0)
+        time.sleep(0.1)
+        self.assertEqual(cache.expired_count(), 1)
+        # Expired entries stay resident until evicted or purged.
+        self.assertIsNone(cache.get("one"))
+        self.assertEqual(cache.expired_count(), 1)
+        cache.put("one", 1)
+        self.assertEqual(cache.expired_count(), 0)
+
+
+class ExpiringLRUCacheWithIndexTests(ExpiringLRUCacheTests):
+
+    def _makeOne(self, size, default_timeout=None):
+        if default_timeout is None:
+            return self._getTargetClass()(size, expiry_granularity=0.05)
+        else:
+            return self._getTargetClass()(
+                size, default_timeout=default_timeout,
+                expiry_granularity=0.05)
+
+    def test_index_hooks_put(self):
+        self.assertTrue(self._makeOne(3)._hooked)
+
+    def check_cache_is_consistent(self, cache):
+        ExpiringLRUCacheTests.check_cache_is_consistent(self, cache)
+        # The index must hold exactly the entries in cache.data
+        index = cache._expiry_index
+        self.assertEqual(len(index), len(cache.data))
+        for key, (pos, val, expires) in cache.data.items():
+            number = int(expires // index.granularity)
+            self.assertEqual(index.buckets[number][key], expires)
+
+    def test_pickle_keeps_index(self):
+        import pickle
+        cache = self._makeOne(3)
+        cache.put('one', 1)
+        clone = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(clone._expiry_index.granularity, 0.05)
+        self.check_cache_is_consistent(clone)
+
+    def test_ctor_bad_granularity(self):
+        self.assertRaises(ValueError, self._getTargetClass(), 10,
+                          expiry_granularity=0)
+
+    def test_eviction_updates_index(self):
+        cache = self._makeOne(2)
+        for i in range(10):
+            cache.put(i, i)
+        self.assertEqual(len(cache._expiry_index), 2)
+        self.check_cache_is_consistent(cache)
+
+    def test_expired_in_part_of_bucket(self):
+        from repoze.lru import _ExpiryIndex
+        index = _ExpiryIndex(10)
+        index.add('a', 101)
+        index.add('b', 105)
+        self.assertEqual(index.expired(102), ['a'])
+
+    def test_discard_missing(self):
+        from repoze.lru import _ExpiryIndex
+        index = _ExpiryIndex(10)
+        index.add('a', 101)
+        index.discard('b', 101)
+        index.discard('a', 201)
+        self.assertEqual(index.expired(102), ['a'])
+
+    def test_clear_resets_index(self):
+        cache = self._makeOne(2)
+        cache.put(1, 1)
+        cache.clear()
+        self.assertEqual(len(cache._expiry_index), 0)
+        self.assertIsNone(cache.next_expiry())
+
+    def test_heap_does_not_grow_on_overwrite(self):
+        cache = self._makeOne(10, default_timeout=100)
+        index = cache._expiry_index
+        for i in range(1000):
+            cache.put('k', i)
+        self.assertEqual(len(index.heap), 1)
+        # A key moving to later buckets leaves emptied buckets behind,
+        # pruned as new ones are added.
+        for i in range(1000):
+            cache.put('k', i, timeout=i)
+        self.assertEqual(len(index.heap), 1)
+        self.assertEqual(len(index.buckets), 1)
+        cache.put('other', 0, timeout=1000)
+        cache.invalidate('k')
+        self.assertEqual(cache.next_expiry(), cache.data['other'][2])
+        self.assertEqual(len(index.heap), 1)
+        self.check_cache_is_consistent(cache)
+
+    def test_expired_uses_buckets_in_order(self):
+        cache = self._makeOne(100, default_timeout=0.01)
+        for i in range(50):
+            cache.put(i, i, timeout=(i % 5) * 0.05)
+        time.sleep(0.01)
+        self.assertEqual(cache.expired_count(), 10)
+        self.assertEqual(cache.purge_expired(), 10)
+        self.assertEqual(len(cache.data), 40)
+        self.check_cache_is_consistent(cache)
+
+
+class LRUCachePyTests(LRUCacheTests):
+
+    def _getTargetClass(self):
+        from repoze.lru import LRUCachePy
+        return LRUCachePy
+
+
+class ExpiringLRUCachePyTests(ExpiringLRUCacheTests):
+
+    def _getTargetClass(self):
+        from repoze.lru import ExpiringLRUCachePy
+        return ExpiringLRUCachePy
+
+
+class WeakValueLRUCacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import WeakValueLRUCache
+        return WeakValueLRUCache
+
+    def _makeOne(self, size):
+        return self._getTargetClass()(size)
+
+    def test_get_put(self):
+        cache = self._makeOne(3)
+        value = Referent()
+        cache.put('key', value)
+        self.assertIs(cache.get('key'), value)
+        self.assertIsNone(cache.get('nonesuch'))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_dead_value_frees_slot(self):
+        cache = self._makeOne(3)
+        value = Referent()
+        cache.put('key', value)
+        pos = cache.data['key'][0]
+        del value
+        gc.collect()
+        self.assertEqual(cache.data, {})
+        self.assertFalse(cache.clock_refs[pos])
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.misses, 1)
+
+    def test_replaced_value_does_not_remove_entry(self):
+        cache = self._makeOne(3)
+        old = Referent()
+        new = Referent()
+        cache.put('key', old)
+        cache.put('key', new)
+        del old
+        gc.collect()
+        self.assertIs(cache.get('key'), new)
+
+    def test_dead_value_drops_tags(self):
+        cache = self._makeOne(3)
+        value = Referent()
+        cache.put('key', value, tags=('t',))
+        del value
+        gc.collect()
+        self.assertEqual(cache._dead_keys, ['key'])
+        keep = Referent()
+        cache.put('other', keep)
+        self.assertEqual(cache._dead_keys, [])
+        self.assertEqual(cache._tag_index.tags_by_key, {})
+
+    def test_peek_keys_items(self):
+        cache = self._makeOne(3)
+        value = Referent()
+        cache.put('key', value)
+        self.assertIs(cache.peek('key'), value)
+        self.assertTrue('key' in cache)
+        self.assertEqual(cache.items(), [('key', value)])
+        self.assertEqual(cache.lookups, 0)
+        del value
+        gc.collect()
+        self.assertFalse('key' in cache)
+        self.assertEqual(cache.keys(), [])
+
+    def test_dead_value_before_callback(self):
+        # Other threads may see an entry whose value died before the garbage
+        # collector calls back.
+        import weakref
+        cache = self._makeOne(3)
+        value = Referent()
+        cache.put('key', value)
+        dead = Referent()
+        cache.data['key'] = (cache.data['key'][0], weakref.ref(dead))
+        del dead
+        self.assertIsNone(cache.get('key'))
+        self.assertIsNone(cache.peek('key'))
+        self.assertEqual(cache.items(), [])
+        self.assertEqual(cache.misses, 1)
+
+    def test_dead_value_of_cleared_entry(self):
+        cache = self._makeOne(3)
+        cleared = []
+        cache.on_evict(lambda *args: cleared.append(args))
+        value = Referent()
+        live = Referent()
+        gate = _block_disposer()
+        try:
+            cache.put('dead', value)
+            cache.put('live', live)
+            cache.clear()
+            del value
+            gc.collect()
+        finally:
+            gate.set()
+        cache.flush_evictions()
+        self.assertEqual(cleared, [('live', live, 'clear')])
+        self.assertEqual(cache.data, {})
+
+    def test_key_put_again_keeps_tags(self):
+        # The value may die while another thread puts the key again.
+        cache = self._makeOne(3)
+        value = Referent()
+        other = Referent()
+        cache.put('key', value, tags=('t',))
+        cache._dead_keys.append('key')
+        cache.put('other', other)
+        self.assertEqual(cache._dead_keys, [])
+        self.assertEqual(cache._tag_index.tags_by_key,
+                         {'key': frozenset(['t'])})
+
+    def test_dead_cache(self):
+        import weakref
+        cache = self._makeOne(3)
+        value = Referent()
+        cache.put('key', value)
+        wr = cache.data['key'][1]
+        cacheref = weakref.ref(cache)
+        del cache
+        gc.collect()
+        self.assertIsNone(cacheref())
+        # The weak reference outlives the cache, and still calls back.
+        del value
+        gc.collect()
+        self.assertIsNone(wr())
+
+    def test_pickle(self):
+        import pickle
+        cache = self._makeOne(3)
+        self.assertRaises(TypeError, pickle.dumps, cache)
+
+    def test_intern_values(self):
+        cache = self._makeOne(3)
+        self.assertRaises(TypeError, cache.intern_values)
+
+    def test_unreferenceable_value(self):
+        cache = self._makeOne(3)
+        self.assertRaises(TypeError, cache.put, 'key', 42)
+
+    def test_on_evict(self):
+        cache = self._makeOne(1)
+        evicted = []
+        cache.on_evict(lambda *args: evicted.append(args))
+        value = Referent()
+        cache.put('key', value)
+        cache.put('key', value)
+        self.assertEqual(evicted, [])
+        cache.put('other', Referent())
+        self.assertEqual(evicted, [('key', value, 'capacity')])
+        # Dead values are not reported.
+        gc.collect()
+        cache.put('key', value)
+        cache.invalidate('other')
+        self.assertEqual(len(evicted), 1)
+
+
+class WeakKeyLRUCacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import WeakKeyLRUCache
+        return WeakKeyLRUCache
+
+    def _makeOne(self, size):
+        return self._getTargetClass()(size)
+
+    def test_get_put_invalidate(self):
+        cache = self._makeOne(3)
+        key = Referent()
+        cache.put(key, 'value')
+        self.assertEqual(cache.get(key), 'value')
+        self.assertIsNone(cache.get(Referent()))
+        cache.put(key, 'other')
+        self.assertEqual(cache.get(key), 'other')
+        self.assertEqual(len(cache.data), 1)
+        cache.invalidate(key)
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.data, {})
+
+    def test_dead_key_frees_slot(self):
+        cache = self._makeOne(3)
+        key = Referent()
+        cache.put(key, 'value')
+        pos = list(cache.data.values())[0][0]
+        del key
+        gc.collect()
+        self.assertEqual(cache.data, {})
+        self.assertFalse(cache.clock_refs[pos])
+
+    def test_peek_keys_items(self):
+        cache = self._makeOne(3)
+        key = Referent()
+        cache.put(key, 'value')
+        self.assertEqual(cache.peek(key), 'value')
+        self.assertIsNone(cache.peek(Referent()))
+        self.assertTrue(key in cache)
+        self.assertEqual(cache.keys(), [key])
+        self.assertEqual(cache.items(), [(key, 'value')])
+        self.assertEqual(dict(cache.view()), {key: 'value'})
+        self.assertEqual(cache.lookups, 0)
+
+    def test_dead_key_before_callback(self):
+        import weakref
+        cache = self._makeOne(3)
+        key = Referent()
+        cache.put(key, 'value')
+        dead = Referent()
+        pos, val = cache.data.pop(weakref.ref(key))
+        cache.data[weakref.ref(dead)] = (pos, val)
+        cache.clock_keys[pos] = weakref.ref(dead)
+        del dead
+        self.assertEqual(cache.items(), [])
+
+    def test_dead_key_of_cleared_entry(self):
+        cache = self._makeOne(3)
+        cleared = []
+        cache.on_evict(lambda *args: cleared.append(args))
+        key = Referent()
+        live = Referent()
+        gate = _block_disposer()
+        try:
+            cache.put(key, 1)
+            cache.put(live, 2)
+            cache.clear()
+            del key
+            gc.collect()
+        finally:
+            gate.set()
+        cache.flush_evictions()
+        self.assertEqual(cleared, [(live, 2, 'clear')])
+
+    def test_invalidate_tag_untagged(self):
+        cache = self._makeOne(3)
+        key = Referent()
+        cache.put(key, 1)
+        cache.invalidate_tag('t')
+        self.assertEqual(cache.get(key), 1)
+
+    def test_invalidate_tag(self):
+        cache = self._makeOne(3)
+        one = Referent()
+        two = Referent()
+        cache.put(one, 1, tags=('t',))
+        cache.put(two, 2)
+        cache.invalidate_tag('t')
+        self.assertIsNone(cache.get(one))
+        self.assertEqual(cache.get(two), 2)
+        self.assertEqual(cache._keys(), [two])
+
+    def test_dead_key_drops_tags(self):
+        cache = self._makeOne(3)
+        key = Referent()
+        cache.put(key, 1, tags=('t',))
+        cache.put(key, 2, tags=('t',))
+        del key
+        gc.collect()
+        cache.put(Referent(), 3)
+        gc.collect()
+        self.assertEqual(cache.data, {})
+        cache.put(Referent(), 4)
+        self.assertEqual(cache._tag_index.tags_by_key, {})
+
+    def test_on_evict(self):
+        cache = self._makeOne(1)
+        evicted = []
+        cache.on_evict(lambda *args: evicted.append(args))
+        one = Referent()
+        two = Referent()
+        cache.put(one, 1)
+        cache.put(two, 2, tags=('t',))
+        cache.invalidate_tag('t')
+        self.assertEqual(evicted, [(one, 1, 'capacity'),
+                                   (two, 2, 'invalidate')])
+
+
+class Referent(object):
+    pass
+
+
+def _block_disposer():
+    # Keep the thread releasing cleared entries and running background
+    # on_evict() callbacks busy until the returned event is set.
+    import threading
+    from repoze.lru import LRUCache
+    gate = threading.Event()
+    blocker = LRUCache(1)
+    blocker.on_evict(lambda *args: gate.wait(10), background=True)
+    blocker.put('key', 'value')
+    blocker.invalidate('key')
+    return gate
+
+
+class FrontCacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import FrontCache
+        return FrontCache
+
+    def _makeOne(self, cache, **kw):
+        return self._getTargetClass()(cache, **kw)
+
+    def test_ctor_bad_args(self):
+        from repoze.lru import LRUCache
+        self.assertRaises(ValueError, self._makeOne, LRUCache(10), size=0)
+        self.assertRaises(ValueError, self._makeOne, LRUCache(10),
+                          flush_every=0)
+
+    def test_replaced_value(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        cache.put('a', 1)
+        front = self._makeOne(cache)
+        self.assertTrue(cache._hooked)
+        self.assertEqual(front.get('a'), 1)
+        cache.put('a', 2)
+        self.assertEqual(front.get('a'), 2)
+
+    def test_hits_are_reported_in_batches(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        cache.put('a', 1)
+        front = self._makeOne(cache, flush_every=3)
+        self.assertEqual(front.get('a'), 1)
+        self.assertEqual(cache.hits, 1)
+        cache.clock_refs[0] = False
+        self.assertEqual(front.get('a'), 1)
+        self.assertEqual(front.get('a'), 1)
+        # Served by the front cache, not reported yet
+        self.assertEqual(cache.hits, 1)
+        self.assertFalse(cache.clock_refs[0])
+        self.assertEqual(front.get('a'), 1)
+        self.assertEqual(cache.hits, 4)
+        self.assertEqual(cache.lookups, 4)
+        self.assertTrue(cache.clock_refs[0])
+        front.get('a')
+        front.flush()
+        self.assertEqual(cache.hits, 5)
+
+    def test_miss(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        front = self._makeOne(cache)
+        self.assertIsNone(front.get('a'))
+        self.assertEqual(front.get('a', 2), 2)
+        self.assertEqual(cache.misses, 2)
+
+    def test_copies_dropped_on_changes(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(2)
+        front = self._makeOne(cache)
+        cache.put('a', 1)
+        front.get('a')
+        cache.put('a', 2)
+        self.assertEqual(front.get('a'), 2)
+        cache.invalidate('a')
+        self.assertIsNone(front.get('a'))
+        cache.put('a', 3)
+        self.assertEqual(front.get('a'), 3)
+        cache.clear()
+        self.assertIsNone(front.get('a'))
+        cache.put('a', 4)
+        front.get('a')
+        cache.put('b', 5)
+        cache.put('c', 6)
+        cache.put('d', 7)
+        self.assertIsNone(front.get('a'))
+
+    def test_put_and_invalidate(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        front = self._makeOne(cache)
+        front.put('a', 1, tags=('t',))
+        self.assertEqual(front.get('a'), 1)
+        front.put('a', 2, tags=('t',))
+        self.assertEqual(front.get('a'), 2)
+        front.invalidate_tag('t')
+        self.assertIsNone(front.get('a'))
+        front.put('a', 3)
+        front.invalidate('a')
+        self.assertIsNone(front.get('a'))
+        front.put('a', 4)
+        front.clear()
+        self.assertIsNone(front.get('a'))
+
+    def test_unbounded_cache(self):
+        from repoze.lru import UnboundedCache
+        cache = UnboundedCache()
+        front = self._makeOne(cache, flush_every=1)
+        cache.put('a', 1)
+        self.assertEqual(front.get('a'), 1)
+        self.assertEqual(front.get('a'), 1)
+        self.assertEqual(cache.hits, 2)
+        cache.put('a', 2)
+        self.assertEqual(front.get('a'), 2)
+
+    def test_expiring_cache(self):
+        from repoze.lru import ExpiringLRUCache
+        cache = ExpiringLRUCache(10)
+        front = self._makeOne(cache)
+        cache.put('a', 1, timeout=0.05)
+        self.assertEqual(front.get('a'), 1)
+        self.assertEqual(front.get('a'), 1)
+        time.sleep(0.06)
+        self.assertIsNone(front.get('a'))
+        # A shorter timeout for the same value is noticed too
+        cache.put('b', 2)
+        self.assertEqual(front.get('b'), 2)
+        cache.put('b', 2, timeout=-1)
+        self.assertIsNone(front.get('b'))
+
+    def test_hits_on_removed_entry(self):
+        from repoze.lru import ExpiringLRUCache
+        cache = ExpiringLRUCache(10)
+        front = self._makeOne(cache)
+        cache.put('a', 1)
+        front.get('a')
+        front.get('a')
+        cache.invalidate('a')
+        cache.put('b', 2)
+        # Reports the pending hit on 'a', which is gone.
+        self.assertEqual(front.get('b'), 2)
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.keys(), ['b'])
+
+    def test_weak_key_cache(self):
+        from repoze.lru import WeakKeyLRUCache
+        cache = WeakKeyLRUCache(10)
+        front = self._makeOne(cache, flush_every=1)
+        key = Referent()
+        cache.put(key, 1)
+        cache.clock_refs[0] = False
+        front.get(key)
+        front.get(key)
+        self.assertTrue(cache.clock_refs[0])
+        self.assertEqual(cache.hits, 2)
+
+    def test_size(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        front = self._makeOne(cache, size=2)
+        for key in range(3):
+            cache.put(key, key)
+            front.get(key)
+        self.assertEqual(list(front._local.entries), [2])
+
+    def test_threads_have_own_copies(self):
+        import threading
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        cache.put('a', 1)
+        front = self._makeOne(cache, flush_every=100)
+        front.get('a')
+        front.get('a')
+        results = []
+        def read():
+            results.append(front.get('a'))
+            results.append(dict(front._local.entries))
+            front.flush()
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [1, {'a': (1, None)}])
+        # The other thread missed its front cache
+        self.assertEqual(cache.hits, 2)
+        front.flush()
+        self.assertEqual(cache.hits, 3)
+
+    def test_with_lru_cache(self):
+        from repoze.lru import LRUCache
+        from repoze.lru import lru_cache
+        calls = []
+        front = self._makeOne(LRUCache(10))
+        @lru_cache(10, cache=front)
+        def func(x):
+            calls.append(x)
+            return x
+        func(1)
+        func(1)
+        func(1)
+        self.assertEqual(calls, [1])
+        func.invalidate(1)
+        func(1)
+        self.assertEqual(calls, [1, 1])
+        func.invalidate_where(lambda args, kw: True)
+        func(1)
+        self.assertEqual(calls, [1, 1, 1])
+
+
+class WriteBehindCacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import WriteBehindCache
+        return WriteBehindCache
+
+    def _makeOne(self, cache, **kw):
+        wb = self._getTargetClass()(cache, **kw)
+        self.addCleanup(wb.close)
+        return wb
+
+    def _inOtherThread(self, func, *args):
+        import threading
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func(*args)))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_bad_batch_size(self):
+        from repoze.lru import LRUCache
+        self.assertRaises(ValueError, self._getTargetClass(), LRUCache(3),
+                          batch_size=0)
+
+    def test_get_sees_own_queued_calls(self):
+        cache = GatedCache(3)
+        wb = self._makeOne(cache)
+        wb.put('a', 1)
+        wb.put('b', 2, tags=('t',))
+        self.assertEqual(wb.get('a'), 1)
+        self.assertIsNone(self._inOtherThread(wb.get, 'a'))
+        wb.invalidate('a')
+        self.assertIsNone(wb.get('a'))
+        self.assertEqual(wb.get('a', 3), 3)
+        self.assertEqual(cache.cache.data, {})
+        cache.gate.set()
+        wb.flush()
+        self.assertEqual(self._inOtherThread(wb.get, 'b'), 2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(wb._local.pending, {})
+        wb.invalidate_tag('t')
+        self.assertIsNone(wb.get('b'))
+
+    def test_calls_applied_in_worker_thread(self):
+        import threading
+        from repoze.lru import LRUCache
+        threads = []
+        class Value(object):
+            def __del__(self):
+                threads.append(threading.current_thread())
+        cache = LRUCache(1)
+        wb = self._makeOne(cache, batch_size=2)
+        wb.put('a', Value())
+        wb.put('b', Value())
+        wb.put('c', 3)
+        wb.flush()
+        gc.collect()
+        self.assertEqual(len(threads), 2)
+        self.assertFalse(threading.current_thread() in threads)
+        self.assertEqual(wb.get('c'), 3)
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(wb._keys(), ['c'])
+
+    def test_clear(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(3)
+        wb = self._makeOne(cache)
+        wb.clear()
+        wb.put('a', 1)
+        wb.clear()
+        self.assertIsNone(wb.get('a'))
+        self.assertEqual(cache.data, {})
+
+    def test_failed_calls_are_counted(self):
+        from repoze.lru import LRUCache
+        wb = self._makeOne(LRUCache(3))
+        wb.put('a', 1, nonesuch=True)
+        wb.put('b', 2)
+        wb.flush()
+        self.assertEqual(wb.failed, 1)
+        self.assertIsNone(wb.get('a'))
+        self.assertEqual(wb.get('b'), 2)
+
+    def test_close(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(3)
+        wb = self._makeOne(cache)
+        wb.close()
+        wb.put('a', 1)
+        thread = wb._worker.thread
+        wb.close()
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(wb._worker.thread)
+        self.assertEqual(cache.get('a'), 1)
+        wb.flush()
+        wb.put('b', 2)
+        wb.flush()
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_collected_without_close(self):
+        import weakref
+        cache = GatedCache(3)
+        wb = self._getTargetClass()(cache)
+        wb.put('a', 1)
+        wb.put('b', 2, nonesuch=True)
+        thread = wb._worker.thread
+        ref = weakref.ref(wb)
+        wb = None
+        gc.collect()
+        self.assertIsNone(ref())
+        # The calls queued so far are still applied.
+        cache.gate.set()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    def test_close_leaves_later_calls_queued(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(3)
+        wb = self._makeOne(cache)
+        wb._worker.queue.extend([None, None])
+        wb.put('a', 1)
+        wb._worker.thread.join()
+        self.assertEqual(len(wb._worker.queue), 2)
+        self.assertIsNone(cache.get('a'))
+        wb._worker.queue.popleft()
+        wb._worker.thread = None
+        wb.put('b', 2)
+        wb.flush()
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_reinit_after_fork(self):
+        # In a child, the worker thread is gone and the calls are queued.
+        from repoze.lru import LRUCache
+        cache = LRUCache(3)
+        wb = self._makeOne(cache)
+        wb._worker.queue.append(None)
+        wb.put('a', 1)
+        wb._worker.thread.join()
+        wb._reinit_after_fork()
+        wb.flush()
+        self.assertEqual(cache.get('a'), 1)
+        wb.close()
+        wb._reinit_after_fork()
+        self.assertIsNone(wb._worker.thread)
+
+    def test_lru_cache(self):
+        from repoze.lru import LRUCache
+        from repoze.lru import lru_cache
+        cache = LRUCache(3)
+        wb = self._makeOne(cache)
+        decorated = lru_cache(3, wb)(_adder)
+        self.assertEqual(decorated(1), 11)
+        self.assertEqual(decorated(1), 11)
+        wb.flush()
+        self.assertEqual(cache.get((1,)), 11)
+
+
+class InternPoolTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import InternPool
+        return InternPool
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def test_intern_release(self):
+        pool = self._makeOne()
+        first = _distinct_copy('value')
+        second = _distinct_copy('value')
+        self.assertIs(pool.intern(first), first)
+        self.assertIs(pool.intern(second), first)
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(len(pool), 1)
+        # Only values returned by intern() count
+        pool.release(second)
+        pool.release(first)
+        self.assertEqual(len(pool), 1)
+        pool.release(first)
+        self.assertEqual(len(pool), 0)
+        pool.release(first)
+        self.assertIs(pool.intern(second), second)
+
+    def test_types_are_not_merged(self):
+        pool = self._makeOne()
+        self.assertIs(pool.intern(1), 1)
+        self.assertIs(type(pool.intern(1.0)), float)
+        self.assertIs(pool.intern(True), True)
+        self.assertEqual(len(pool), 3)
+
+    def test_unhashable(self):
+        pool = self._makeOne()
+        value = []
+        self.assertIs(pool.intern(value), value)
+        pool.release(value)
+        self.assertEqual(len(pool), 0)
+
+
+class ValueCodecTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import ValueCodec
+        return ValueCodec
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, self._makeOne, 'nonesuch')
+        self.assertRaises(ValueError, self._makeOne, threshold=-1)
+
+    def test_named_codecs(self):
+        import zlib
+        self.assertIs(self._makeOne().codec, zlib)
+        for name in ('zlib', 'lzma', 'bz2'):
+            try:
+                codec = self._makeOne(name, threshold=0)
+            except ImportError:  # pragma: NO COVER
+                continue
+            self.assertEqual(codec.encode(b'a' * 100).value(), b'a' * 100)
+
+    def test_custom_codec(self):
+        class Reverse(object):
+            def compress(self, data):
+                return data[::-1][:-1]
+            def decompress(self, data):
+                return b'a' + data[::-1]
+        codec = self._makeOne(Reverse(), threshold=3)
+        self.assertEqual(codec.encode(b'abc').value(), b'abc')
+        self.assertEqual(codec.ratio, 1.5)
+
+    def test_values_left_alone(self):
+        import zlib
+        codec = self._makeOne(threshold=10)
+        self.assertEqual(codec.ratio, 1.0)
+        for val in (42, [b'x' * 100], b'x' * 9, zlib.compress(b'x' * 100)):
+            self.assertIs(codec.encode(val), val)
+        self.assertEqual(codec.compressed, 0)
+
+
+class HashedKeyTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import HashedKey
+        return HashedKey
+
+    def _makeOne(self, items=()):
+        return self._getTargetClass()(items)
+
+    def test_equals_plain_tuple(self):
+        key = self._makeOne((1, ('a', 'b')))
+        self.assertEqual(key, (1, ('a', 'b')))
+        self.assertEqual(hash(key), hash((1, ('a', 'b'))))
+        self.assertEqual(key[1], ('a', 'b'))
+        self.assertEqual(self._makeOne(), ())
+
+    def test_hash_is_computed_once(self):
+        class Item(object):
+            hashed = 0
+            def __hash__(self):
+                Item.hashed += 1
+                return 42
+        key = self._makeOne((Item(), 1))
+        hash(key)
+        hash(key)
+        self.assertEqual(Item.hashed, 1)
+
+    def test_unhashable(self):
+        self.assertRaises(TypeError, self._makeOne, ([1],))
+
+    def test_cache_lookups(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        cache.put(self._makeOne((1, 2)), 'a')
+        self.assertEqual(cache.get((1, 2)), 'a')
+        cache.put((3, 4), 'b')
+        self.assertEqual(cache.get(self._makeOne((3, 4))), 'b')
+
+    def test_hashvalue(self):
+        key = self._makeOne((1, 2))
+        self.assertEqual(key.hashvalue, hash((1, 2)))
+
+    def test_no_instance_dict(self):
+        from repoze.lru import HashedKeyPy
+        key = self._makeOne((1, 2))
+        # Only the pure-Python implementation needs one.
+        self.assertEqual(hasattr(key, '__dict__'),
+                         isinstance(key, HashedKeyPy))
+
+    def test_pickle(self):
+        import pickle
+        key = self._makeOne(('a', 1))
+        # The hash is not stored: string hashes differ between processes.
+        self.assertEqual(key.__reduce__(),
+                         (self._getTargetClass(), (('a', 1),)))
+        loaded = pickle.loads(pickle.dumps(key))
+        self.assertIs(type(loaded), self._getTargetClass())
+        self.assertEqual(loaded, ('a', 1))
+        self.assertEqual(hash(loaded), hash(('a', 1)))
+
+
+class HashedKeyPyTests(HashedKeyTests):
+
+    def _getTargetClass(self):
+        from repoze.lru import HashedKeyPy
+        return HashedKeyPy
+
+
 class DecoratorTests(unittest.TestCase):
 
     def _getTargetClass(self):
@@ -644,6 +2649,28 @@ class DecoratorTests(unittest.TestCase):
         with self.assertRaises(TypeError):
             decorated(3, 4, 5, a=1, b=[1, 2, 3])
 
+    def test_unhashable_keeps_type_error(self):
+        # Code run to look up ignore_unhashable_args while the TypeError is
+        # being handled must not lose it.
+        class decorator(self._getTargetClass()):
+            @property
+            def _ignore_unhashable_args(self):
+                try:
+                    {}['missing']
+                except KeyError:
+                    pass
+                return False
+
+            @_ignore_unhashable_args.setter
+            def _ignore_unhashable_args(self, value):
+                pass
+
+        def func(a, b=None):  # pragma: NO COVER
+            return a
+
+        decorated = decorator(10)(func)
+        self.assertRaises(TypeError, decorated, 1, b=[1])
+
     def test_expiry(self):
         #When timeout is given, decorator must eventually forget entries
         @self._makeOne(1, None, timeout=0.1)
@@ -673,6 +2700,352 @@ class DecoratorTests(unittest.TestCase):
         self.assertEqual(result3, 2 * "hello")
         self.assertTrue(stop - start > 0.1)
 
+    def test_tags(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        calls = []
+        @self._makeOne(10, cache, tags=("users",))
+        def load(user_id):
+            calls.append(user_id)
+            return user_id
+        load(1)
+        load(2)
+        self.assertEqual(cache._tag_index.keys_by_tag["users"],
+                         set([(1,), (2,)]))
+        cache.invalidate_tag("users")
+        load(1)
+        self.assertEqual(calls, [1, 2, 1])
+
+    def test_invalidate(self):
+        calls = []
+        @self._makeOne(10)
+        def add(a, b=0):
+            calls.append((a, b))
+            return a + b
+        add(1)
+        add(1, b=2)
+        add.invalidate(1)
+        add(1)
+        add(1, b=2)
+        self.assertEqual(calls, [(1, 0), (1, 2), (1, 0)])
+        add.invalidate(1, b=2)
+        add(1, b=2)
+        self.assertEqual(calls, [(1, 0), (1, 2), (1, 0), (1, 2)])
+        add.invalidate(5)  # not cached, does not raise
+
+    def test_invalidate_unhashable(self):
+        @self._makeOne(10, ignore_unhashable_args=True)
+        def func(a, b=None):  # pragma: NO COVER
+            return a
+        func.invalidate(1, b=[1])  # does not raise
+        @self._makeOne(10)
+        def func(a, b=None):  # pragma: NO COVER
+            return a
+        self.assertRaises(TypeError, func.invalidate, 1, b=[1])
+
+    def test_invalidate_where(self):
+        @self._makeOne(10)
+        def func(user_id, item=None, lang='en'):
+            return user_id, item, lang
+        func(42, 1)
+        func(42, 2, lang='de')
+        func(43, 1)
+        func.invalidate_where(lambda args, kw: kw.get('lang') == 'de')
+        self.assertEqual(len(func._cache.data), 2)
+        func.invalidate_where(lambda args, kw: args[0] == 42)
+        self.assertEqual(list(func._cache.data), [(43, 1)])
+
+    def test_invalidate_where_expiring(self):
+        @self._makeOne(10, timeout=10)
+        def func(*args):
+            return args
+        func(1)
+        func(2)
+        func.invalidate_where(lambda args, kw: args[0] == 1)
+        self.assertEqual(list(func._cache.data), [(2,)])
+
+    def test_invalidate_prefix_scan(self):
+        @self._makeOne(None)
+        def func(*args):
+            return args
+        func(42, 1)
+        func(42, 2)
+        func(43, 1)
+        func.invalidate_prefix(42)
+        self.assertEqual(list(func._cache._data), [(43, 1)])
+        func.invalidate_prefix()
+        self.assertEqual(func._cache._data, {})
+
+    def test_invalidate_prefix_indexed(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        @self._makeOne(10, cache, prefix_index=2)
+        def func(*args, **kwargs):
+            return args
+        func(42, 1, 'a')
+        func(42, 1, 'b', x=1)
+        func(42, 2, 'a')
+        func(43, 1, 'a')
+        func()
+        func.invalidate_prefix(42, 1)
+        self.assertEqual(len(cache.data), 3)
+        func.invalidate_prefix(42)
+        self.assertEqual(set(cache.data), set([(43, 1, 'a'), ()]))
+        # Longer prefixes fall back to scanning
+        func.invalidate_prefix(43, 1, 'a')
+        self.assertEqual(list(cache.data), [()])
+
+    def test_prefix_index_with_tags(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        @self._makeOne(10, cache, tags=('t',), prefix_index=1)
+        def func(*args):
+            return args
+        func(1, 2)
+        func(2, 2)
+        func.invalidate_prefix(1)
+        self.assertEqual(list(cache.data), [(2, 2)])
+        cache.invalidate_tag('t')
+        self.assertEqual(cache.data, {})
+
+    def test_prefix_index_per_function(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        decorator = self._makeOne(10, cache, prefix_index=1)
+        one = decorator(lambda *args: args)
+        two = decorator(lambda *args: args + args)
+        one(1)
+        two(1, 1)
+        one.invalidate_prefix(1)
+        self.assertEqual(list(cache.data), [(1, 1)])
+
+    def test_weak_values(self):
+        from repoze.lru import WeakValueLRUCache
+        @self._makeOne(10, weak_values=True)
+        def make(key):
+            return Referent()
+        self.assertIsInstance(make._cache, WeakValueLRUCache)
+        value = make(1)
+        self.assertIs(make(1), value)
+        del value
+        gc.collect()
+        self.assertEqual(make._cache.data, {})
+
+    def test_weak_keys_untagged(self):
+        @self._makeOne(10, weak_keys=True)
+        def derive(obj):
+            return id(obj)
+        obj = Referent()
+        self.assertEqual(derive(obj), id(obj))
+        self.assertEqual(derive(obj), id(obj))
+        self.assertEqual(derive._cache.hits, 1)
+
+    def test_weak_keys(self):
+        from repoze.lru import WeakKeyLRUCache
+        calls = []
+        @self._makeOne(10, weak_keys=True, tags=('t',))
+        def derive(obj):
+            calls.append(obj)
+            return id(obj)
+        self.assertIsInstance(derive._cache, WeakKeyLRUCache)
+        obj = Referent()
+        self.assertEqual(derive(obj), id(obj))
+        self.assertEqual(derive(obj), id(obj))
+        self.assertEqual(len(calls), 1)
+        derive.invalidate(obj)
+        derive(obj)
+        self.assertEqual(len(calls), 2)
+        derive.invalidate_where(lambda args, kw: args[0] is obj)
+        self.assertEqual(derive._cache.data, {})
+        self.assertRaises(TypeError, derive.invalidate, obj, 1)
+        derive(obj)
+        del calls[:]
+        obj = None
+        gc.collect()
+        self.assertEqual(derive._cache.data, {})
+
+    def test_weak_bad_options(self):
+        self.assertRaises(ValueError, self._makeOne, 10,
+                          weak_keys=True, weak_values=True)
+        self.assertRaises(ValueError, self._makeOne, None, weak_keys=True)
+        self.assertRaises(ValueError, self._makeOne, 10, timeout=1,
+                          weak_values=True)
+        self.assertRaises(ValueError, self._makeOne, 10, weak_keys=True,
+                          prefix_index=1)
+        self.assertRaises(ValueError, self._makeOne, 10, weak_keys=True,
+                          hashed_keys=True)
+
+    def test_hashed_keys(self):
+        from repoze.lru import HashedKey
+        calls = []
+        @self._makeOne(10, hashed_keys=True, prefix_index=1)
+        def derive(*args, **kwargs):
+            calls.append(args)
+            return len(args) + len(kwargs)
+        self.assertEqual(derive(1, 2), 2)
+        self.assertEqual(derive(1, 2), 2)
+        self.assertEqual(derive(1, 2, c=3), 3)
+        self.assertEqual(derive(1, 2, c=3), 3)
+        self.assertEqual(len(calls), 2)
+        keys = derive._cache._keys()
+        self.assertEqual([type(key) for key in keys], [HashedKey, HashedKey])
+        self.assertEqual(dict(derive._cache.items()),
+                         {((1, 2), frozenset([('c', 3)])): 3, (1, 2): 2})
+        found = []
+        derive.invalidate_where(lambda args, kw: found.append((args, kw)))
+        self.assertEqual(len(found), 2)
+        self.assertTrue(((1, 2), {}) in found)
+        self.assertTrue(((1, 2), {'c': 3}) in found)
+        derive.invalidate(1, 2)
+        self.assertEqual(derive._cache._keys(),
+                         [((1, 2), frozenset([('c', 3)]))])
+        derive.invalidate_prefix(1)
+        self.assertEqual(derive._cache._keys(), [])
+
+    def test_codec(self):
+        decorated = self._makeOne(10, codec='zlib', codec_threshold=10)(
+            lambda count: u'x' * count)
+        self.assertEqual(decorated(100), u'x' * 100)
+        self.assertEqual(decorated(100), u'x' * 100)
+        self.assertEqual(decorated(5), u'x' * 5)
+        self.assertEqual(decorated._cache.value_codec.compressed, 1)
+        self.assertEqual(decorated._cache.hits, 1)
+
+    def _makeRefreshing(self, executor, **kw):
+        calls = []
+        @self._makeOne(10, timeout=10, refresh_ahead=0.5,
+                       refresh_executor=executor, **kw)
+        def compute(x):
+            calls.append(x)
+            return (x, len(calls))
+        return compute, calls
+
+    def _expireSoon(self, cache, key):
+        pos, val, expires = cache.data[key]
+        cache.data[key] = (pos, val, time.time() + 1)
+        return pos
+
+    def test_refresh_ahead(self):
+        executor = DeferringExecutor()
+        compute, calls = self._makeRefreshing(executor)
+        cache = compute._cache
+        self.assertEqual(compute(1), (1, 1))
+        self.assertEqual(compute(1), (1, 1))
+        self.assertEqual(executor.calls, [])
+        self._expireSoon(cache, (1,))
+        self.assertEqual(compute(1), (1, 1))
+        self.assertEqual(compute(1), (1, 1))
+        self.assertEqual(len(executor.calls), 1)
+        executor.run()
+        self.assertEqual(calls, [1, 1])
+        self.assertTrue(cache.data[(1,)][2] > time.time() + 9)
+        self.assertEqual(compute(1), (1, 2))
+        self.assertEqual(executor.calls, [])
+
+    def test_refresh_ahead_skips_cold_entries(self):
+        executor = DeferringExecutor()
+        compute, calls = self._makeRefreshing(executor)
+        compute(1)
+        pos = self._expireSoon(compute._cache, (1,))
+        compute._cache.clock_refs[pos] = False
+        compute(1)
+        self.assertEqual(executor.calls, [])
+        # That call marked the entry as used.
+        compute(1)
+        self.assertEqual(len(executor.calls), 1)
+
+    def test_refresh_ahead_invalidated_meanwhile(self):
+        executor = DeferringExecutor()
+        compute, calls = self._makeRefreshing(executor, hashed_keys=True)
+        compute(1)
+        self._expireSoon(compute._cache, (1,))
+        compute(1)
+        compute.invalidate(1)
+        executor.run()
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(compute._cache.data, {})
+
+    def test_refresh_ahead_executor_shut_down(self):
+        class ShutDown(object):
+            def submit(self, *args):
+                raise RuntimeError('shut down')
+        compute, calls = self._makeRefreshing(ShutDown())
+        compute(1)
+        self._expireSoon(compute._cache, (1,))
+        self.assertEqual(compute(1), (1, 1))
+        self.assertEqual(compute(1), (1, 1))
+
+    def test_refresh_ahead_default_executor(self):
+        compute, calls = self._makeRefreshing(None)
+        compute(1)
+        self._expireSoon(compute._cache, (1,))
+        compute(1)
+        for i in range(100):  # pragma: NO BRANCH
+            if compute._cache.peek((1,)) == (1, 2):
+                break
+            time.sleep(0.01)
+        self.assertEqual(compute(1), (1, 2))
+
+    def test_refresh_ahead_default_timeout(self):
+        from repoze.lru import ExpiringLRUCache
+        decorator = self._makeOne(10, ExpiringLRUCache(10, default_timeout=20),
+                                  refresh_ahead=0.5)
+        self.assertEqual(decorator._refresh_window, 10)
+
+    def test_refresh_ahead_without_futures(self):
+        import sys
+        self.addCleanup(sys.modules.update, dict(sys.modules))
+        self.addCleanup(sys.modules.pop, 'concurrent.futures')
+        sys.modules['concurrent.futures'] = None
+        self.assertRaises(ValueError, self._makeOne, 10, timeout=10,
+                          refresh_ahead=0.5)
+        executor = DeferringExecutor()
+        decorator = self._makeOne(10, timeout=10, refresh_ahead=0.5,
+                                  refresh_executor=executor)
+        self.assertIs(decorator._refresh_executor, executor)
+
+    def test_refresh_ahead_bad_options(self):
+        from repoze.lru import LRUCache
+        self.assertRaises(ValueError, self._makeOne, 10, timeout=10,
+                          refresh_ahead=1)
+        self.assertRaises(ValueError, self._makeOne, 10, refresh_ahead=0.5)
+        self.assertRaises(ValueError, self._makeOne, 10, LRUCache(10),
+                          timeout=10, refresh_ahead=0.5)
+
+    def test_refresh_ahead_ignore_unhashable(self):
+        decorated = self._makeOne(10, timeout=10, refresh_ahead=0.5,
+                                  ignore_unhashable_args=True)(len)
+        self.assertEqual(decorated([1, 2]), 2)
+        decorated = self._makeOne(10, timeout=10, refresh_ahead=0.5)(len)
+        self.assertRaises(TypeError, decorated, [1, 2])
+
+    def test_jitter(self):
+        from repoze.lru import LRUCache
+        decorated = self._makeOne(10, timeout=10, jitter=0.2)(_adder)
+        self.assertEqual(decorated._cache.jitter, 0.2)
+        self.assertRaises(ValueError, self._makeOne, 10, jitter=0.2)
+        self.assertRaises(ValueError, self._makeOne, 10, LRUCache(10),
+                          jitter=0.2)
+        self.assertRaises(ValueError, self._makeOne, 10, timeout=10,
+                          jitter=2)
+
+    def test_hashed_keys_use_c_wrapper(self):
+        wrapper_type = self._getTargetClass()._CachedWrapper
+        decorated = self._makeOne(10, hashed_keys=True)(len)
+        if wrapper_type is not None:
+            self.assertIs(type(decorated), wrapper_type)
+        self.assertEqual(decorated((1, 2)), 2)
+        self.assertEqual(decorated((1, 2)), 2)
+        self.assertEqual(decorated._cache.hits, 1)
+
+    def test_hashed_keys_ignore_unhashable(self):
+        decorated = self._makeOne(10, hashed_keys=True,
+                                  ignore_unhashable_args=True)(len)
+        self.assertEqual(decorated([1, 2]), 2)
+        self.assertEqual(decorated._cache._keys(), [])
+        decorated = self._makeOne(10, hashed_keys=True)(len)
+        self.assertRaises(TypeError, decorated, [1, 2])
+
     def test_partial(self):
         #lru_cache decorator must not crash on functools.partial instances
         def add(a,b):
@@ -683,6 +3056,394 @@ class DecoratorTests(unittest.TestCase):
         decorated = lru_cache(20)(add_five)
         self.assertEqual(decorated(3), 8)
 
+    def test_binds_as_method(self):
+        decorator = self._makeOne(10)
+        class Adder(object):
+            def __init__(self, base):
+                self.base = base
+            @decorator
+            def add(self, x):
+                return self.base + x
+        self.assertEqual(Adder(1).add(2), 3)
+        self.assertEqual(Adder(10).add(2), 12)
+        self.assertEqual(Adder.add(Adder(5), 2), 7)
+
+    def test_wrapper_attributes_are_writable(self):
+        decorator = self._makeOne(10)
+        def wrapped(key):
+            return key
+        decorated = decorator(wrapped)
+        decorated.custom = 'value'
+        self.assertEqual(decorated.custom, 'value')
+        self.assertEqual(decorated.__name__, 'wrapped')
+        self.assertEqual(decorated(1), 1)
+
+    def test_shadowed_cache_get_is_used(self):
+        decorator = self._makeOne(10)
+        calls = []
+        def wrapped(key):
+            return key
+        decorated = decorator(wrapped)
+        decorated(1)
+        get = decorator.cache.get
+        def recording_get(key, default=None):
+            calls.append(key)
+            return get(key, default)
+        decorator.cache.get = recording_get
+        self.assertEqual(decorated(1), 1)
+        self.assertEqual(calls, [(1,)])
+
+
+class DecoratorPyTests(DecoratorTests):
+
+    def _getTargetClass(self):
+        from repoze.lru import lru_cache
+        class pure_lru_cache(lru_cache):
+            _CachedWrapper = None
+        return pure_lru_cache
+
+
+class PickledAdder(object):
+    # At module level, so that instances can be pickled.
+    from repoze.lru import cached_method
+
+    def __init__(self, base):
+        self.base = base
+        self.calls = 0
+
+    @cached_method(10)
+    def add(self, x):
+        self.calls += 1
+        return self.base + x
+
+    del cached_method
+
+
+class CachedMethodTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import cached_method
+        return cached_method
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def _makeClass(self, *args, **kw):
+        decorator = self._makeOne(*args, **kw)
+
+        class Adder(object):
+            def __init__(self, base):
+                self.base = base
+                self.calls = 0
+
+            @decorator
+            def add(self, x, y=0):
+                "Add to base"
+                self.calls += 1
+                return self.base + x + y
+
+        return Adder
+
+    def test_ctor_no_size(self):
+        self.assertRaises(ValueError, self._makeOne, None)
+
+    def test_class_access(self):
+        cls = self._makeClass(10)
+        self.assertIsInstance(cls.add, self._getTargetClass())
+        self.assertEqual(cls.add.__doc__, "Add to base")
+
+    def test_per_instance(self):
+        from repoze.lru import LRUCache
+        cls = self._makeClass(10)
+        one, two = cls(1), cls(2)
+        self.assertEqual(one.add(1), 2)
+        self.assertEqual(one.add(1), 2)
+        self.assertEqual(one.add(1, y=1), 3)
+        self.assertEqual(two.add(1), 3)
+        self.assertEqual(one.calls, 2)
+        self.assertEqual(two.calls, 1)
+        self.assertIsInstance(one.add._cache, LRUCache)
+        self.assertIs(one.add._cache, one._add_cache)
+        self.assertIsNot(one.add._cache, two.add._cache)
+        self.assertEqual(set(one._add_cache.data),
+                         set([(1,), ((1,), frozenset([('y', 1)]))]))
+        self.assertEqual(one.add.__name__, 'add')
+
+    def test_bound_once(self):
+        cls = self._makeClass(10)
+        obj = cls(1)
+        method = obj.add
+        self.assertIs(obj.add, obj.add)
+        self.assertEqual(list(obj.__dict__), ['base', 'calls', '_add_cache'])
+        self.assertIs(method._cache, obj.add._cache)
+        self.assertEqual(method(1), 2)
+        self.assertEqual(obj.add(1), 2)
+        self.assertEqual(obj.calls, 1)
+        # The first bound method keeps a temporary instance alive.
+        self.assertEqual(cls(2).add(1), 3)
+
+    def test_overridden_in_subclass(self):
+        cls = self._makeClass(10)
+        class Sub(cls):
+            def add(self, x, y=0):
+                return super(Sub, self).add(x, y) * 2
+        obj = Sub(1)
+        self.assertEqual(obj.add(1), 4)
+        self.assertEqual(obj.add(1), 4)
+        self.assertEqual(obj.calls, 1)
+        # The instance does not shadow the override.
+        self.assertNotIn('add', obj.__dict__)
+
+    def test_copy(self):
+        import copy
+        cls = self._makeClass(10)
+        obj = cls(1)
+        self.assertEqual(obj.add(1), 2)
+        clone = copy.copy(obj)
+        clone.base = 100
+        self.assertEqual(clone.add(1), 101)
+        self.assertEqual(clone.add(2), 102)
+        self.assertEqual(obj.add(2), 3)
+        self.assertIsNot(clone._add_cache, obj._add_cache)
+        deep = copy.deepcopy(obj)
+        deep.base = 200
+        self.assertEqual(deep.add(1), 2)
+        self.assertEqual(deep.add(3), 203)
+        self.assertEqual(obj.add(3), 4)
+
+    def test_copy_shared(self):
+        import copy
+        cls = self._makeClass(10, shared=True)
+        obj = cls(1)
+        self.assertEqual(obj.add(1), 2)
+        clone = copy.copy(obj)
+        clone.base = 100
+        self.assertEqual(clone.add(1), 101)
+        self.assertEqual(obj.add(1), 2)
+        clone.add.clear()
+        self.assertEqual(obj.add(1), 2)
+        self.assertEqual(obj.calls, 1)
+
+    def test_pickle(self):
+        import pickle
+        obj = PickledAdder(1)
+        self.assertEqual(obj.add(1), 2)
+        copied = pickle.loads(pickle.dumps(obj))
+        self.assertEqual(copied.add(1), 2)
+        self.assertEqual(copied.add(2), 3)
+        self.assertEqual(copied.calls, 2)
+        self.assertEqual(obj.calls, 1)
+
+    def test_bound_method_outlives_instance(self):
+        cls = self._makeClass(10)
+        obj = cls(1)
+        obj.add(1)
+        method = obj.add
+        obj = None
+        self.assertEqual(method(1), 2)
+        self.assertRaises(ReferenceError, method, 2)
+
+    def test_instance_cache_grows(self):
+        cls = self._makeClass(1000)
+        obj = cls(1)
+        obj.add(1)
+        self.assertTrue(len(obj._add_cache.clock_keys) < 10)
+        for i in range(100):
+            obj.add(i)
+        self.assertEqual(len(obj._add_cache.data), 100)
+        self.assertTrue(len(obj._add_cache.clock_keys) < 200)
+
+    def test_clear(self):
+        cls = self._makeClass(10)
+        one, two = cls(1), cls(2)
+        one.add(1)
+        two.add(1)
+        one.add.clear()
+        one.add(1)
+        two.add(1)
+        self.assertEqual(one.calls, 2)
+        self.assertEqual(two.calls, 1)
+
+    def test_instance_not_kept_alive(self):
+        import weakref
+        cls = self._makeClass(10)
+        obj = cls(1)
+        obj.add(1)
+        ref = weakref.ref(obj)
+        obj = None
+        self.assertIsNone(ref())
+        self.assertEqual(cls.add._bound, {})
+        self.assertEqual(cls.add._owners, {})
+
+    def test_timeout(self):
+        from repoze.lru import ExpiringLRUCache
+        cls = self._makeClass(10, timeout=0.1)
+        obj = cls(1)
+        obj.add(1)
+        self.assertIsInstance(obj.add._cache, ExpiringLRUCache)
+        time.sleep(0.1)
+        obj.add(1)
+        self.assertEqual(obj.calls, 2)
+
+    def test_slots(self):
+        decorator = self._makeOne(10)
+        class Slotted(object):
+            __slots__ = ('_value_cache',)
+            @decorator
+            def value(self, x):
+                return x * 2
+        obj = Slotted()
+        self.assertEqual(obj.value(2), 4)
+        self.assertEqual(obj._value_cache.get((2,)), 4)
+        self.assertIsNot(obj.value, obj.value)
+        self.assertIs(obj.value._cache, obj.value._cache)
+
+    def test_shared(self):
+        cls = self._makeClass(3, shared=True)
+        self.assertEqual(cls.add.cache.size, 3)
+        objects = [cls(i) for i in range(5)]
+        for obj in objects:
+            self.assertEqual(obj.add(1, y=1), obj.base + 2)
+            self.assertIs(obj.add._cache, cls.add.cache)
+        self.assertEqual(len(cls.add.cache.data), 3)
+        last = objects[-1]
+        last.add(1, y=1)
+        self.assertEqual(last.calls, 1)
+        objects[-2].add.clear()
+        objects[-2].add(1, y=1)
+        last.add(1, y=1)
+        self.assertEqual(objects[-2].calls, 2)
+        self.assertEqual(last.calls, 1)
+
+
+class BatchCachedTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru import batch_cached
+        return batch_cached
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def _makeSquares(self, *args, **kw):
+        calls = []
+        @self._makeOne(*args, **kw)
+        def squares(items, offset=0):
+            "Square items"
+            calls.append(items)
+            return [item * item + offset for item in items]
+        return squares, calls
+
+    def test_ctor(self):
+        from repoze.lru import ExpiringLRUCache
+        from repoze.lru import LRUCache
+        from repoze.lru import UnboundedCache
+        self.assertIsInstance(self._makeOne(None).cache, UnboundedCache)
+        self.assertIsInstance(self._makeOne(10).cache, LRUCache)
+        self.assertIsInstance(self._makeOne(10, timeout=1).cache,
+                              ExpiringLRUCache)
+
+    def test_only_misses_are_computed(self):
+        squares, calls = self._makeSquares(100)
+        self.assertEqual(squares.__doc__, "Square items")
+        self.assertEqual(squares([1, 2, 3]), [1, 4, 9])
+        self.assertEqual(squares([3, 4, 1, 4, 5]), [9, 16, 1, 16, 25])
+        self.assertEqual(calls, [[1, 2, 3], [4, 5]])
+        self.assertEqual(squares((2, 3)), [4, 9])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(squares([]), [])
+        self.assertEqual(len(calls), 2)
+
+    def test_iterable(self):
+        squares, calls = self._makeSquares(100)
+        self.assertEqual(squares(iter([1, 2])), [1, 4])
+        self.assertEqual(calls, [[1, 2]])
+
+    def test_extra_args_are_part_of_key(self):
+        squares, calls = self._makeSquares(100)
+        self.assertEqual(squares([1, 2]), [1, 4])
+        self.assertEqual(squares([1, 2], offset=1), [2, 5])
+        self.assertEqual(squares([2], offset=1), [5])
+        self.assertEqual(calls, [[1, 2], [1, 2]])
+
+    def test_wrong_result_length(self):
+        @self._makeOne(100)
+        def broken(items):
+            return items[:-1]
+        self.assertRaises(ValueError, broken, [1, 2])
+
+    def test_cache_and_partial(self):
+        from functools import partial
+        from repoze.lru import UnboundedCache
+        def scaled(factor, items):
+            return [item * factor for item in items]
+        cache = UnboundedCache()
+        decorated = self._makeOne(None, cache)(partial(scaled, 3))
+        self.assertIs(decorated._cache, cache)
+        self.assertEqual(decorated([1, 2]), [3, 6])
+        self.assertEqual(cache.get(2), 6)
+
+    def test_numpy(self):
+        try:
+            import numpy
+        except ImportError:  # pragma: NO COVER
+            return
+        calls = []
+        @self._makeOne(100)
+        def squares(items):
+            calls.append(items)
+            return items * items
+        result = squares(numpy.array([1, 2, 3]))
+        self.assertEqual(result.tolist(), [1, 4, 9])
+        result = squares(numpy.array([3, 4, 4]))
+        self.assertIsInstance(result, numpy.ndarray)
+        self.assertEqual(result.tolist(), [9, 16, 16])
+        self.assertEqual(calls[1].tolist(), [4])
+        self.assertEqual(squares(numpy.array([1, 4])).tolist(), [1, 16])
+
+
+def _distinct_copy(text):
+    # Return a string equal to text, but not text itself.
+    return ''.join(list(text))
+
+
+class DeferringExecutor(object):
+    # Runs the submitted calls when told to.
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, func, *args):
+        self.calls.append((func, args))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for func, args in calls:
+            func(*args)
+
+
+class GatedCache(object):
+    # LRUCache whose put() waits until the gate is opened.
+
+    def __init__(self, size):
+        import threading
+        from repoze.lru import LRUCache
+        self.cache = LRUCache(size)
+        self.gate = threading.Event()
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def put(self, key, val, *args, **kw):
+        self.gate.wait()
+        self.cache.put(key, val, *args, **kw)
+
+    def invalidate(self, key):
+        self.cache.invalidate(key)
+
+    def invalidate_tag(self, tag):
+        self.cache.invalidate_tag(tag)
+
 
 class DummyLRUCache(dict):
 
@@ -710,6 +3471,19 @@ class CacherMaker(unittest.TestCase):
         decorated(11)
         self.assertEqual(len(maker._cache[name].data),2)
 
+    def test_anonymous_caches(self):
+        maker = self._makeOne(10)
+        maker.lrucache(name='anonymous-2')(_adder)
+        maker.lrucache()(_adder)
+        maker.memoized()(_adder)
+        maker.expiring_lrucache()(_adder)
+        self.assertEqual(sorted(maker._cache),
+                         ['anonymous-1', 'anonymous-2', 'anonymous-3',
+                          'anonymous-4'])
+        self.assertEqual(type(maker._cache['anonymous-3']).__name__,
+                         'UnboundedCache')
+        self.assertRaises(KeyError, maker.lrucache, name='anonymous-1')
+
     def test_exception(self):
         maker = self._makeOne()
         size = 10
@@ -765,6 +3539,38 @@ class CacherMaker(unittest.TestCase):
         self.assertEqual(len(maker._cache['two'].data), 10)
         self.assertEqual(len(maker._cache['three'].data), 0)
 
+    def test_intern_values(self):
+        maker = self._makeOne(maxsize=10, intern_values=True)
+        first = maker.lrucache()(lambda x: _distinct_copy('value'))
+        second = maker.expiring_lrucache()(lambda x: _distinct_copy('value'))
+        third = maker.memoized()(lambda x: _distinct_copy('value'))
+        weak = maker.lrucache(weak_keys=True)(lambda x: x)
+        # Calls return the value they computed, hits the shared copy.
+        first(1)
+        second(1)
+        third(1)
+        self.assertIs(first(1), second(1))
+        self.assertIs(first(1), third(1))
+        self.assertIsNone(weak._cache.intern_pool)
+        self.assertEqual(maker.intern_pool.copies[(str, 'value')][1], 3)
+        maker.clear()
+        first._cache.flush_evictions()
+        first(2)
+        second(2)
+        third(2)
+        self.assertEqual(maker.intern_pool.copies[(str, 'value')][1], 3)
+
+    def test_expiring_refresh_ahead(self):
+        maker = self._makeOne(maxsize=10, timeout=10)
+        decorated = maker.expiring_lrucache(refresh_ahead=0.2)(_adder)
+        self.assertEqual(decorated(1), 11)
+
+    def test_expiring_jitter(self):
+        maker = self._makeOne(maxsize=10, timeout=10)
+        decorated = maker.expiring_lrucache(name='j', jitter=0.3)(_adder)
+        self.assertEqual(maker._cache['j'].jitter, 0.3)
+        self.assertEqual(decorated(1), 11)
+
     def test_memoized(self):
         from repoze.lru import lru_cache
         from repoze.lru import UnboundedCache
@@ -774,6 +3580,24 @@ class CacherMaker(unittest.TestCase):
         self.assertIsInstance(memo.cache, UnboundedCache)
         self.assertIs(memo.cache, maker._cache['test'])
 
+    def test_lrucache_weak(self):
+        from repoze.lru import WeakKeyLRUCache
+        from repoze.lru import WeakValueLRUCache
+        maker = self._makeOne(maxsize=10)
+        maker.lrucache(name='keys', weak_keys=True)
+        maker.lrucache(name='values', weak_values=True)
+        self.assertIsInstance(maker._cache['keys'], WeakKeyLRUCache)
+        self.assertIsInstance(maker._cache['values'], WeakValueLRUCache)
+        self.assertRaises(ValueError, maker.lrucache, name='both',
+                          weak_keys=True, weak_values=True)
+
+    def test_memoized_maxsize(self):
+        maker = self._makeOne(maxsize=10)
+        memo = maker.memoized('test', maxsize=100)
+        self.assertEqual(memo.cache.maxsize, 100)
+        memo = maker.memoized('other')
+        self.assertIsNone(memo.cache.maxsize)
+
     def test_expiring(self):
         size = 10
         timeout = 10
@@ -810,5 +3634,373 @@ class CacherMaker(unittest.TestCase):
         decorator = cache.expiring_lrucache(name=name, timeout=20)
         self.assertEqual(decorator.cache.default_timeout, timeout)
 
+    def test_invalidate_tag(self):
+        maker = self._makeOne(maxsize=10)
+        one = maker.lrucache(name='one', tags=('user',))(_adder)
+        two = maker.expiring_lrucache(name='two', tags=('user',))(_adder)
+        three = maker.memoized(name='three', tags=('user', 'memo'))(_adder)
+        four = maker.lrucache(name='four')(_adder)
+        for func in one, two, three, four:
+            func(1)
+        maker.invalidate_tag('user')
+        self.assertEqual(len(maker._cache['one'].data), 0)
+        self.assertEqual(len(maker._cache['two'].data), 0)
+        self.assertEqual(len(maker._cache['three']._data), 0)
+        self.assertEqual(len(maker._cache['four'].data), 1)
+
+class PoolMapTests(unittest.TestCase):
+
+    def _callFUT(self, *args, **kw):
+        from repoze.lru import pool_map
+        return pool_map(*args, **kw)
+
+    def setUp(self):
+        _pool_square._cache.clear()
+
+    def test_serves_hits_and_dedups_misses(self):
+        executor = DummyExecutor()
+        _pool_square(2)
+        result = self._callFUT(executor, _pool_square, [1, 2, 3, 1, 3])
+        self.assertEqual(result, [1, 4, 9, 1, 9])
+        self.assertEqual(executor.calls, [[(1,), (3,)]])
+        self.assertEqual(_pool_square._cache.get((3,)), 9)
+
+    def test_all_hits(self):
+        executor = DummyExecutor()
+        _pool_square(2)
+        self.assertEqual(self._callFUT(executor, _pool_square, [2, 2]),
+                         [4, 4])
+        self.assertEqual(executor.calls, [])
+
+    def test_multiple_iterables_and_kw(self):
+        executor = DummyExecutor()
+        result = self._callFUT(executor, _pool_add, [1, 2], [10, 20],
+                               chunksize=5)
+        self.assertEqual(result, [11, 22])
+        self.assertEqual(executor.kw, {'chunksize': 5})
+        self.assertEqual(_pool_add._cache.get((2, 20)), 22)
+
+    def test_process_pool(self):
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:  # pragma: NO COVER
+            return
+        with ProcessPoolExecutor(2) as executor:
+            result = self._callFUT(executor, _pool_square, range(10))
+        self.assertEqual(result, [x * x for x in range(10)])
+        self.assertEqual(_pool_square._cache.get((9,)), 81)
+
+
+class DummyExecutor(object):
+
+    def __init__(self):
+        self.calls = []
+        self.kw = None
+
+    def map(self, fn, items, **kw):
+        import pickle
+        fn = pickle.loads(pickle.dumps(fn))
+        self.calls.append(list(items))
+        self.kw = kw
+        return [fn(args) for args in items]
+
+
+def _pool_square(x):
+    return x * x
+
+def _pool_add(x, y):
+    return x + y
+
+def _decorate_pool_functions():
+    from repoze.lru import lru_cache
+    global _pool_square, _pool_add
+    _pool_square = lru_cache(100)(_pool_square)
+    _pool_add = lru_cache(100, tags=('add',))(_pool_add)
+
+_decorate_pool_functions()
+
+
+class TraceRecorderTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru.simulator import TraceRecorder
+        return TraceRecorder
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_bad_sample_rate(self):
+        from repoze.lru import LRUCache
+        self.assertRaises(ValueError, self._makeOne, LRUCache(10), 0)
+        self.assertRaises(ValueError, self._makeOne, LRUCache(10), 1.5)
+
+    def test_records_all(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        cache.put('a', 1)
+        with self._makeOne(cache, sample_rate=1) as recorder:
+            self.assertEqual(cache.get('a'), 1)
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(cache.get('c', 3), 3)
+        cache.get('d')
+        self.assertEqual(recorder.trace, ['a', 'b', 'c'])
+        self.assertEqual(cache.lookups, 4)
+        self.assertNotIn('get', cache.__dict__)
+
+    def test_decorated_function(self):
+        from repoze.lru import lru_cache
+        @lru_cache(10)
+        def func(x):
+            return x
+        recorder = self._makeOne(func, sample_rate=1)
+        recorder.start()
+        self.assertRaises(ValueError, recorder.start)
+        func(1)
+        func(1)
+        recorder.stop()
+        func(2)
+        self.assertEqual(recorder.trace, [(1,), (1,)])
+
+    def test_sampling_is_by_key(self):
+        from repoze.lru import UnboundedCache
+        cache = UnboundedCache()
+        with self._makeOne(cache, sample_rate=0.1) as recorder:
+            for i in range(3):
+                for key in range(1000):
+                    cache.get(key)
+        sampled = set(recorder.trace)
+        self.assertTrue(50 < len(sampled) < 150)
+        # Every sampled key is recorded on each lookup
+        self.assertEqual(len(recorder.trace), 3 * len(sampled))
+
+    def test_maxlen(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(10)
+        with self._makeOne(cache, sample_rate=1, maxlen=2) as recorder:
+            for key in range(5):
+                cache.get(key)
+        self.assertEqual(recorder.trace, [0, 1])
+
+
+class EventLogTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.lru.events import EventLog
+        return EventLog
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def _kinds(self, log):
+        return [(kind, key) for timestamp, kind, key in log.drain()]
+
+    def test_bad_capacity(self):
+        from repoze.lru import LRUCache
+        self.assertRaises(ValueError, self._makeOne, LRUCache(10), 0)
+
+    def test_stop_unhooks_put(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(2)
+        with self._makeOne(cache):
+            self.assertTrue(cache._hooked)
+        self.assertFalse(cache._hooked)
+
+    def test_lru_events(self):
+        from repoze.lru import LRUCache
+        cache = LRUCache(2)
+        before = time.time()
+        with self._makeOne(cache) as log:
+            cache.put('a', 1)
+            self.assertEqual(cache.get('a'), 1)
+            self.assertEqual(cache.get('b', 2), 2)
+            cache.put('b', 2)
+            cache.put('c', 3)
+        cache.put('d', 4)
+        self.assertEqual(len(log), 6)
+        self.assertTrue(all(timestamp >= before
+                            for timestamp, kind, key in log.events))
+        self.assertEqual(self._kinds(log), [
+            ('put', 'a'), ('hit', 'a'), ('miss', 'b'), ('put', 'b'),
+            ('put', 'c'), ('evict', 'a')])
+        self.assertEqual(len(log), 0)
+        self.assertEqual(cache.hits, 1)
+        for name in 'get', 'put', '_event_log':
+            self.assertNotIn(name, cache.__dict__)
+
+    def test_expiring_events(self):
+        from repoze.lru import ExpiringLRUCache
+        cache = ExpiringLRUCache(2)
+        with self._makeOne(cache) as log:
+            cache.put('a', 1, timeout=-1)
+            self.assertIsNone(cache.get('a'))
+            cache.put('b', 2, timeout=-1)
+            cache.put('c', 3)
+            cache.put('d', 4, timeout=-1)
+            self.assertEqual(cache.purge_expired(), 1)
+        self.assertEqual(self._kinds(log), [
+            ('put', 'a'), ('expire', 'a'), ('put', 'b'), ('put', 'c'),
+            ('expire', 'a'), ('put', 'd'), ('expire', 'b'),
+            ('expire', 'd')])
+
+    def test_unbounded_evictions(self):
+        from repoze.lru import UnboundedCache
+        cache = UnboundedCache(maxsize=2)
+        with self._makeOne(cache) as log:
+            for key in range(3):
+                cache.put(key, key)
+        self.assertEqual(self._kinds(log), [
+            ('put', 0), ('put', 1), ('put', 2), ('evict', 0)])
+
+    def test_decorated_function(self):
+        from repoze.lru import lru_cache
+        @lru_cache(10)
+        def func(x):
+            return x
+        log = self._makeOne(func)
+        log.start()
+        self.assertRaises(ValueError, log.start)
+        func(1)
+        func(1)
+        log.stop()
+        func(2)
+        self.assertEqual(self._kinds(log), [
+            ('miss', (1,)), ('put', (1,)), ('hit', (1,))])
+
+    def test_capacity_and_sampling(self):
+        from repoze.lru import UnboundedCache
+        cache = UnboundedCache()
+        with self._makeOne(cache, capacity=10, sample_rate=0.1) as log:
+            for i in range(3):
+                for key in range(1000):
+                    cache.get(key)
+        self.assertEqual(len(log), 10)
+        self.assertTrue(150 < log.recorded < 450)
+        self.assertEqual(log.recorded % 3, 0)
+
+    def test_dump_and_load(self):
+        import io
+        from repoze.lru import LRUCache
+        from repoze.lru.events import key_digest
+        from repoze.lru.events import load
+        cache = LRUCache(10)
+        with self._makeOne(cache) as log:
+            cache.get('a')
+            cache.put('a', 1)
+            cache.get('a')
+        timestamps = [timestamp for timestamp, kind, key in log.events]
+        fileobj = io.BytesIO()
+        self.assertEqual(log.dump(fileobj), 3)
+        self.assertEqual(len(log), 0)
+        fileobj.seek(0)
+        self.assertEqual(list(load(fileobj)), [
+            (timestamps[0], 'miss', key_digest('a')),
+            (timestamps[1], 'put', key_digest('a')),
+            (timestamps[2], 'hit', key_digest('a'))])
+        self.assertRaises(ValueError, list, load(io.BytesIO(b'garbage')))
+
+    def test_key_digest_is_stable(self):
+        # Unlike hash('a'), which depends on PYTHONHASHSEED.
+        from repoze.lru.events import key_digest
+        self.assertEqual(key_digest(1), 5525938153918655029)
+        self.assertEqual(key_digest((1, 2)), -1190258887970796144)
+
+
+class MissRatioCurveTests(unittest.TestCase):
+
+    def test_stack_distances(self):
+        from repoze.lru.simulator import stack_distances
+        self.assertEqual(stack_distances(['a', 'b', 'a', 'c', 'b', 'b', 'a']),
+                         [None, None, 1, None, 2, 0, 2])
+
+    def test_curve(self):
+        from repoze.lru.simulator import miss_ratio_curve
+        trace = ['a', 'b', 'a', 'c', 'b', 'b', 'a']
+        curve = miss_ratio_curve(trace, [1, 2, 3])
+        self.assertEqual(curve, [(1, 6 / 7.0), (2, 5 / 7.0), (3, 3 / 7.0)])
+        self.assertEqual(miss_ratio_curve([], [1]), [(1, 0.0)])
+
+    def test_curve_matches_clock(self):
+        from repoze.lru.simulator import clock_miss_ratio
+        from repoze.lru.simulator import miss_ratio_curve
+        rnd = random.Random(42)
+        trace = [int(rnd.paretovariate(1.2)) for i in range(20000)]
+        sizes = [10, 50, 200]
+        for size, miss_ratio in miss_ratio_curve(trace, sizes):
+            self.assertAlmostEqual(miss_ratio, clock_miss_ratio(trace, size),
+                                   delta=0.05)
+
+    def test_sampled_curve(self):
+        from repoze.lru import UnboundedCache
+        from repoze.lru.simulator import TraceRecorder
+        from repoze.lru.simulator import miss_ratio_curve
+        rnd = random.Random(42)
+        trace = [int(rnd.paretovariate(0.8)) for i in range(50000)]
+        cache = UnboundedCache()
+        with TraceRecorder(cache, sample_rate=0.1) as recorder:
+            for key in trace:
+                cache.get(key)
+        sizes = [100, 1000]
+        full = miss_ratio_curve(trace, sizes)
+        sampled = miss_ratio_curve(recorder.trace, sizes, sample_rate=0.1)
+        for (size, expected), (_, estimate) in zip(full, sampled):
+            self.assertAlmostEqual(expected, estimate, delta=0.1)
+
+    def test_suggest_size(self):
+        from repoze.lru.simulator import suggest_size
+        curve = [(300, 0.1), (100, 0.5), (200, 0.2)]
+        self.assertEqual(suggest_size(curve, 0.2), 200)
+        self.assertEqual(suggest_size(curve, 0.6), 100)
+        self.assertIsNone(suggest_size(curve, 0.05))
+
+    def test_clock_miss_ratio(self):
+        from repoze.lru.simulator import clock_miss_ratio
+        self.assertEqual(clock_miss_ratio([], 10), 0.0)
+        self.assertEqual(clock_miss_ratio([1, 2, 1, 2], 2), 0.5)
+        self.assertEqual(clock_miss_ratio([1, 2, 1, 2], 20, 0.05), 1.0)
+
+
+class ForkTests(unittest.TestCase):
+
+    def test_after_fork_in_child(self):
+        # The checks run in the child: _after_fork_in_child() replaces the
+        # module state, which would break the threads of this process.
+        import os
+        if not hasattr(os, 'register_at_fork'):  # pragma: NO COVER
+            return
+        from repoze import lru
+        cache = lru.LRUCache(3)
+        cache.put('one', 1)
+        cleared = lru.LRUCache(3)
+        cleared.put('one', 1)
+        cleared.clear_after_fork = True
+        lock = cache.lock
+        init_lock = lru._INIT_LOCK
+        # Starts the worker thread releasing cleared entries, which does not
+        # survive the fork.
+        dropped = lru.LRUCache(3)
+        dropped.put('one', 1)
+        dropped.clear()
+        dropped.flush_evictions()
+        pid = os.fork()
+        if pid == 0:  # pragma: NO COVER (child)
+            import signal
+            signal.alarm(5)
+            status = 1
+            try:
+                cache.clear()
+                cache.flush_evictions()
+                if (cache.lock is not lock and
+                        lru._INIT_LOCK is not init_lock and
+                        cleared.get('one') is None):
+                    status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertIs(cache.lock, lock)
+        self.assertEqual(cache.get('one'), 1)
+        self.assertEqual(cleared.get('one'), 1)
+
+
 def _adder(x):
     return x + 10
@@ -13,8 +13,15 @@
 ##############################################################################
 
 import os
+import platform
 
+from distutils.errors import CCompilerError
+from distutils.errors import DistutilsExecError
+from distutils.errors import DistutilsFileError
+from distutils.errors import DistutilsPlatformError
+from setuptools import Extension
 from setuptools import setup, find_packages
+from setuptools.command.build_ext import build_ext
 
 here = os.path.abspath(os.path.dirname(__file__))
 try:
@@ -26,6 +33,41 @@ except:
 
 testing_extras = ['nose', 'coverage']
 
+
+class optional_build_ext(build_ext):
+    """Build the C extension if possible, else fall back to pure Python."""
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except (DistutilsPlatformError, DistutilsFileError) as e:
+            self._unavailable(e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, OSError) as e:
+            self._unavailable(e)
+
+    def _unavailable(self, e):
+        print('*' * 75)
+        print('WARNING: the C extension could not be compiled, speedups are')
+        print('not enabled. repoze.lru falls back to pure Python.')
+        print('Failure information, if any, is above.')
+        print('Error: %s' % e)
+        print('*' * 75)
+
+
+# PyPy does not profit from the C extension.
+if (platform.python_implementation() == 'CPython' and
+        not os.environ.get('PURE_PYTHON')):
+    ext_modules = [
+        Extension('repoze.lru._speedups',
+                  [os.path.join('repoze', 'lru', '_speedups.c')]),
+    ]
+else:
+    ext_modules = []
+
 setup(name='repoze.lru',
       version='0.8dev0',
       description='A tiny LRU cache implementation and decorator',
@@ -49,6 +91,8 @@ setup(name='repoze.lru',
       url="http://www.repoze.org",
       license="BSD-derived (http://www.repoze.org/LICENSE.txt)",
       packages=find_packages(),
+      ext_modules=ext_modules,
+      cmdclass={'build_ext': optional_build_ext},
       include_package_data=True,
       namespace_packages=['repoze'],
       zip_safe=False,